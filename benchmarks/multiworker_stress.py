@@ -0,0 +1,75 @@
+"""
+Several processes write turns to the same conversation at the same time, as uvicorn workers do with MULTI_WORKER=1,
+then the conversation is checked: every turn, message and embedding must be there and the files must parse.
+
+Run from the project root:
+    python -m benchmarks.multiworker_stress [workers] [turns per worker]
+"""
+import os, sys, json, time, tempfile, multiprocessing
+import numpy as np
+
+DIM = 64
+
+
+def worker(conversations_dir: str, conversation_id: str, worker_id: int, turns: int):
+    os.environ["CONVERSATIONS_DIR"] = conversations_dir
+    os.environ["MULTI_WORKER"] = "1"
+    from routers.file_manager import get_conversation_session
+
+    session = get_conversation_session(conversation_id)
+    rng = np.random.default_rng(worker_id)
+    for turn in range(turns):
+        messages = [
+            {"role": "user", "content": f"worker {worker_id} turn {turn}"},
+            {"role": "assistant", "content": f"answer {worker_id} {turn}"}
+        ]
+        session.commit_turn(messages, messages, embeddings=list(rng.standard_normal((2, DIM), dtype=np.float32)))
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    conversations_dir = tempfile.mkdtemp(prefix="conversations_")
+    os.environ["CONVERSATIONS_DIR"] = conversations_dir
+    os.environ["MULTI_WORKER"] = "1"
+    from models.models import ContentFileTemplate, AgentConfig
+    from routers.file_manager import create_conversation, get_conversation_file_path, load_conversation_content, open_embedding_store, get_conversation_index
+
+    conversation_id = create_conversation(ContentFileTemplate(
+        conversation_name="stress",
+        agent_config=AgentConfig(summary_model="llama3.2:1b"),
+        resume_context=""
+    ))
+
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=worker, args=(conversations_dir, conversation_id, i, turns)) for i in range(workers)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+
+    file_path = get_conversation_file_path(conversation_id)
+    with open(file_path, "r", encoding="utf-8") as file:
+        json.load(file)
+    content, _ = load_conversation_content(file_path)
+    full_history = content["full_history"]
+    embeddings = open_embedding_store(file_path, content).read()
+
+    expected = workers * turns * 2
+    written = {message["content"] for message in full_history if message["role"] == "user"}
+    missing = [f"worker {w} turn {t}" for w in range(workers) for t in range(turns) if f"worker {w} turn {t}" not in written]
+    turn_count = get_conversation_index().get(conversation_id)["turn_count"]
+
+    print(f"{workers} workers x {turns} turns in {elapsed:.2f} s ({workers * turns / elapsed:.0f} turns/s)")
+    print(f"messages: {len(full_history)}/{expected}  embeddings: {len(embeddings)}/{expected}  indexed turns: {turn_count}/{workers * turns}  missing turns: {len(missing)}")
+    ok = len(full_history) == expected and len(embeddings) == expected and not missing and turn_count == workers * turns \
+        and all(process.exitcode == 0 for process in processes)
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Recall and memory of the quantized RetrievalEngine (float16, int8) against float32,
+with and without the re-ranking of the candidates with the float32 embeddings.
+Recall is the fraction of the float32 top-k found, context is the fraction of queries for which
+find_relevant_context returns the same text as with float32.
+
+Run from the project root:
+    python -m benchmarks.quantization_benchmark
+"""
+import time
+import numpy as np
+
+from classes.agent_functions import find_relevant_context
+from classes.retrieval_engine import RetrievalEngine
+
+DIM = 768
+TOP_K = 3
+SIZES = [1_000, 10_000, 100_000]
+QUERIES = 50
+TOPICS = 200
+
+
+def embeddings_like(rng, size: int) -> np.ndarray:
+    """
+    Vectors grouped by topic around a common direction, so the similarities are spread like those of text embeddings.
+    """
+    common = rng.standard_normal(DIM)
+    topics = rng.standard_normal((TOPICS, DIM))
+    topic = rng.integers(0, TOPICS, size)
+    return (0.6 * common + topics[topic] + 0.8 * rng.standard_normal((size, DIM))).astype(np.float32)
+
+
+def timed(function, repeat: int) -> float:
+    """
+    Mean milliseconds of function over repeat calls.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'vectors':>8} {'type':>8} {'rerank':>7} {'memory MB':>10} {'ms/query':>9} {'recall@3':>9} {'context':>8}")
+
+    for size in SIZES:
+        stored = embeddings_like(rng, size)
+        history = [{"role": "user", "content": f"message {i}"} for i in range(size)]
+        #Queries close to stored messages, so some pass the similarity threshold of find_relevant_context
+        queries = stored[rng.choice(size, QUERIES, replace=False)] + 0.9 * rng.standard_normal((QUERIES, DIM)).astype(np.float32)
+
+        baseline = RetrievalEngine()
+        baseline.add(stored)
+        expected = [set(baseline.search(query, TOP_K)[0]) for query in queries]
+        expected_context = [find_relevant_context(query, baseline, history) for query in queries]
+
+        for quantization in ["float32", "float16", "int8"]:
+            for rerank in ([False] if quantization == "float32" else [False, True]):
+                engine = RetrievalEngine(quantization=quantization, full_precision=(lambda rows: stored[rows]) if rerank else None)
+                engine.add(stored)
+
+                milliseconds = timed(lambda: [engine.search(query, TOP_K) for query in queries], 1) / QUERIES
+                recall = np.mean([len(expected_set & set(engine.search(query, TOP_K)[0])) / TOP_K for query, expected_set in zip(queries, expected)])
+                context = np.mean([find_relevant_context(query, engine, history) == text for query, text in zip(queries, expected_context)])
+                print(f"{size:>8} {quantization:>8} {str(rerank):>7} {engine.nbytes / 2**20:>10.1f} {milliseconds:>9.3f} {recall:>9.3f} {context:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
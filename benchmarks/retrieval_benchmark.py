@@ -0,0 +1,65 @@
+"""
+Compares the original per-vector cosine similarity loop against RetrievalEngine.
+
+Run from the project root:
+    python -m benchmarks.retrieval_benchmark
+"""
+import time
+import numpy as np
+
+from classes.retrieval_engine import RetrievalEngine
+
+DIM = 768
+TOP_K = 3
+SIZES = [100, 1_000, 10_000, 100_000]
+QUERIES = 20
+BATCH = 64
+
+
+def legacy_top_k(query_embedding, embeddings_vectors, top_k: int = TOP_K):
+    """
+    Scoring done by find_relevant_context before RetrievalEngine.
+    """
+    similarities = [
+        np.dot(query_embedding, vec) / (np.linalg.norm(query_embedding) * np.linalg.norm(vec))
+        for vec in embeddings_vectors
+    ]
+    return np.argsort(similarities)[-top_k:][::-1]
+
+
+def timed(function, repeat: int) -> float:
+    """
+    Mean milliseconds of function over repeat calls.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'vectors':>10} {'legacy ms':>12} {'engine ms':>12} {'batch ms/query':>16} {'speedup':>10} {'same top-k':>11}")
+
+    for size in SIZES:
+        stored = rng.standard_normal((size, DIM))
+        queries = rng.standard_normal((BATCH, DIM))
+
+        engine = RetrievalEngine()
+        for row in stored:
+            engine.add(row)
+
+        legacy_repeat = max(1, min(QUERIES, 200_000 // size))
+        legacy_ms = timed(lambda: legacy_top_k(queries[0], stored), legacy_repeat)
+        engine_ms = timed(lambda: engine.search(queries[0], TOP_K), QUERIES)
+        batch_ms = timed(lambda: engine.search(queries, TOP_K), max(1, QUERIES // 4)) / BATCH
+
+        same = all(
+            list(legacy_top_k(query, stored)) == list(engine.search(query, TOP_K)[0])
+            for query in queries[:5]
+        )
+        print(f"{size:>10} {legacy_ms:>12.3f} {engine_ms:>12.3f} {batch_ms:>16.4f} {legacy_ms / engine_ms:>9.1f}x {str(same):>11}")
+
+
+if __name__ == "__main__":
+    main()
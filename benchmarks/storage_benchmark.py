@@ -0,0 +1,230 @@
+"""
+Microbenchmarks of the storage and retrieval hot paths on synthetic conversations with 768-dim embeddings:
+find_relevant_context, get_conversation_content, add_to_full_history_conversation_file,
+add_embedding_to_conversation_file and read_file_index.
+
+For every operation and conversation size it reports the median wall time, the bytes read and written
+(rchar/wchar of /proc/self/io, Linux only; embeddings read through the memory map are not counted)
+and the peak of Python memory (tracemalloc).
+Results are compared with benchmarks/storage_baseline.json, regressions are flagged.
+
+Run from the project root:
+    python -m benchmarks.storage_benchmark [--sizes 10,1000,10000,50000] [--repeat 5] [--save-baseline] [--check]
+"""
+import os, sys, json, time, shutil, argparse, platform, tempfile, statistics, tracemalloc
+import numpy as np
+
+DIM = 768
+SIZES = [10, 1_000, 10_000, 50_000]
+REPEAT = 5
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "storage_baseline.json")
+
+#get_conversation_content returns every embedding as Python lists, ~3 GB of memory at 50k turns
+MAX_CONTENT_TURNS = 10_000
+
+#A result slower than the baseline by this ratio (and by more than REGRESSION_MIN_MS) is a regression
+REGRESSION_RATIO = 1.25
+REGRESSION_MIN_MS = 0.05
+
+
+def read_io_counters() -> dict | None:
+    """
+    Bytes read and written by this process through system calls, None outside Linux.
+    """
+    try:
+        with open("/proc/self/io", "r") as file:
+            counters = dict(line.split(": ") for line in file.read().splitlines())
+        return {"read": int(counters["rchar"]), "written": int(counters["wchar"])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def measure(operation, repeat: int, setup=None) -> dict:
+    """
+    Median wall time and mean I/O of repeat calls, then the peak memory of one more call under tracemalloc.
+    :param operation: Function to measure
+    :param setup(optional): Function called before every call, not measured
+    """
+    times, reads, writes = [], [], []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        io_before = read_io_counters()
+        start = time.perf_counter()
+        operation()
+        times.append((time.perf_counter() - start) * 1000)
+        io_after = read_io_counters()
+        if io_before and io_after:
+            reads.append(io_after["read"] - io_before["read"])
+            writes.append(io_after["written"] - io_before["written"])
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    operation()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "wall_ms": round(statistics.median(times), 4),
+        "bytes_read": int(statistics.mean(reads)) if reads else None,
+        "bytes_written": int(statistics.mean(writes)) if writes else None,
+        "peak_memory_bytes": peak
+    }
+
+
+def create_synthetic_conversation(turns: int, rng: np.random.Generator) -> str:
+    """
+    Conversation with turns user/assistant pairs and one embedding per message, written through the storage layer.
+    """
+    from models.models import ContentFileTemplate, AgentConfig, Message
+    from routers.file_manager import create_conversation, get_conversation_session, close_conversation_session
+
+    full_history = []
+    for turn in range(turns):
+        full_history.append(Message(role="user", content=f"Question {turn}: how does the storage layer handle turn {turn}?"))
+        full_history.append(Message(role="assistant", content=f"Answer {turn}: " + "the conversation is appended to the journal. " * 4))
+
+    file_id = create_conversation(ContentFileTemplate(
+        conversation_name=f"benchmark {turns}",
+        agent_config=AgentConfig(summary_model="llama3.2:1b"),
+        resume_context="",
+        full_history=full_history
+        ))
+
+    session = get_conversation_session(file_id)
+    for first in range(0, len(full_history), 10_000):
+        rows = rng.standard_normal((min(10_000, len(full_history) - first), DIM), dtype=np.float32)
+        session.add_missing_embeddings(first, rows)
+    close_conversation_session(file_id)
+    return file_id
+
+
+def fill_index(conversations: int):
+    """
+    Add index entries until the conversation index has the given number of conversations.
+    """
+    from routers.file_manager import get_conversation_index
+
+    index = get_conversation_index()
+    existing = len(index.all())
+    with index.lock:
+        index.connection.executemany(
+            "INSERT INTO conversations (id, name, file_path, created, updated) VALUES (?, ?, ?, datetime('now'), datetime('now'))",
+            [(f"benchmark-{i}", f"benchmark {i}", f"benchmark-{i}.json") for i in range(existing, conversations)]
+            )
+        index.connection.commit()
+
+
+def run(sizes: list, repeat: int) -> dict:
+    from classes.agent_functions import find_relevant_context
+    from routers.file_manager import (get_conversation_session, close_conversation_session, get_conversation_content,
+                                      add_to_full_history_conversation_file, add_embedding_to_conversation_file, read_file_index)
+
+    rng = np.random.default_rng(0)
+    results = {}
+    for turns in sizes:
+        file_id = create_synthetic_conversation(turns, rng)
+        query = rng.standard_normal(DIM, dtype=np.float32)
+        message = [{"role": "user", "content": "A new message appended by the benchmark."}]
+        embedding = rng.standard_normal(DIM, dtype=np.float32)
+
+        session = get_conversation_session(file_id)
+        engine, full_history = session.retrieval_engine, session.full_history
+        results[f"find_relevant_context@{turns}"] = measure(lambda: find_relevant_context(query, engine, full_history), repeat)
+
+        if turns <= MAX_CONTENT_TURNS:
+            #Cold: the conversation is loaded from disk every call
+            results[f"get_conversation_content@{turns}"] = measure(
+                lambda: get_conversation_content(file_id), repeat, setup=lambda: close_conversation_session(file_id)
+                )
+
+        get_conversation_session(file_id)
+        results[f"add_to_full_history_conversation_file@{turns}"] = measure(lambda: add_to_full_history_conversation_file(file_id, message), repeat)
+        results[f"add_embedding_to_conversation_file@{turns}"] = measure(lambda: add_embedding_to_conversation_file(file_id, embedding), repeat)
+        close_conversation_session(file_id)
+
+        fill_index(turns)
+        results[f"read_file_index@{turns}"] = measure(read_file_index, repeat)
+
+        for name in [name for name in results if name.endswith(f"@{turns}")]:
+            print_result(name, results[name])
+
+    return results
+
+
+def print_result(name: str, result: dict, baseline: dict = None):
+    line = (f"{name:<50} {result['wall_ms']:>12.3f} ms {format_bytes(result['bytes_read']):>10} read "
+            f"{format_bytes(result['bytes_written']):>10} written {format_bytes(result['peak_memory_bytes']):>10} peak")
+    if baseline:
+        line += f"   {result['wall_ms'] / baseline['wall_ms']:>6.2f}x baseline" if baseline["wall_ms"] else ""
+    print(line, flush=True)
+
+
+def format_bytes(value: int | None) -> str:
+    if value is None:
+        return "n/a"
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(value) < 1024 or unit == "GB":
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+
+
+def compare(results: dict, baseline: dict) -> list:
+    """
+    Names of the results slower than the baseline.
+    """
+    print(f"\nCompared with the baseline of {baseline['created']} ({baseline['machine']}):")
+    regressions = []
+    for name, result in results.items():
+        expected = baseline["results"].get(name)
+        if expected is None:
+            continue
+        print_result(name, result, expected)
+        if result["wall_ms"] > expected["wall_ms"] * REGRESSION_RATIO and result["wall_ms"] - expected["wall_ms"] > REGRESSION_MIN_MS:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Storage and retrieval microbenchmarks")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in SIZES), help="Comma separated numbers of turns")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--save-baseline", action="store_true", help=f"Write the results to {BASELINE_PATH}")
+    parser.add_argument("--check", action="store_true", help="Exit with status 1 if there is a regression")
+    args = parser.parse_args()
+
+    #The conversations and caches of the benchmark live in a temporal directory
+    directory = tempfile.mkdtemp(prefix="storage_benchmark_")
+    os.environ["CONVERSATIONS_DIR"] = directory
+    os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(directory, "embeddings.sqlite")
+    os.environ["CONVERSATION_FLUSH_POLICY"] = "turn"
+
+    try:
+        results = run([int(size) for size in args.sizes.split(",")], args.repeat)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    regressions = []
+    if os.path.exists(BASELINE_PATH) and not args.save_baseline:
+        with open(BASELINE_PATH, "r", encoding="utf-8") as file:
+            regressions = compare(results, json.load(file))
+        print(f"\n{len(regressions)} regressions" + (f": {', '.join(regressions)}" if regressions else ""))
+
+    if args.save_baseline:
+        baseline = {
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "machine": f"{platform.system()} {platform.machine()}, {os.cpu_count()} CPU, Python {platform.python_version()}",
+            "repeat": args.repeat,
+            "results": results
+            }
+        with open(BASELINE_PATH, "w", encoding="utf-8") as file:
+            json.dump(baseline, file, indent=4)
+        print(f"\nBaseline written to {BASELINE_PATH}")
+
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,21 @@
-import time
 import psutil
-import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
 
-def dynamic_wait_time(base_wait_time=90, max_wait_time=3600):
+def get_resource_usage(interval: float = None) -> tuple[float, float]:
     """
-    Calculate dynamic wait time based on system resource usage.
-    
-    Args:
-    base_wait_time (int): Minimum wait time in seconds
-    max_wait_time (int): Maximum wait time in seconds
+    Returns the CPU and memory usage percentages.
+    :param interval(optional): Seconds to measure the CPU, None compares with the previous call without blocking
     """
-    try:
-        # Get CPU usage percentage
-        cpu_usage = psutil.cpu_percent(interval=1)
-        
-        # Get memory usage percentage
-        memory = psutil.virtual_memory()
-        memory_usage = memory.percent
-        
-        # Calculate scaling factor based on resource usage
-        # Higher resource usage leads to longer wait times
-        cpu_factor = 1 + (cpu_usage / 100)
-        memory_factor = 1 + (memory_usage / 100)
-        
-        # Calculate wait time
-        wait_time = base_wait_time * cpu_factor * memory_factor
-        
-        # Ensure wait time is within specified bounds
-        wait_time = max(base_wait_time, min(wait_time, max_wait_time))
-        
-        # Log resource usage and calculated wait time
-        logger.info(f"CPU Usage: {cpu_usage}% | Memory Usage: {memory_usage}% | Wait Time: {(wait_time/60):.2f} minuts")
-        
-        time.sleep(wait_time)
-    
-    except Exception as e:
-        logger.error(f"Error calculating wait time: {e}")
-        return base_wait_time
\ No newline at end of file
+    cpu_usage = psutil.cpu_percent(interval=interval)
+    memory_usage = psutil.virtual_memory().percent
+    return cpu_usage, memory_usage
+
+
+def scale_wait_time(base_wait_time: float, cpu_usage: float, memory_usage: float, max_wait_time: float) -> float:
+    """
+    Scale a wait time with the resource usage, higher usage leads to longer wait times.
+    """
+    cpu_factor = 1 + (cpu_usage / 100)
+    memory_factor = 1 + (memory_usage / 100)
+
+    return max(base_wait_time, min(base_wait_time * cpu_factor * memory_factor, max_wait_time))
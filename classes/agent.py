@@ -1,28 +1,51 @@
+import asyncio, logging, threading, time
 import numpy as np
 from ollama import chat
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
 
-from classes.agent_functions import generate_embedding, find_relevant_context, summarize_history
+from classes.agent_functions import generate_embedding, generate_embedding_async, find_relevant_context, summarize_history_incremental, async_client, check_missing_model, request_scheduler, model_residency
+from classes.context_builder import ContextBuilder
+from classes.metrics import timed_stage, record_stage, ttft_seconds, tokens_per_second
+from classes.request_scheduler import SchedulerOverloaded
 
-from routers.file_manager import update_message_to_conversation_file, add_to_full_history_conversation_file, add_embedding_to_conversation_file, get_embeddings_of_conversation, get_full_history_of_conversation
+from routers.file_manager import ConversationSession, get_conversation_session
+from routers.search import add_messages_to_search_index
+from routers.embeddings_backfill import schedule_conversation_backfill
+
+logger = logging.getLogger(__name__)
+
+#Summaries run after the responses, outside of the request
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+#Prompts within the context window of the models, with a prefix that stays the same between turns
+context_builder = ContextBuilder()
 
 
 class Agent():
-    def __init__(self, file_id: str, model: str, system_prompt:str = "", num_answers: int = 0, options: dict = {}, max_history: int = 10, summary_model: str = "ollama3.2:1b", chat_history: list = []):
+    def __init__(self, file_id: str, model: str, system_prompt:str = "", num_answers: int = 0, options: dict = None, max_history: int = 10, summary_model: str = "ollama3.2:1b", chat_history: list = None, resume_context: str = ""):
         
         self.file_id = file_id
         
         self.model: str = model
         self.system_prompt = system_prompt
         self.num_answers = num_answers
-        self.options = options
+        self.options = options or {}
         self.max_history = max_history
         self.summary_model = summary_model
-        self.chat_history = chat_history
-        if(len(chat_history)): self.chat_history = [{"role":"system", "content": system_prompt}]
+        
+        # A stored messages_history restores the agent as it was, otherwise it starts with the system message
+        self.chat_history = list(chat_history) if chat_history else [{"role":"system", "content": system_prompt}]
         
         self.embeddings_vectors: List[np.ndarray] = []
-        self.resume_context = ""
+        self.resume_context = resume_context or ""
+        
+        #Reloads of the conversation session seen by this agent, a new reload means another worker changed the conversation
+        self.conversation_reloads = 0
+        
+        self.summary_lock = threading.Lock()
+        self.summary_running = False
+        self.pending_summary_messages: list = []
  
     def __str__(self):
         """
@@ -32,44 +55,256 @@ class Agent():
         
          
     def generate_response(self, message):
-        current_embedding = generate_embedding(message)
-        add_embedding_to_conversation_file(self.file_id, current_embedding)
-        embeddings_vectors = get_embeddings_of_conversation(self.file_id)
-        full_history = get_full_history_of_conversation(self.file_id)
-        relevant_context = find_relevant_context(current_embedding, embeddings_vectors, full_history)
-        
-        # Check if history needs to be summarized
-        if len(self.chat_history) >= self.max_history:
-            self.resume_context = summarize_history(self.chat_history, self.summary_model)
+        with timed_stage("load_session"):
+            session = get_conversation_session(self.file_id)
+        
+        with timed_stage("embed_query"):
+            current_embedding = generate_embedding(message)
+        with timed_stage("retrieve"):
+            relevant_context = find_relevant_context(current_embedding, session.retrieval_engine, session.full_history)
+        
+        with timed_stage("build_prompt"):
+            prompt_messages = self._build_prompt(message, relevant_context)
+        
+        total_response = ""
+        
+        queued = time.perf_counter()
+        try:
+            with request_scheduler.slot(self.model):
+                start = time.perf_counter()
+                record_stage("queue", start - queued)
+                first_token = None
+                chunks = 0
+                response = chat(model = self.model, messages= prompt_messages, options= self.options or None, stream=True, keep_alive=model_residency.use(self.model))
+                
+                try:
+                    for word in response:
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                        chunks += 1
+                        total_response += word['message']['content']
+                        if word.get('done'):
+                            context_builder.calibrate(prompt_messages, word.get('prompt_eval_count'), self.model)
+                            self._record_generation(start, first_token, chunks, word)
+                        yield word['message']['content']
+                finally:
+                    #Closing the HTTP stream makes ollama stop generating
+                    response.close()
+        
+        #The client disconnected and the response was closed
+        except GeneratorExit:
+            self._persist_interrupted_turn(session, *self._interrupt_turn(message, total_response))
+            raise
+        except Exception as e:
+            check_missing_model(e)
+            raise
             
-            # Keep only the system message and the last two messages
-            self.chat_history = [
-                self.chat_history[0],
-                {"role": "system", "content": f"Summary of the previous conversation:\n{self.resume_context}"},
-                *self.chat_history[-2:]
-            ]
+        format_user_message = {"role":"user", "content": message}
+        format_assitant_response = {"role":"assistant", "content": total_response}
+                
+        self.chat_history.extend([format_user_message, format_assitant_response])
+        
+        if(self.file_id != ""):
+            with timed_stage("embed_response"):
+                response_embedding = generate_embedding(total_response)
+            with timed_stage("persist"):
+                self._persist_turn(session, format_user_message, format_assitant_response, current_embedding, response_embedding)
             
-        # Prepare the message with context
-        context_message = (
-            f"{message}\n\nRelevant context of the previous conversation:\n{relevant_context}\n"
-            f"Summary of the conversation:\n{self.resume_context}" if self.resume_context else message
-            )
+    
+    async def agenerate_response(self, message):
+        """
+        Async version of generate_response. Ollama calls are awaited and the file work runs in worker threads,
+        so the event loop is never blocked.
+        """
+        with timed_stage("load_session"):
+            session = await asyncio.to_thread(get_conversation_session, self.file_id)
+        
+        with timed_stage("embed_query"):
+            current_embedding = await generate_embedding_async(message)
+        with timed_stage("retrieve"):
+            #The retrieval engine waits for the session lock held by flushes and is built from the embeddings file on first use
+            relevant_context = await asyncio.to_thread(lambda: find_relevant_context(current_embedding, session.retrieval_engine, session.full_history))
         
-        format_user_message = {"role":"user", "content": context_message}
-        self.chat_history.append(format_user_message)
+        with timed_stage("build_prompt"):
+            prompt_messages = self._build_prompt(message, relevant_context)
         
         total_response = ""
         
-        response = chat(model = self.model, messages= self.chat_history, stream=True, keep_alive=60)
+        queued = time.perf_counter()
+        try:
+            async with request_scheduler.aslot(self.model):
+                start = time.perf_counter()
+                record_stage("queue", start - queued)
+                first_token = None
+                chunks = 0
+                response = await async_client.chat(model = self.model, messages= prompt_messages, options= self.options or None, stream=True, keep_alive=model_residency.use(self.model))
+                
+                try:
+                    async for word in response:
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                        chunks += 1
+                        total_response += word['message']['content']
+                        if word.get('done'):
+                            context_builder.calibrate(prompt_messages, word.get('prompt_eval_count'), self.model)
+                            self._record_generation(start, first_token, chunks, word)
+                        yield word['message']['content']
+                finally:
+                    #Closing the HTTP stream makes ollama stop generating
+                    await response.aclose()
         
-        for word in response:
-            total_response += word['message']['content']
-            yield word['message']['content']
+        #The client disconnected: the response was closed, or cancelled while waiting for ollama
+        except (GeneratorExit, asyncio.CancelledError):
+            #Awaiting is not possible in a cancelled task, the turn is written in a worker thread
+            turn = self._interrupt_turn(message, total_response)
+            asyncio.get_running_loop().run_in_executor(None, self._persist_interrupted_turn, session, *turn)
+            raise
+        except Exception as e:
+            check_missing_model(e)
+            raise
             
+        format_user_message = {"role":"user", "content": message}
         format_assitant_response = {"role":"assistant", "content": total_response}
                 
-        self.chat_history.append(format_assitant_response)
+        self.chat_history.extend([format_user_message, format_assitant_response])
         
         if(self.file_id != ""):
-            add_to_full_history_conversation_file(self.file_id, [format_user_message, format_assitant_response])
-            update_message_to_conversation_file(self.file_id, self.chat_history) 
\ No newline at end of file
+            with timed_stage("embed_response"):
+                response_embedding = await generate_embedding_async(total_response)
+            with timed_stage("persist"):
+                await asyncio.to_thread(self._persist_turn, session, format_user_message, format_assitant_response, current_embedding, response_embedding)
+    
+    
+    def _record_generation(self, start: float, first_token: float, chunks: int, final_chunk):
+        """
+        Record the time to first token and the tokens per second of a response when its last chunk arrives.
+        The speed comes from eval_count/eval_duration of the last chunk, or from the chunks received without them.
+        :param start: perf_counter before the chat request
+        :param first_token: perf_counter when the first chunk arrived
+        :param chunks: Chunks received
+        :param final_chunk: Last chunk of the response (done)
+        """
+        end = time.perf_counter()
+        record_stage("ttft", first_token - start)
+        record_stage("generation", end - first_token)
+        ttft_seconds.observe(first_token - start, model=self.model)
+        
+        eval_count, eval_duration = final_chunk.get('eval_count'), final_chunk.get('eval_duration')
+        if eval_count and eval_duration:
+            tokens_per_second.observe(eval_count / (eval_duration / 1e9), model=self.model)
+        elif end > first_token:
+            tokens_per_second.observe(chunks / (end - first_token), model=self.model)
+    
+    
+    def _interrupt_turn(self, message: str, partial_response: str) -> tuple[dict, dict]:
+        """
+        Add to the history the turn of a response cut by a client disconnect, with the text generated until then.
+        :return (user message, assistant message) for _persist_interrupted_turn
+        """
+        logger.info(f"Client disconnected from {self.file_id}, response interrupted after {len(partial_response)} characters")
+        
+        format_user_message = {"role":"user", "content": message}
+        format_assitant_response = {"role":"assistant", "content": partial_response}
+        
+        self.chat_history.extend([format_user_message, format_assitant_response])
+        return format_user_message, format_assitant_response
+    
+    
+    def _persist_interrupted_turn(self, session: ConversationSession, user_message: dict, assistant_message: dict):
+        """
+        Store an interrupted turn. The assistant message is marked with interrupted: true in the full history
+        and both messages are embedded by the backfill.
+        """
+        if(self.file_id == ""):
+            return
+        
+        try:
+            session.commit_turn([user_message, {**assistant_message, "interrupted": True}], self.chat_history)
+            self.conversation_reloads = session.reloads
+            schedule_conversation_backfill(self.file_id)
+        except Exception as e:
+            logger.error(f"Error saving the interrupted turn of {self.file_id}: {e}")
+    
+    
+    def _evict_messages(self, count: int):
+        """
+        Remove the oldest count messages after the system message from the history, they are folded
+        into resume_context in the background. Until that summary finishes the next turns use the previous one.
+        """
+        if count <= 0:
+            return
+        
+        evicted = self.chat_history[1:1 + count]
+        self.chat_history = [self.chat_history[0], *self.chat_history[1 + count:]]
+        
+        with self.summary_lock:
+            self.pending_summary_messages.extend(evicted)
+            if self.summary_running:
+                return
+            self.summary_running = True
+            
+        summary_executor.submit(self._summarize_pending_messages)
+        
+        
+    def _summarize_pending_messages(self):
+        """
+        Fold the evicted messages into resume_context until there are no more pending.
+        """
+        while True:
+            with self.summary_lock:
+                messages = self.pending_summary_messages
+                self.pending_summary_messages = []
+                if not messages:
+                    self.summary_running = False
+                    return
+            
+            try:
+                with timed_stage("summarize"):
+                    self.resume_context = summarize_history_incremental(self.resume_context, messages, self.summary_model)
+                
+                if(self.file_id != ""):
+                    get_conversation_session(self.file_id).update_resume_context(self.resume_context)
+            
+            #Shed by the request scheduler: the messages are summarized once it admits summaries again
+            except SchedulerOverloaded as e:
+                with self.summary_lock:
+                    self.pending_summary_messages = messages + self.pending_summary_messages
+                time.sleep(e.retry_after)
+                    
+            except Exception as e:
+                logger.error(f"Error summarizing the history of {self.file_id}: {e}")
+        
+        
+    def _build_prompt(self, message: str, relevant_context: str) -> list:
+        """
+        Messages sent to the model for a new user message. The history goes first as it was sent last turn,
+        the summary and the relevant context are appended to the new message only, and the oldest messages
+        are evicted when the prompt doesn't fit the num_ctx of the options.
+        """
+        self._evict_messages(context_builder.trim_history(self.chat_history, message, self.options, self.model))
+        
+        return context_builder.build(self.chat_history, message, relevant_context, self.resume_context, self.options, self.model)
+    
+    
+    def _persist_turn(self, session: ConversationSession, user_message: dict, assistant_message: dict, user_embedding: np.ndarray, assistant_embedding: np.ndarray):
+        """
+        Store the turn in the conversation file and in the search index.
+        """
+        # One embedding per message of the full history, in the same order
+        first_position, embedded = session.commit_turn(
+            [user_message, assistant_message], 
+            self.chat_history, 
+            embeddings=[user_embedding, assistant_embedding]
+            )
+        self.conversation_reloads = session.reloads
+        
+        #Messages of a history still without embeddings are embedded and indexed by the backfill
+        if not embedded:
+            schedule_conversation_backfill(self.file_id)
+            return
+        
+        add_messages_to_search_index(
+            self.file_id, first_position, 
+            np.vstack([user_embedding, assistant_embedding]), 
+            [user_message, assistant_message]
+            )
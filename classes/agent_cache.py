@@ -0,0 +1,134 @@
+import sys, time, threading
+from collections import OrderedDict
+from typing import Callable
+
+
+class AgentCache():
+    """
+    LRU cache of agents bounded by number of entries, estimated memory and idle time.
+    Evicted agents are passed to on_evict and are rebuilt from their conversation file on the next request.
+    """
+    def __init__(self, max_entries: int = 256, max_bytes: int = 256 * 1024 * 1024, idle_ttl: float = 1800, on_evict: Callable = None, size_of: Callable = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.on_evict = on_evict
+        self.size_of = size_of or estimate_agent_size
+
+        self.lock = threading.RLock()
+        self.entries: OrderedDict[str, list] = OrderedDict()  # key: [agent, size, last_access]
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions_entries": 0, "evictions_memory": 0, "evictions_idle": 0}
+
+    def __contains__(self, key: str):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: str):
+        """
+        Returns the cached agent or None if it is not cached or it has been idle longer than idle_ttl.
+        """
+        with self.lock:
+            evicted = self._evict_idle()
+
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+            else:
+                entry[2] = time.monotonic()
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+
+        self._notify(evicted)
+        return entry[0] if entry is not None else None
+
+    def put(self, key: str, agent):
+        """
+        Add an agent and evict the least recently used ones until the cache is within its bounds.
+        """
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+
+            size = self.size_of(agent)
+            self.entries[key] = [agent, size, time.monotonic()]
+            self.total_bytes += size
+
+            evicted += self._evict_idle()
+            while len(self.entries) > 1 and len(self.entries) > self.max_entries:
+                evicted.append(self._pop_oldest("evictions_entries"))
+            while len(self.entries) > 1 and self.total_bytes > self.max_bytes:
+                evicted.append(self._pop_oldest("evictions_memory"))
+
+        self._notify(evicted)
+
+    def update_size(self, key: str):
+        """
+        Estimate again the memory of an agent after its history changed.
+        """
+        evicted = []
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+
+            size = self.size_of(entry[0])
+            self.total_bytes += size - entry[1]
+            entry[1] = size
+
+            while len(self.entries) > 1 and self.total_bytes > self.max_bytes:
+                evicted.append(self._pop_oldest("evictions_memory"))
+
+        self._notify(evicted)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the size of the cache and its hit, miss and eviction counters.
+        """
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "idle_ttl": self.idle_ttl
+            }
+
+    def _evict_idle(self) -> list:
+        evicted = []
+        now = time.monotonic()
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if now - entry[2] < self.idle_ttl:
+                break
+            evicted.append(self._pop_oldest("evictions_idle"))
+        return evicted
+
+    def _pop_oldest(self, reason: str) -> tuple:
+        key, (agent, size, _) = self.entries.popitem(last=False)
+        self.total_bytes -= size
+        self.stats[reason] += 1
+        return key, agent
+
+    def _notify(self, evicted: list):
+        if self.on_evict is None:
+            return
+        for key, agent in evicted:
+            self.on_evict(key, agent)
+
+
+def estimate_agent_size(agent) -> int:
+    """
+    Approximate memory of an agent: its object plus the text of its history and summary.
+    """
+    size = sys.getsizeof(agent) + sys.getsizeof(agent.chat_history) + sys.getsizeof(agent.resume_context)
+    for message in agent.chat_history:
+        size += sys.getsizeof(message) + sum(sys.getsizeof(value) for value in message.values())
+    return size
@@ -1,26 +1,197 @@
+import os, asyncio
 import numpy as np
-from ollama import embeddings, chat
+from ollama import embed, chat, generate, ps, list as ollamaList, AsyncClient, ResponseError
+
+from classes.embedding_cache import EmbeddingCache
+from classes.model_inventory import ModelInventory, is_model_not_found
+from classes.model_residency import ModelResidency, model_name
+from classes.request_scheduler import RequestScheduler, PRIORITY_CHAT, PRIORITY_SUMMARY, PRIORITY_BACKFILL, parse_model_limits
+from classes.retrieval_engine import RetrievalEngine
+
+EMBEDDING_MODEL = 'nomic-embed-text:latest'
+
+embedding_cache = EmbeddingCache(
+    os.getenv("EMBEDDING_CACHE_PATH", os.path.join(os.path.dirname(__file__), "..", "cache", "embeddings.sqlite")),
+    memory_entries=int(os.getenv("EMBEDDING_CACHE_MEMORY_ENTRIES", "2048")),
+    disk_entries=int(os.getenv("EMBEDDING_CACHE_DISK_ENTRIES", "100000"))
+    )
+
+#Admission control of every ollama call: concurrent requests per model, a bounded priority queue and load shedding
+request_scheduler = RequestScheduler(
+    default_limit=int(os.getenv("SCHEDULER_MODEL_CONCURRENCY", "2")),
+    model_limits=parse_model_limits(os.getenv("SCHEDULER_MODEL_LIMITS", "")),
+    max_queue=int(os.getenv("SCHEDULER_MAX_QUEUE", "64")),
+    max_wait=float(os.getenv("SCHEDULER_MAX_WAIT_SECONDS", "120")),
+    max_cpu_percent=float(os.getenv("SCHEDULER_MAX_CPU_PERCENT", "95")),
+    max_memory_percent=float(os.getenv("SCHEDULER_MAX_MEMORY_PERCENT", "95"))
+    )
+
+#Client for the async pipeline, it doesn't block the event loop while ollama answers
+async_client = AsyncClient()
+
+
+def list_installed_models() -> list[dict]:
+    """
+    Ask ollama for the installed models with format {model, size, family, parameter_size, quantization_level, modified_at}
+    """
+    models = []
+    for element in ollamaList().models:
+        details = element.details
+        models.append({
+            "model": element.model,
+            "size": element.size,
+            "family": details.family if details else None,
+            "parameter_size": details.parameter_size if details else None,
+            "quantization_level": details.quantization_level if details else None,
+            "modified_at": element.modified_at.isoformat() if element.modified_at else None
+        })
+    return models
+
+
+model_inventory = ModelInventory(
+    list_installed_models,
+    ttl=float(os.getenv("MODEL_INVENTORY_TTL_SECONDS", "60")),
+    max_stale=float(os.getenv("MODEL_INVENTORY_MAX_STALE_SECONDS", "3600"))
+    )
+
+
+def check_missing_model(error: Exception):
+    """
+    Invalidate the model inventory when an ollama call failed because the model is not installed anymore.
+    """
+    if is_model_not_found(error):
+        model_inventory.invalidate()
+
+
+#MODEL RESIDENCY
+def set_model_keep_alive(model: str, keep_alive: float):
+    """
+    Load a model or change how long ollama keeps it loaded, 0 unloads it. Nothing is generated.
+    Embedding models can't generate, they are loaded with a short embed request.
+    """
+    if model_name(model) != model_name(EMBEDDING_MODEL):
+        try:
+            generate(model=model, keep_alive=keep_alive)
+            return
+        except ResponseError as e:
+            if "does not support generate" not in str(e):
+                raise
+    embed(model=model, input="warm-up", keep_alive=keep_alive)
+
+
+def load_model(model: str, keep_alive: float):
+    with request_scheduler.slot(model, PRIORITY_BACKFILL):
+        set_model_keep_alive(model, keep_alive)
+
+
+def get_model_size(model: str) -> int | None:
+    """
+    Size of an installed model from the model inventory.
+    """
+    sizes = {model_name(element["model"]): element["size"] for element in model_inventory.get()}
+    return sizes.get(model_name(model))
+
+
+#Keeps the embedding, chat and summary models loaded while they are used, within a memory budget
+model_residency = ModelResidency(
+    load=load_model,
+    unload=lambda model: set_model_keep_alive(model, 0),
+    list_loaded=lambda: {element.model: element.size for element in ps().models},
+    model_size=get_model_size,
+    pinned=[EMBEDDING_MODEL, *[model.strip() for model in os.getenv("MODEL_WARMUP", "").split(",") if model.strip()]],
+    memory_budget=int(os.getenv("MODEL_MEMORY_BUDGET_MB", "0")) * 1024 * 1024,
+    keep_alive=float(os.getenv("MODEL_KEEP_ALIVE_SECONDS", "1800")),
+    idle_keep_alive=float(os.getenv("MODEL_IDLE_KEEP_ALIVE_SECONDS", "60")),
+    idle_seconds=float(os.getenv("MODEL_IDLE_SECONDS", "900")),
+    interval=float(os.getenv("MODEL_RESIDENCY_INTERVAL_SECONDS", "60")),
+    #MODEL_RESIDENCY=0 leaves loading and unloading the models to ollama
+    enabled=os.getenv("MODEL_RESIDENCY", "1") != "0"
+    )
 
 #EMBEDDINGS
-def generate_embedding(text: str) -> np.ndarray:
+#Texts sent to ollama in a single embed call
+embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+
+
+def generate_embeddings(texts: list[str], priority: int = PRIORITY_CHAT) -> np.ndarray:
+    """
+    Use the nomic-embed-text model to create the embeds of several texts.
+    Texts already embedded are taken from the embedding cache, the rest are sent in batches of embedding_batch_size.
+    :param texts: Textos to embed
+    :param priority(optional): Priority of the requests in the request scheduler
+    :return embeddings in format np.array with shape (len(texts), dim)
+    """
+    cached = [embedding_cache.get(EMBEDDING_MODEL, text) for text in texts]
+    missing = [i for i, embedding in enumerate(cached) if embedding is None]
+    
+    for first in range(0, len(missing), embedding_batch_size):
+        batch = missing[first:first + embedding_batch_size]
+        try:
+            with request_scheduler.slot(EMBEDDING_MODEL, priority):
+                response = embed(model=EMBEDDING_MODEL, input=[texts[i] for i in batch], keep_alive=model_residency.use(EMBEDDING_MODEL))
+        except Exception as e:
+            check_missing_model(e)
+            raise
+        
+        for i, embedding in zip(batch, response["embeddings"]):
+            cached[i] = np.array(embedding, dtype=np.float32)
+            embedding_cache.put(EMBEDDING_MODEL, texts[i], cached[i])
+    
+    return np.vstack(cached) if cached else np.empty((0, 0), dtype=np.float32)
+
+
+async def generate_embeddings_async(texts: list[str], priority: int = PRIORITY_CHAT) -> np.ndarray:
+    """
+    Async version of generate_embeddings.
+    :param texts: Textos to embed
+    :param priority(optional): Priority of the requests in the request scheduler
+    :return embeddings in format np.array with shape (len(texts), dim)
+    """
+    cached = await asyncio.to_thread(lambda: [embedding_cache.get(EMBEDDING_MODEL, text) for text in texts])
+    missing = [i for i, embedding in enumerate(cached) if embedding is None]
+    
+    for first in range(0, len(missing), embedding_batch_size):
+        batch = missing[first:first + embedding_batch_size]
+        try:
+            async with request_scheduler.aslot(EMBEDDING_MODEL, priority):
+                response = await async_client.embed(model=EMBEDDING_MODEL, input=[texts[i] for i in batch], keep_alive=model_residency.use(EMBEDDING_MODEL))
+        except Exception as e:
+            check_missing_model(e)
+            raise
+        
+        for i, embedding in zip(batch, response["embeddings"]):
+            cached[i] = np.array(embedding, dtype=np.float32)
+        await asyncio.to_thread(lambda: [embedding_cache.put(EMBEDDING_MODEL, texts[i], cached[i]) for i in batch])
+    
+    return np.vstack(cached) if cached else np.empty((0, 0), dtype=np.float32)
+
+
+def generate_embedding(text: str, priority: int = PRIORITY_CHAT) -> np.ndarray:
     """
     Use the nomic-embed-text model to create an embed.
     :param text: Texto to embed
+    :param priority(optional): Priority of the request in the request scheduler
     :return embedding in format np.array
     """
-    
-    """ response = embed(model='nomic-embed-text:latest', input=text)
-    return np.array(response.embeddings[0]) """
+    return generate_embeddings([text], priority)[0]
 
-    response = embeddings(model='nomic-embed-text:latest', prompt=text)
-    return np.array(response["embedding"])
+
+async def generate_embedding_async(text: str, priority: int = PRIORITY_CHAT) -> np.ndarray:
+    """
+    Async version of generate_embedding.
+    :param text: Texto to embed
+    :param priority(optional): Priority of the request in the request scheduler
+    :return embedding in format np.array
+    """
+    return (await generate_embeddings_async([text], priority))[0]
 
 
 def find_relevant_context(query_embedding, embeddings_vectors, embeddings_history, top_k: int = 3) -> str:
     """
     Find the most relevant messages in history using cosine similarity.
+    The stored embedding at position i belongs to the message at position i of the history.
     :param query_embedding: Message converted to embed.
-    :param embeddings_vectors: List of all stored embeds.
+    :param embeddings_vectors: RetrievalEngine or list of all stored embeds.
     :param embeddings_history: Full conversation history in text format with list.
     :param top_k(optional)
     
@@ -29,53 +200,57 @@ def find_relevant_context(query_embedding, embeddings_vectors, embeddings_histor
     if not embeddings_history:
         return ""
     
-    # Calculate cosine similarities
-    similarities = [
-        np.dot(query_embedding, vec) / (np.linalg.norm(query_embedding) * np.linalg.norm(vec))
-        for vec in embeddings_vectors
-    ]
+    engine = embeddings_vectors
+    if not isinstance(engine, RetrievalEngine):
+        engine = RetrievalEngine()
+        engine.add(np.asarray(embeddings_vectors, dtype=np.float32))
     
-    # Get the indexes of the top_k most similar
-    top_indices = np.argsort(similarities)[-top_k:][::-1]
+    # Get the indexes of the top_k most similar, only vectors with a message in the history
+    top_indices, similarities = engine.search(query_embedding, top_k, limit=len(embeddings_history))
     
     # Building the relevant context
     relevant_messages = [
         embeddings_history[i]['content']
-        for i in top_indices
-        if similarities[i] > 0.7  # Threshold of similarity
+        for i, similarity in zip(top_indices, similarities)
+        if similarity > 0.7  # Threshold of similarity
     ]
     
     return "\n".join(relevant_messages)
 
 
 #MODELS
-def summarize_history(messages_history, summary_model) -> str:
+def summarize_history_incremental(previous_summary: str, new_messages: list, summary_model: str) -> str:
     """
-    Generate a summary of the conversation history using the summary model.
+    Fold new messages into an existing summary without summarizing the whole history again.
+    :param previous_summary: Last summary, can be empty
+    :param new_messages: Messages not included in the previous summary
+    :param summary_model
     """
-    if len(messages_history) <= 2:  # Only the system message and one more
-        return ""
-        
-    # Set the context for the summary
-    conversation = "\n".join([
-        f"{msg['role']}: {msg['content']}"
-        for msg in messages_history[1:]  # Exclude system message
-        ])
+    if not new_messages:
+        return previous_summary
+    
+    conversation = "\n".join([f"{msg['role']}: {msg['content']}" for msg in new_messages])
     
     prompt_system = {
         "role": "system",
-        "content": f"Summarize the following conversation keeping the most important points and who said them."
+        "content": "Update the summary of a conversation with the new messages, keeping the most important points and who said them. Answer only with the updated summary."
         }
-        
+    
     summary_prompt = {
         "role": "user",
-        "content": conversation
+        "content": f"Previous summary:\n{previous_summary or '(empty)'}\n\nNew messages:\n{conversation}"
         }
     
-    # Generate the summary
-    summary_response = chat(
-        model= summary_model,
-        messages=[prompt_system, summary_prompt]
-    )
+    try:
+        with request_scheduler.slot(summary_model, PRIORITY_SUMMARY):
+            summary_response = chat(
+                model= summary_model,
+                keep_alive=model_residency.use(summary_model),
+                messages=[prompt_system, summary_prompt]
+            )
+    except Exception as e:
+        check_missing_model(e)
+        raise
     
-    return summary_response['message']['content']
\ No newline at end of file
+    return summary_response['message']['content']
+
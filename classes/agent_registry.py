@@ -0,0 +1,111 @@
+import os, json, threading
+
+from classes.file_lock import FileLock, write_file_atomically
+
+SUMMARY_FIELDS = ["id", "name", "resume", "model"]
+
+
+class AgentRegistry():
+    """
+    Agents of a JSON file kept in memory by id.
+    Reads are served from memory, the file is read again only when its mtime or size changed
+    (edited by hand or by another worker) and changes are written back atomically.
+    Agents without id keep their place in the file but can't be looked up.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.file_lock = FileLock(f"{path}.lock")
+        self.agents: dict = {}
+        self.summaries: list[dict] = []
+        self.stamp = None
+        self.stats = {"reloads": 0, "writes": 0}
+
+    def list(self) -> list[dict]:
+        """
+        Returns every agent with format {id, name, resume, model}
+        """
+        with self.lock:
+            self._reload_if_changed()
+            return self.summaries
+
+    def get(self, agent_id: str) -> dict | None:
+        with self.lock:
+            self._reload_if_changed()
+            agent = self.agents.get(agent_id)
+            return dict(agent) if agent is not None else None
+
+    def add(self, agent: dict):
+        """
+        Add an agent, it must have an id.
+        """
+        with self.lock, self.file_lock:
+            self._reload_if_changed()
+            self.agents[agent["id"]] = dict(agent)
+            self._write()
+
+    def update(self, agent_id: str, changes: dict) -> bool:
+        """
+        Change the fields of an agent.
+        :param changes: Fields to change, None values are ignored
+        :return False if nothing changed
+        """
+        with self.lock, self.file_lock:
+            self._reload_if_changed()
+            if agent_id not in self.agents:
+                raise KeyError(agent_id)
+
+            local_agent = self.agents[agent_id]
+            updated_agent = {**local_agent, **{key: value for key, value in changes.items() if value is not None}}
+            if updated_agent == local_agent:
+                return False
+
+            self.agents[agent_id] = updated_agent
+            self._write()
+            return True
+
+    def delete(self, agent_id: str):
+        with self.lock, self.file_lock:
+            self._reload_if_changed()
+            if agent_id not in self.agents:
+                raise KeyError(agent_id)
+
+            del self.agents[agent_id]
+            self._write()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {**self.stats, "agents": len(self.agents)}
+
+    def _file_stamp(self) -> tuple:
+        stat = os.stat(self.path)
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _reload_if_changed(self):
+        """
+        Raises FileNotFoundError if the file doesn't exist and json.JSONDecodeError if it is corrupted.
+        """
+        stamp = self._file_stamp()
+        if stamp == self.stamp:
+            return
+
+        with open(self.path, "r", encoding="utf-8") as file:
+            agents = json.load(file)
+
+        self.agents = {agent.get("id") or ("no id", i): agent for i, agent in enumerate(agents)}
+        self._update_summaries()
+        self.stamp = stamp
+        self.stats["reloads"] += 1
+
+    def _write(self):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(self.path)
+
+        data = json.dumps(list(self.agents.values()), indent=4, ensure_ascii=False)
+        write_file_atomically(self.path, data.encode("utf-8"))
+        self._update_summaries()
+        self.stamp = self._file_stamp()
+        self.stats["writes"] += 1
+
+    def _update_summaries(self):
+        self.summaries = [{field: agent.get(field) for field in SUMMARY_FIELDS} for agent in self.agents.values()]
@@ -0,0 +1,124 @@
+import numpy as np
+
+from classes.retrieval_engine import RetrievalEngine, normalize_rows
+
+
+class IVFIndex():
+    """
+    Approximate nearest neighbour index with an inverted file (IVF) layout.
+    Vectors are normalized and clustered around centroids found with k-means, a search only scores
+    the vectors of the n_probe lists whose centroids are closest to the query.
+    Until there are min_train_size vectors every search is exact.
+    Adding vectors never trains: they go to the list of their closest centroid and needs_training tells when
+    the index has grown retrain_growth times since the last training, so the owner can train it apart.
+    The vectors can be kept quantized, see RetrievalEngine.
+    """
+    def __init__(self, dim: int = 0, min_train_size: int = 1024, n_probe: int = 8, retrain_growth: float = 4.0,
+                 quantization: str = "float32", full_precision=None, rerank_factor: int = 4):
+        self.engine = RetrievalEngine(dim=dim, quantization=quantization, full_precision=full_precision, rerank_factor=rerank_factor)
+        self.min_train_size = min_train_size
+        self.n_probe = n_probe
+        self.retrain_growth = retrain_growth
+
+        self.centroids: np.ndarray = None
+        self.lists: list[list[int]] = []
+        self.trained_size = 0
+
+    def __len__(self):
+        return len(self.engine)
+
+    @property
+    def dim(self) -> int:
+        return self.engine.dim
+
+    def add(self, vectors: np.ndarray) -> range:
+        """
+        Add vectors with shape (dim,) or (n, dim).
+        :return row ids of the added vectors
+        """
+        first_row = len(self.engine)
+        self.engine.add(vectors)
+        rows = range(first_row, len(self.engine))
+
+        if self.centroids is not None:
+            self._assign(rows)
+
+        return rows
+
+    @property
+    def needs_training(self) -> bool:
+        """
+        True when there are min_train_size vectors and no centroids, or retrain_growth times the vectors of the last training.
+        """
+        if self.centroids is None:
+            return len(self.engine) >= self.min_train_size
+        return len(self.engine) >= self.trained_size * self.retrain_growth
+
+    def compute_centroids(self, iterations: int = 10, sample_size: int = 20_000, seed: int = 0) -> np.ndarray | None:
+        """
+        Centroids of a sample of the stored vectors found with k-means. The index is not changed,
+        so it can run while vectors are added and be applied later with train(centroids).
+        """
+        count = len(self.engine)
+        if count == 0:
+            return None
+
+        n_lists = int(np.clip(np.sqrt(count), 1, 1024))
+        rng = np.random.default_rng(seed)
+        sample = self.engine.rows(rng.choice(count, min(sample_size, count), replace=False))
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=n_lists) == 0
+            sums[empty] = centroids[empty]
+            centroids = normalize_rows(sums)
+        return centroids
+
+    def train(self, centroids: np.ndarray = None, iterations: int = 10, sample_size: int = 20_000, seed: int = 0):
+        """
+        Cluster the stored vectors and rebuild the inverted lists.
+        :param centroids(optional): Use these centroids instead of running k-means
+        """
+        count = len(self.engine)
+        if count == 0:
+            return
+
+        if centroids is None:
+            centroids = self.compute_centroids(iterations, sample_size, seed)
+
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.lists = [[] for _ in range(len(self.centroids))]
+        self.trained_size = count
+        self._assign(range(count))
+
+    def search(self, query: np.ndarray, top_k: int = 5, n_probe: int = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the stored vectors most similar to a query.
+        :return (row ids, scores) ordered from most to least similar
+        """
+        if self.centroids is None:
+            return self.engine.search(query, top_k)
+
+        normalized_query = normalize_rows(query)[0]
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        closest_lists = np.argpartition(-(self.centroids @ normalized_query), n_probe - 1)[:n_probe]
+
+        candidates = np.fromiter(
+            (row for list_id in closest_lists for row in self.lists[list_id]),
+            dtype=np.int64
+        )
+        if len(candidates) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        scores = self.engine.rows(candidates) @ normalized_query
+        return self.engine.rerank(normalized_query, candidates, scores, top_k)
+
+    def _assign(self, rows: range, block_rows: int = 65536):
+        for start in range(rows.start, rows.stop, block_rows):
+            stop = min(rows.stop, start + block_rows)
+            assignment = np.argmax(self.engine.rows(slice(start, stop)) @ self.centroids.T, axis=1)
+            for row, list_id in zip(range(start, stop), assignment):
+                self.lists[list_id].append(row)
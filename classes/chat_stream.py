@@ -0,0 +1,66 @@
+import json, time, asyncio
+from fastapi.responses import StreamingResponse
+
+
+class ChatStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that closes its generator as soon as the response ends, also when the client disconnects.
+    Closing the generator of a chat stops the ollama stream, releases its request scheduler slot
+    and keeps the partial turn; StreamingResponse alone leaves it suspended until it is garbage collected.
+    """
+    def __init__(self, content, *args, **kwargs):
+        super().__init__(content, *args, **kwargs)
+        self.content = content
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if hasattr(self.content, "aclose"):
+                await self.content.aclose()
+            elif hasattr(self.content, "close"):
+                await asyncio.to_thread(self.content.close)
+
+
+def sse_frame(data: dict, event: str = None) -> str:
+    return (f"event: {event}\n" if event else "") + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def sse_batches(chunks, interval: float = 0.05, max_chars: int = 512):
+    """
+    Server-sent events with the chunks of a response joined in batches: a frame is sent for the first chunk and then
+    every interval seconds or max_chars characters, instead of one frame per token. A done event ends the stream.
+    :param chunks: Generator of text chunks, closed when this generator is closed
+    """
+    try:
+        batch, sent_at = "", None
+        for chunk in chunks:
+            batch += chunk
+            now = time.monotonic()
+            if sent_at is None or now - sent_at >= interval or len(batch) >= max_chars:
+                yield sse_frame({"content": batch})
+                batch, sent_at = "", now
+        if batch:
+            yield sse_frame({"content": batch})
+        yield sse_frame({}, event="done")
+    finally:
+        chunks.close()
+
+
+async def asse_batches(chunks, interval: float = 0.05, max_chars: int = 512):
+    """
+    Async version of sse_batches.
+    """
+    try:
+        batch, sent_at = "", None
+        async for chunk in chunks:
+            batch += chunk
+            now = time.monotonic()
+            if sent_at is None or now - sent_at >= interval or len(batch) >= max_chars:
+                yield sse_frame({"content": batch})
+                batch, sent_at = "", now
+        if batch:
+            yield sse_frame({"content": batch})
+        yield sse_frame({}, event="done")
+    finally:
+        await chunks.aclose()
@@ -0,0 +1,130 @@
+import os, threading
+
+#Context window used when the agent options don't set num_ctx (ollama default)
+DEFAULT_NUM_CTX = int(os.getenv("DEFAULT_NUM_CTX", "2048"))
+
+#Tokens kept free for the answer when the options don't set num_predict
+DEFAULT_RESPONSE_TOKENS = int(os.getenv("CONTEXT_RESPONSE_TOKENS", "512"))
+
+#Tokens per message added by the chat template (role markers)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class ContextBuilder():
+    """
+    Builds the messages sent to the model within the token budget of its context window (options.num_ctx).
+    The prompt is laid out so ollama can reuse the KV cache of the previous turn:
+    - The system message and the earlier turns are sent byte-identical every turn.
+    - The volatile content (retrieved context and summary) goes only in the last user message.
+    - When the history doesn't fit, the oldest messages are dropped until it uses at most trim_ratio
+      of the budget, so the prefix changes once in a while instead of every turn.
+    Tokens are estimated from characters. Every model has its own tokenizer, so the ratio is calibrated per model
+    with the prompt_eval_count returned by ollama, starting from chars_per_token.
+    """
+    def __init__(self, chars_per_token: float = 4.0, trim_ratio: float = 0.5):
+        self.chars_per_token = chars_per_token
+        self.trim_ratio = trim_ratio
+        self.lock = threading.Lock()
+        self.model_chars_per_token: dict[str, float] = {}
+        self.stats = {"prompts": 0, "trims": 0, "context_truncations": 0, "calibrations": 0}
+
+    def ratio(self, model: str = None) -> float:
+        """
+        Characters per token of a model, chars_per_token until it is calibrated.
+        """
+        return self.model_chars_per_token.get(model, self.chars_per_token)
+
+    def count_tokens(self, text: str, model: str = None) -> int:
+        #Agents without system_prompt keep a system message with None content
+        return int(len(text or "") / self.ratio(model)) + 1
+
+    def count_message_tokens(self, messages: list, model: str = None) -> int:
+        return sum(self.count_tokens(message["content"], model) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+    def budget(self, options: dict = None) -> int:
+        """
+        Tokens available for the prompt: num_ctx minus the tokens reserved for the answer.
+        """
+        options = options or {}
+        num_ctx = int(options.get("num_ctx") or DEFAULT_NUM_CTX)
+        num_predict = options.get("num_predict")
+        response_tokens = int(num_predict) if num_predict and int(num_predict) > 0 else DEFAULT_RESPONSE_TOKENS
+        return max(num_ctx - min(response_tokens, num_ctx // 2), num_ctx // 2)
+
+    def trim_history(self, chat_history: list, message: str, options: dict = None, model: str = None) -> int:
+        """
+        Number of messages to drop after the system message so the history and the new message fit the budget.
+        Nothing is dropped while they fit; otherwise the history is brought down to trim_ratio of the budget.
+        Whole turns are dropped: the history left starts with a user message.
+        :param chat_history: System message followed by the turns
+        :param message: New user message
+        :param model(optional): Model the prompt is for
+        """
+        budget = self.budget(options)
+        message_tokens = self.count_tokens(message, model) + MESSAGE_OVERHEAD_TOKENS
+        if self.count_message_tokens(chat_history, model) + message_tokens <= budget:
+            return 0
+
+        target = budget * self.trim_ratio
+        tokens = self.count_message_tokens(chat_history, model) + message_tokens
+        dropped = 0
+        for old_message in chat_history[1:]:
+            #The answer of a user message already dropped goes with it
+            if tokens <= target and old_message["role"] == "user":
+                break
+            tokens -= self.count_tokens(old_message["content"], model) + MESSAGE_OVERHEAD_TOKENS
+            dropped += 1
+
+        with self.lock:
+            self.stats["trims"] += 1
+        return dropped
+
+    def build(self, chat_history: list, message: str, relevant_context: str = "", summary: str = "", options: dict = None, model: str = None) -> list:
+        """
+        Messages for the model: the history as it is and the new user message with the volatile content at its end,
+        cut so the prompt fits the budget.
+        :param chat_history: System message followed by the turns, already trimmed with trim_history
+        :param message: New user message
+        :param relevant_context(optional): Messages retrieved from the conversation
+        :param summary(optional): Summary of the messages out of the history
+        :param model(optional): Model the prompt is for
+        """
+        available = self.budget(options) - self.count_message_tokens(chat_history, model) - self.count_tokens(message, model) - MESSAGE_OVERHEAD_TOKENS
+
+        volatile = ""
+        if summary:
+            volatile += f"\n\nSummary of the conversation:\n{summary}"
+        if relevant_context:
+            volatile += f"\n\nRelevant context of the previous conversation:\n{relevant_context}"
+
+        if volatile and self.count_tokens(volatile, model) > available:
+            volatile = volatile[:max(0, int(available * self.ratio(model)))]
+            with self.lock:
+                self.stats["context_truncations"] += 1
+
+        with self.lock:
+            self.stats["prompts"] += 1
+        return [*chat_history, {"role": "user", "content": message + volatile}]
+
+    def calibrate(self, messages: list, prompt_eval_count: int, model: str = None):
+        """
+        Adjust the characters per token of a model with the tokens ollama counted for a prompt.
+        Prompts partly served from the KV cache report fewer tokens, only full evaluations near the estimate are used.
+        """
+        if not prompt_eval_count:
+            return
+        chars = sum(len(message["content"] or "") for message in messages)
+        tokens = prompt_eval_count - MESSAGE_OVERHEAD_TOKENS * len(messages)
+        if chars <= 0 or tokens <= 0:
+            return
+
+        observed = chars / tokens
+        with self.lock:
+            ratio = self.ratio(model)
+            if 0.5 * ratio <= observed <= 2 * ratio:
+                self.model_chars_per_token[model] = ratio * 0.9 + observed * 0.1
+                self.stats["calibrations"] += 1
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {**self.stats, "chars_per_token": {model: round(ratio, 3) for model, ratio in self.model_chars_per_token.items()}}
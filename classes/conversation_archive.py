@@ -0,0 +1,59 @@
+import io, os, gzip, tarfile
+
+try:
+    import zstandard
+except ImportError:  # gzip only
+    zstandard = None
+
+#Extension of the archives of every compression, restores look for all of them
+ARCHIVE_EXTENSIONS = {"zstd": ".tar.zst", "gzip": ".tar.gz"}
+
+
+def default_compression() -> str:
+    """
+    zstd when the zstandard package is installed, gzip otherwise.
+    """
+    return "zstd" if zstandard is not None else "gzip"
+
+
+def write_archive(paths: list, compression: str = "gzip", level: int = None) -> bytes:
+    """
+    Tar of some files, stored by their base name, compressed with zstd or gzip.
+    :param paths: Local paths of the files
+    :param compression(optional): zstd or gzip
+    :param level(optional): Compression level, 3 for zstd and 6 for gzip by default
+    :return archive content
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for path in paths:
+            tar.add(path, arcname=os.path.basename(path))
+    data = buffer.getvalue()
+
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=level or 3).compress(data)
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=level or 6)
+    raise ValueError(f"compression must be one of {list(ARCHIVE_EXTENSIONS)}")
+
+
+def read_archive(path: str) -> dict[str, bytes]:
+    """
+    Files of an archive written by write_archive, the compression is taken from its extension.
+    :return {file name: content}
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+
+    if path.endswith(ARCHIVE_EXTENSIONS["zstd"]):
+        if zstandard is None:
+            raise RuntimeError(f"{os.path.basename(path)} needs the zstandard package to be read")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        data = gzip.decompress(data)
+
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r") as tar:
+        #Names are reduced to their base name, an archive never writes outside its directory
+        return {os.path.basename(member.name): tar.extractfile(member).read() for member in tar.getmembers() if member.isfile()}
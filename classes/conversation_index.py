@@ -0,0 +1,201 @@
+import os, json, base64, sqlite3, threading
+from datetime import datetime
+
+SORT_COLUMNS = {"updated": "updated", "created": "created"}
+
+
+class ConversationIndex():
+    """
+    Index of conversations in an SQLite database in WAL mode with the metadata of every conversation:
+    name, file path, created, updated, turn count and byte size. Listing never opens conversation files.
+    Conversations moved to the archive tier keep their compressed size in archived_size, NULL while they are not archived.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                name TEXT,
+                file_path TEXT NOT NULL,
+                created TEXT NOT NULL,
+                updated TEXT NOT NULL,
+                turn_count INTEGER NOT NULL DEFAULT 0,
+                byte_size INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        #Columns added after the first version of the index
+        columns = {row["name"] for row in self.connection.execute("PRAGMA table_info(conversations)")}
+        if "accessed" not in columns:
+            self.connection.execute("ALTER TABLE conversations ADD COLUMN accessed TEXT")
+        if "archived_size" not in columns:
+            self.connection.execute("ALTER TABLE conversations ADD COLUMN archived_size INTEGER")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated DESC, id DESC)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS conversations_created ON conversations (created DESC, id DESC)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+
+    def add(self, conversation_id: str, name: str, file_path: str, created: str = None, updated: str = None, turn_count: int = 0, byte_size: int = 0):
+        """
+        Add a conversation or replace its metadata.
+        """
+        created = created or datetime.now().isoformat()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO conversations (id, name, file_path, created, updated, turn_count, byte_size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (conversation_id, name, file_path, created, updated or created, turn_count, byte_size)
+            )
+            self.connection.commit()
+
+    def get(self, conversation_id: str) -> dict | None:
+        """
+        Returns the metadata of a conversation or None.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def all(self) -> dict:
+        """
+        Returns every conversation in the format of the old index.json: id: {conversation_name, file_path}
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT id, name, file_path FROM conversations ORDER BY created, id").fetchall()
+        return {row["id"]: {"conversation_name": row["name"], "file_path": row["file_path"]} for row in rows}
+
+    def list(self, limit: int = None, cursor: str = None, sort: str = "updated") -> tuple[list, str | None]:
+        """
+        Returns a page of conversations sorted from most to least recent and the cursor of the next page.
+        :param limit(optional): Conversations per page, all of them if None
+        :param cursor(optional): Cursor returned with the previous page
+        :param sort(optional): updated or created
+        :return (conversations, next cursor or None)
+        """
+        column = SORT_COLUMNS.get(sort)
+        if column is None:
+            raise ValueError(f"sort must be one of {list(SORT_COLUMNS)}")
+
+        query = f"SELECT * FROM conversations"
+        parameters = []
+        if cursor:
+            value, last_id = decode_cursor(cursor)
+            query += f" WHERE ({column} < ? OR ({column} = ? AND id < ?))"
+            parameters += [value, value, last_id]
+        query += f" ORDER BY {column} DESC, id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit + 1)
+
+        with self.lock:
+            rows = [dict(row) for row in self.connection.execute(query, parameters).fetchall()]
+
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][column], rows[-1]["id"])
+
+        return rows, next_cursor
+
+    def update_conversation(self, conversation_id: str, turns_added: int = 0, byte_size: int = None, updated: str = None):
+        """
+        Update the metadata of a conversation after a write.
+        """
+        updated = updated or datetime.now().isoformat()
+        with self.lock:
+            self.connection.execute(
+                "UPDATE conversations SET updated = ?, turn_count = turn_count + ?, byte_size = COALESCE(?, byte_size) WHERE id = ?",
+                (updated, turns_added, byte_size, conversation_id)
+            )
+            self.connection.commit()
+
+    def touch(self, conversation_id: str):
+        """
+        Record that a conversation was opened, so it is not archived while it is in use.
+        """
+        with self.lock:
+            self.connection.execute("UPDATE conversations SET accessed = ? WHERE id = ?", (datetime.now().isoformat(), conversation_id))
+            self.connection.commit()
+
+    def set_archived(self, file_path: str, archived_size: int = None, byte_size: int = None):
+        """
+        Mark a conversation as archived with the size of its archive, or as restored with archived_size None.
+        :param file_path: Conversation file path
+        :param byte_size(optional): Size of the conversation files before they were archived
+        """
+        with self.lock:
+            self.connection.execute(
+                "UPDATE conversations SET archived_size = ?, byte_size = COALESCE(?, byte_size) WHERE file_path = ?",
+                (archived_size, byte_size, file_path)
+            )
+            self.connection.commit()
+
+    def idle(self, before: str, limit: int = None) -> list:
+        """
+        Conversations not archived and neither written nor opened since before, the oldest first.
+        :param before: ISO date
+        :param limit(optional): Maximum number of conversations
+        """
+        query = """
+            SELECT * FROM conversations
+            WHERE archived_size IS NULL AND MAX(updated, COALESCE(accessed, updated)) < ?
+            ORDER BY MAX(updated, COALESCE(accessed, updated)), id
+        """
+        parameters = [before]
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(query, parameters).fetchall()]
+
+    def archive_stats(self) -> dict:
+        """
+        Number of archived conversations, the size of their files before archiving and the size of their archives.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(byte_size), 0), COALESCE(SUM(archived_size), 0) FROM conversations WHERE archived_size IS NOT NULL"
+            ).fetchone()
+        return {"archived": row[0], "original_bytes": row[1], "archived_bytes": row[2]}
+
+    def import_index_json(self, index_file_path: str, read_metadata=None) -> int:
+        """
+        One time import of the conversations of an index.json file. Later calls do nothing.
+        :param index_file_path: Path of index.json
+        :param read_metadata(optional): Function receiving a file_path that returns {created, updated, turn_count, byte_size}
+        :return number of conversations imported
+        """
+        with self.lock:
+            imported = self.connection.execute("SELECT value FROM meta WHERE key = 'index_json_imported'").fetchone()
+        if imported is not None or not os.path.exists(index_file_path):
+            return 0
+
+        with open(index_file_path, "r", encoding="utf-8") as file:
+            index = json.loads(file.read() or "{}")
+
+        for conversation_id, entry in index.items():
+            metadata = read_metadata(entry["file_path"]) if read_metadata else {}
+            self.add(conversation_id, entry.get("conversation_name"), entry["file_path"], **metadata)
+
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('index_json_imported', ?)", (datetime.now().isoformat(),))
+            self.connection.commit()
+
+        return len(index)
+
+
+def encode_cursor(value: str, conversation_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([value, conversation_id]).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple[str, str]:
+    try:
+        value, conversation_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return value, conversation_id
+    except Exception:
+        raise ValueError("Invalid cursor")
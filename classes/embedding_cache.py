@@ -0,0 +1,123 @@
+import os, hashlib, sqlite3, threading, time
+import numpy as np
+from collections import OrderedDict
+
+
+class EmbeddingCache():
+    """
+    Two tier cache of embeddings keyed by (model, hash of the normalized text).
+    - Memory: LRU with at most memory_entries embeddings.
+    - Disk: SQLite table with at most disk_entries embeddings, the least recently used are evicted.
+    """
+    def __init__(self, path: str, memory_entries: int = 2048, disk_entries: int = 100_000):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+
+        self.lock = threading.Lock()
+        self.memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "memory_evictions": 0, "disk_evictions": 0}
+
+        self._connection: sqlite3.Connection = None
+        self._disk_count = 0
+
+    def get(self, model: str, text: str) -> np.ndarray | None:
+        """
+        Returns the cached embedding of a text or None.
+        """
+        key = cache_key(model, text)
+
+        with self.lock:
+            embedding = self.memory.get(key)
+            if embedding is not None:
+                self.memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return embedding
+
+            row = self._disk().execute("SELECT dim, vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+
+            self._disk().execute("UPDATE embeddings SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._disk().commit()
+
+            embedding = np.frombuffer(row[1], dtype=np.float32).reshape(row[0])
+            self._remember(key, embedding)
+            self.stats["disk_hits"] += 1
+            return embedding
+
+    def put(self, model: str, text: str, embedding: np.ndarray):
+        """
+        Store the embedding of a text in both tiers.
+        """
+        key = cache_key(model, text)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        embedding.setflags(write=False)
+
+        with self.lock:
+            self._remember(key, embedding)
+
+            disk = self._disk()
+            inserted = disk.execute(
+                "INSERT OR IGNORE INTO embeddings (key, dim, vector, accessed) VALUES (?, ?, ?, ?)",
+                (key, len(embedding), embedding.tobytes(), time.time())
+            ).rowcount
+            self._disk_count += inserted
+
+            if self._disk_count > self.disk_entries:
+                evicted = self._disk_count - self.disk_entries
+                disk.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY accessed LIMIT ?)",
+                    (evicted,)
+                )
+                self._disk_count -= evicted
+                self.stats["disk_evictions"] += evicted
+            disk.commit()
+
+    def get_stats(self) -> dict:
+        """
+        Returns the hit and miss counters and the size of both tiers.
+        """
+        with self.lock:
+            lookups = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+            hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+            return {
+                **self.stats,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self.memory),
+                "memory_max_entries": self.memory_entries,
+                "disk_entries": self._disk_count if self._connection else 0,
+                "disk_max_entries": self.disk_entries
+            }
+
+    def _remember(self, key: str, embedding: np.ndarray):
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+            self.stats["memory_evictions"] += 1
+
+    def _disk(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, dim INTEGER, vector BLOB, accessed REAL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)")
+            self._disk_count = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return self._connection
+
+
+def normalize_text(text: str) -> str:
+    """
+    Text used for the cache key: surrounding whitespace removed and inner whitespace collapsed.
+    """
+    return " ".join(text.split())
+
+
+def cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
@@ -0,0 +1,78 @@
+import os
+import numpy as np
+
+
+class EmbeddingStore():
+    """
+    Append-only float32 matrix stored in a binary file next to a conversation file.
+    Each row is one embedding, the number of committed rows is kept in the conversation file
+    so rows written after the last committed count (an interrupted write) are discarded.
+    """
+    def __init__(self, path: str, dim: int = 0, count: int = 0):
+        self.path = path
+        self.dim = dim
+        self.count = count
+        self._matrix: np.ndarray = None
+
+        self._discard_uncommitted_rows()
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def row_bytes(self) -> int:
+        return self.dim * np.dtype(np.float32).itemsize
+
+    def append(self, embeddings: np.ndarray) -> int:
+        """
+        Append one or several embeddings at the end of the file.
+        :param embeddings: Array with shape (dim,) or (n, dim)
+        :return new number of rows
+        """
+        rows = np.asarray(embeddings, dtype=np.float32)
+        if rows.ndim == 1:
+            rows = rows.reshape(1, -1)
+        if len(rows) == 0:
+            return self.count
+
+        if not self.dim:
+            self.dim = rows.shape[1]
+        elif rows.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension {rows.shape[1]} does not match the store dimension {self.dim}")
+
+        with open(self.path, "ab") as file:
+            file.write(rows.tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.count += len(rows)
+        self._matrix = None
+        return self.count
+
+    def reload(self, count: int):
+        """
+        Use a new number of committed rows after another process appended to the file.
+        """
+        self.count = count
+        self._matrix = None
+
+    def read(self) -> np.ndarray:
+        """
+        Returns the committed rows as a read only memory map with shape (count, dim).
+        """
+        if self.count == 0 or not os.path.exists(self.path):
+            return np.empty((0, self.dim), dtype=np.float32)
+
+        if self._matrix is None:
+            self._matrix = np.memmap(self.path, dtype=np.float32, mode="r", shape=(self.count, self.dim))
+
+        return self._matrix
+
+    def _discard_uncommitted_rows(self):
+        if not os.path.exists(self.path) or not self.dim:
+            return
+
+        committed_size = self.count * self.row_bytes
+        if os.path.getsize(self.path) > committed_size:
+            with open(self.path, "r+b") as file:
+                file.truncate(committed_size)
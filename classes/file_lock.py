@@ -0,0 +1,72 @@
+import os, threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock():
+    """
+    Exclusive advisory lock on a file shared by every process of the server.
+    It is reentrant inside a process: nested acquisitions from the same thread only lock the file once.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquire(self):
+        self.thread_lock.acquire()
+        if self.depth == 0:
+            try:
+                self.file = open(self.path, "a+b")
+                if fcntl is not None:
+                    fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+                else:
+                    self.file.seek(0)
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+            except Exception:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                self.thread_lock.release()
+                raise
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            self.file.close()
+            self.file = None
+        self.thread_lock.release()
+
+
+def write_file_atomically(path: str, data: bytes):
+    """
+    Write a file through a temporary file renamed over it, readers see the old or the new content but never a partial one.
+    """
+    temporal_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temporal_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporal_path, path)
+    finally:
+        if os.path.exists(temporal_path):
+            os.remove(temporal_path)
@@ -0,0 +1,61 @@
+import os, json
+
+
+class HistoryJournal():
+    """
+    Append-only JSONL file with the messages added to a conversation history since its last snapshot, one message per line.
+    The number of committed lines is kept by the conversation, lines after it come from an interrupted write and are discarded.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def read(self, count: int) -> list:
+        """
+        Returns the first count messages and removes any line after them.
+        :param count: Committed messages of the journal
+        """
+        messages = []
+        committed_size = 0
+
+        if count > 0 and os.path.exists(self.path):
+            with open(self.path, "rb") as file:
+                for line in file:
+                    if len(messages) == count or not line.endswith(b"\n"):
+                        break
+                    messages.append(json.loads(line))
+                    committed_size += len(line)
+
+        if os.path.exists(self.path) and os.path.getsize(self.path) != committed_size:
+            with open(self.path, "r+b") as file:
+                file.truncate(committed_size)
+
+        self.count = len(messages)
+        return messages
+
+    def append(self, messages: list):
+        """
+        Append messages at the end of the journal with a single write.
+        """
+        if not messages:
+            return
+
+        lines = "".join(json.dumps(message, ensure_ascii=False) + "\n" for message in messages)
+        with open(self.path, "ab") as file:
+            file.write(lines.encode("utf-8"))
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.count += len(messages)
+
+    def clear(self):
+        """
+        Empty the journal after its messages have been written to a snapshot.
+        """
+        if os.path.exists(self.path):
+            with open(self.path, "r+b") as file:
+                file.truncate(0)
+        self.count = 0
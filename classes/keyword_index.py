@@ -0,0 +1,139 @@
+import re, sqlite3, threading
+from datetime import datetime
+
+#Words of a query, a trailing * searches the word as a prefix
+QUERY_TERM = re.compile(r"\w+\*?")
+
+
+class KeywordIndex():
+    """
+    Full text index of the messages of every conversation in an SQLite FTS5 table, ranked with BM25.
+    The messages table keeps the text (conversation, position in full_history, role, content) and the FTS5 table
+    indexes it as external content, kept in sync by triggers. Messages are added once per (conversation, position),
+    adding them again does nothing.
+    BM25 costs microseconds per matching message, so a query matching more than max_ranked messages only ranks the
+    max_ranked most recent ones and search tells that the ranking was truncated. With max_ranked 0 every match is ranked.
+    """
+    def __init__(self, path: str, max_ranked: int = 5000):
+        self.path = path
+        self.max_ranked = max_ranked
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                conversation_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                role TEXT,
+                content TEXT NOT NULL,
+                UNIQUE (conversation_id, position)
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            );
+            CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            END;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    @property
+    def built(self) -> bool:
+        """
+        True once every conversation has been indexed by rebuild, later messages are added as they are written.
+        """
+        with self.lock:
+            return self.connection.execute("SELECT value FROM meta WHERE key = 'built'").fetchone() is not None
+
+    def add_messages(self, conversation_id: str, first_position: int, messages: list):
+        """
+        Index consecutive messages of a conversation.
+        :param conversation_id: Id in index
+        :param first_position: Position in full_history of the first message
+        :param messages: Messages with format {role, content}
+        """
+        rows = [
+            (conversation_id, first_position + i, message.get("role"), message["content"])
+            for i, message in enumerate(messages) if isinstance(message.get("content"), str)
+        ]
+        if not rows:
+            return
+
+        with self.lock:
+            self.connection.executemany("INSERT OR IGNORE INTO messages (conversation_id, position, role, content) VALUES (?, ?, ?, ?)", rows)
+            self.connection.commit()
+
+    def replace_conversation(self, conversation_id: str, messages: list):
+        """
+        Index again every message of a conversation in a single transaction.
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO messages (conversation_id, position, role, content) VALUES (?, ?, ?, ?)",
+                [(conversation_id, position, message.get("role"), message["content"]) for position, message in enumerate(messages) if isinstance(message.get("content"), str)]
+            )
+            self.connection.commit()
+
+    def set_built(self):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', ?)", (datetime.now().isoformat(),))
+            self.connection.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+            self.connection.commit()
+
+    def search(self, query: str, limit: int = 10, offset: int = 0, snippet_tokens: int = 16) -> tuple[list, int | None, bool]:
+        """
+        Messages that contain every word of the query, from the best to the worst BM25 score.
+        :param query: Words to search, word* searches a prefix
+        :param limit(optional): Results per page
+        :param offset(optional): Results to skip
+        :param snippet_tokens(optional): Words of the snippet around the matches, marked with **
+        :return ([{conversation_id, position, role, snippet, score}], offset of the next page or None,
+            True when only the newest max_ranked matches were ranked)
+        """
+        match = match_expression(query)
+        if not match:
+            return [], None, False
+
+        with self.lock:
+            #Walking the matches by rowid is cheap, only the newest max_ranked get a BM25 score
+            newest = None
+            if self.max_ranked > 0:
+                newest = self.connection.execute(
+                    "SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+                    (match, self.max_ranked)
+                ).fetchone()
+            rows = self.connection.execute("""
+                SELECT messages.conversation_id, messages.position, messages.role,
+                       snippet(messages_fts, 0, '**', '**', '...', ?) AS snippet, bm25(messages_fts) AS score
+                FROM messages_fts JOIN messages ON messages.id = messages_fts.rowid
+                WHERE messages_fts MATCH ? AND messages_fts.rowid >= ?
+                ORDER BY score LIMIT ? OFFSET ?
+            """, (min(max(1, snippet_tokens), 64), match, newest[0] + 1 if newest else 0, limit + 1, offset)).fetchall()
+
+        #BM25 of SQLite is negative, lower is better: scores are returned as positive numbers
+        results = [{**dict(row), "score": -row["score"]} for row in rows[:limit]]
+        return results, offset + limit if len(rows) > limit else None, newest is not None
+
+
+def match_expression(query: str) -> str:
+    """
+    FTS5 query with every word of a user query quoted, so operators and punctuation are searched as text.
+    """
+    terms = []
+    for term in QUERY_TERM.findall(query):
+        prefix = term.endswith("*")
+        terms.append('"' + term.rstrip("*") + '"' + ("*" if prefix else ""))
+    return " ".join(terms)
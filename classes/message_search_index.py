@@ -0,0 +1,301 @@
+import os, json, shutil, threading, logging
+import numpy as np
+
+from classes.ann_index import IVFIndex
+from classes.embedding_store import EmbeddingStore
+from classes.file_lock import FileLock, write_file_atomically
+
+logger = logging.getLogger(__name__)
+
+ROW_DTYPE = np.dtype([("conversation", "<i4"), ("position", "<i4"), ("offset", "<i8"), ("length", "<i4")])
+
+
+class MessageSearchIndex():
+    """
+    Persistent IVF index over the message embeddings of every conversation.
+    The files of the index directory are append-only:
+    - vectors.f32: float32 embeddings (EmbeddingStore).
+    - messages.jsonl: the text of every message, one JSON string per line.
+    - rows.bin: conversation, history position and text location of every vector. Its size is the committed number of vectors.
+    - conversations.json: conversation ids referenced by rows.bin.
+    - meta.json: dimension of the embeddings.
+    - centroids.npy: centroids of the last training.
+    Several processes can share the directory: writes hold <directory>.lock and every process picks up
+    the rows appended by the others before adding or searching.
+    In memory the vectors can be kept as float16 or int8 (quantization), searches re-rank them with vectors.f32.
+    When the index has grown enough to be clustered again, k-means runs in a background thread without holding the locks,
+    new messages meanwhile go to the lists of the previous centroids.
+    """
+    def __init__(self, directory: str, n_probe: int = 8, quantization: str = "float32", rerank_factor: int = 4, train_in_background: bool = True):
+        """
+        :param train_in_background(optional): False leaves the training to train(), for an index built at once
+        """
+        self.directory = directory
+        self.n_probe = n_probe
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        self.train_in_background = train_in_background
+        self.training = False
+        self.lock = threading.RLock()
+        self.file_lock = FileLock(f"{os.path.normpath(directory)}.lock")
+        with self.file_lock:
+            self._load()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add_messages(self, conversation_id: str, first_position: int, embeddings: np.ndarray, messages: list):
+        """
+        Add the embeddings of consecutive messages of a conversation.
+        :param conversation_id: Id in index
+        :param first_position: Position in full_history of the first message
+        :param embeddings: Array with shape (n, dim)
+        :param messages: n messages with format {role, content}
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(messages), -1)
+        if len(messages) == 0:
+            return
+
+        with self.lock, self.file_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            self._refresh()
+            if not self.store.dim:
+                with open(self._path("meta.json"), "w", encoding="utf-8") as file:
+                    json.dump({"dim": embeddings.shape[1]}, file)
+            conversation = self._conversation_code(conversation_id)
+
+            rows = np.empty(len(messages), dtype=ROW_DTYPE)
+            with open(self._path("messages.jsonl"), "ab") as file:
+                offset = file.tell()
+                for i, message in enumerate(messages):
+                    line = (json.dumps({"role": message["role"], "content": message["content"]}, ensure_ascii=False) + "\n").encode("utf-8")
+                    file.write(line)
+                    rows[i] = (conversation, first_position + i, offset, len(line))
+                    offset += len(line)
+
+            self.store.append(embeddings)
+            with open(self._path("rows.bin"), "ab") as file:
+                file.write(rows.tobytes())
+
+            self.rows = np.concatenate([self.rows, rows])
+            self.rows_stamp = (self._rows_stamp()[0], self.rows.nbytes)
+            self.index.add(embeddings)
+            self._schedule_training()
+
+    def search(self, query_embedding: np.ndarray, top_k: int = 5) -> list[dict]:
+        """
+        Returns the messages most similar to the query with format {conversation_id, position, role, message, score}
+        """
+        with self.lock:
+            self._refresh()
+            if len(self.rows) == 0:
+                return []
+
+            row_ids, scores = self.index.search(query_embedding, top_k, n_probe=self.n_probe)
+            if len(row_ids) == 0:
+                return []
+
+            results = []
+            with open(self._path("messages.jsonl"), "rb") as file:
+                for row_id, score in zip(row_ids, scores):
+                    row = self.rows[row_id]
+                    file.seek(int(row["offset"]))
+                    message = json.loads(file.read(int(row["length"])))
+                    results.append({
+                        "conversation_id": self.conversations[row["conversation"]],
+                        "position": int(row["position"]),
+                        "role": message["role"],
+                        "message": message["content"],
+                        "score": float(score)
+                    })
+
+            return results
+
+    def train(self):
+        """
+        Cluster all the stored vectors again and save the centroids.
+        """
+        with self.lock:
+            if len(self.rows) == 0:
+                return
+            self.index.train()
+            np.save(self._path("centroids.npy"), self.index.centroids)
+
+    def _schedule_training(self):
+        """
+        Train the index in a background thread when it needs it and no training is running.
+        """
+        with self.lock:
+            if not self.train_in_background or self.training or not self.index.needs_training:
+                return
+            self.training = True
+            index = self.index
+
+        def run():
+            try:
+                #k-means over a sample of the rows, adds and searches go on meanwhile
+                centroids = index.compute_centroids()
+                with self.lock, self.file_lock:
+                    #A rebuild replaced the index meanwhile
+                    if self.index is not index or centroids is None:
+                        return
+                    self._refresh_locked()
+                    self.index.train(centroids=centroids)
+                    np.save(self._path("centroids.npy"), self.index.centroids)
+            except Exception as e:
+                logger.error(f"Error training the search index: {e}")
+            finally:
+                with self.lock:
+                    self.training = False
+
+        threading.Thread(target=run, daemon=True, name="search-index-training").start()
+
+    def replace_with(self, other: "MessageSearchIndex", since: int = None, indexed: dict = None):
+        """
+        Replace the files of this index with the ones of another index and reload it.
+        :param other: Index built apart, in another directory
+        :param since(optional): Rows of this index from since on, appended while the other index was built, are added to it first
+        :param indexed(optional): {conversation id: messages already in the other index}, rows of earlier positions are not added again
+        """
+        with self.lock, self.file_lock:
+            if since is not None:
+                self._refresh_locked()
+                self._copy_rows_to(other, since, indexed or {})
+
+            old_directory = f"{self.directory}.old"
+            if os.path.exists(self.directory):
+                os.replace(self.directory, old_directory)
+            os.replace(other.directory, self.directory)
+            shutil.rmtree(old_directory, ignore_errors=True)
+            self._load()
+
+    def _copy_rows_to(self, other: "MessageSearchIndex", since: int, indexed: dict):
+        """
+        Add the rows of this index from since on to another index, except the positions it already has.
+        """
+        rows = self.rows[since:]
+        if len(rows) == 0:
+            return
+
+        indexed_counts = np.array([indexed.get(conversation_id, 0) for conversation_id in self.conversations], dtype=np.int64)
+        missing = np.flatnonzero(rows["position"] >= indexed_counts[rows["conversation"]]) + since
+        if len(missing) == 0:
+            return
+
+        vectors = self.store.read()
+        with open(self._path("messages.jsonl"), "rb") as file:
+            for row_id in missing:
+                row = self.rows[row_id]
+                file.seek(int(row["offset"]))
+                message = json.loads(file.read(int(row["length"])))
+                other.add_messages(self.conversations[row["conversation"]], int(row["position"]), vectors[row_id:row_id + 1], [message])
+
+    def _rows_stamp(self) -> tuple:
+        try:
+            stat = os.stat(self._path("rows.bin"))
+            return (stat.st_ino, stat.st_size)
+        except FileNotFoundError:
+            return (None, 0)
+
+    def _refresh(self):
+        """
+        Add the rows appended by other processes since the last load or refresh.
+        """
+        inode, size = self._rows_stamp()
+        committed = size // ROW_DTYPE.itemsize
+        if inode == self.rows_stamp[0] and committed == len(self.rows):
+            return
+
+        with self.file_lock:
+            self._refresh_locked()
+
+    def _refresh_locked(self):
+        inode, size = self._rows_stamp()
+        committed = size // ROW_DTYPE.itemsize
+        if inode == self.rows_stamp[0] and committed == len(self.rows):
+            return
+
+        #The directory was replaced by a rebuild or the rows were truncated
+        if inode != self.rows_stamp[0] or committed < len(self.rows):
+            self._load()
+            return
+
+        with open(self._path("rows.bin"), "rb") as file:
+            file.seek(self.rows.nbytes)
+            new_rows = np.frombuffer(file.read((committed - len(self.rows)) * ROW_DTYPE.itemsize), dtype=ROW_DTYPE)
+
+        if not self.store.dim:
+            with open(self._path("meta.json"), "r", encoding="utf-8") as file:
+                self.store.dim = json.load(file)["dim"]
+        if new_rows["conversation"].max() >= len(self.conversations):
+            with open(self._path("conversations.json"), "r", encoding="utf-8") as file:
+                self.conversations = json.load(file)
+            self.conversation_codes = {conversation_id: code for code, conversation_id in enumerate(self.conversations)}
+
+        first_row = len(self.rows)
+        self.store.reload(committed)
+        self.rows = np.concatenate([self.rows, new_rows])
+        self.index.add(self.store.read()[first_row:committed])
+        self.rows_stamp = (inode, self.rows.nbytes)
+        self._schedule_training()
+
+    def _load(self):
+        rows_path = self._path("rows.bin")
+        rows = np.empty(0, dtype=ROW_DTYPE)
+        if os.path.exists(rows_path):
+            rows = np.fromfile(rows_path, dtype=ROW_DTYPE, count=os.path.getsize(rows_path) // ROW_DTYPE.itemsize)
+
+        conversations_path = self._path("conversations.json")
+        self.conversations: list[str] = []
+        if os.path.exists(conversations_path):
+            with open(conversations_path, "r", encoding="utf-8") as file:
+                self.conversations = json.load(file)
+        self.conversation_codes = {conversation_id: code for code, conversation_id in enumerate(self.conversations)}
+
+        dim = 0
+        meta_path = self._path("meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as file:
+                dim = json.load(file)["dim"]
+
+        vectors_path = self._path("vectors.f32")
+        stored_vectors = os.path.getsize(vectors_path) // (dim * 4) if dim and os.path.exists(vectors_path) else 0
+        self.store = EmbeddingStore(vectors_path, dim=dim, count=min(len(rows), stored_vectors))
+        self.rows = rows[:len(self.store)]
+
+        #Discard rows of an interrupted write
+        if os.path.exists(rows_path) and os.path.getsize(rows_path) != self.rows.nbytes:
+            with open(rows_path, "r+b") as file:
+                file.truncate(self.rows.nbytes)
+        self.rows_stamp = (self._rows_stamp()[0], self.rows.nbytes)
+
+        self.index = IVFIndex(
+            dim=self.store.dim, n_probe=self.n_probe,
+            quantization=self.quantization, full_precision=self._full_precision, rerank_factor=self.rerank_factor
+            )
+        #Added in blocks, quantized indexes never hold every vector in float32
+        stored = self.store.read()
+        for start in range(0, len(stored), 65536):
+            self.index.engine.add(stored[start:start + 65536])
+
+        centroids_path = self._path("centroids.npy")
+        if len(self.rows) and os.path.exists(centroids_path):
+            self.index.train(centroids=np.load(centroids_path))
+        elif not self.train_in_background and len(self.rows) >= self.index.min_train_size:
+            self.index.train()
+            np.save(centroids_path, self.index.centroids)
+        else:
+            self._schedule_training()
+
+    def _full_precision(self, rows: np.ndarray) -> np.ndarray:
+        return self.store.read()[rows]
+
+    def _conversation_code(self, conversation_id: str) -> int:
+        if conversation_id not in self.conversation_codes:
+            self.conversation_codes[conversation_id] = len(self.conversations)
+            self.conversations.append(conversation_id)
+            write_file_atomically(self._path("conversations.json"), json.dumps(self.conversations).encode("utf-8"))
+        return self.conversation_codes[conversation_id]
+
+    def _path(self, file_name: str) -> str:
+        return os.path.join(self.directory, file_name)
@@ -0,0 +1,168 @@
+import bisect, contextvars, threading, time
+from contextlib import contextmanager
+
+#Seconds, from a fast file append to a long generation
+DEFAULT_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+#Durations of the stages of the current request, returned in its Server-Timing header
+request_timings: contextvars.ContextVar = contextvars.ContextVar("request_timings", default=None)
+
+
+class Histogram():
+    """
+    Prometheus histogram with labels.
+    """
+    def __init__(self, name: str, documentation: str, labels: list = None, buckets: list = None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels or []
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS)
+        self.lock = threading.Lock()
+        self.series: dict[tuple, dict] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            position = bisect.bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                series["buckets"][position] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                labels = format_labels(self.labels, key)
+                cumulative = 0
+                for bucket, count in zip(self.buckets, series["buckets"]):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{format_labels([*self.labels, "le"], (*key, format_value(bucket)))} {cumulative}')
+                lines.append(f'{self.name}_bucket{format_labels([*self.labels, "le"], (*key, "+Inf"))} {series["count"]}')
+                lines.append(f"{self.name}_sum{labels} {format_value(series['sum'])}")
+                lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
+
+
+class Gauge():
+    """
+    Prometheus gauge read from a function when the metrics are rendered.
+    The function returns a number, or a dict {label value or tuple of label values: number}.
+    """
+    def __init__(self, name: str, documentation: str, read, labels: list = None, kind: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+        self.labels = labels or []
+        self.kind = kind
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items(), key=lambda item: str(item[0])):
+            key = key if isinstance(key, tuple) else (key,)
+            lines.append(f"{self.name}{format_labels(self.labels, key)} {format_value(value)}")
+        return lines
+
+
+class MetricsRegistry():
+    def __init__(self):
+        self.metrics: dict = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name: str, documentation: str, labels: list = None, buckets: list = None) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name: str, documentation: str, read, labels: list = None, kind: str = "gauge") -> Gauge:
+        return self._register(Gauge(name, documentation, read, labels, kind))
+
+    def render(self) -> str:
+        """
+        Every metric in the Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+    def _register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+
+def format_labels(names: list, values: tuple) -> str:
+    if not names:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = MetricsRegistry()
+
+stage_seconds = metrics.histogram("stage_duration_seconds", "Duration of the stages of a chat turn and of the storage operations.", ["stage"])
+ttft_seconds = metrics.histogram("chat_time_to_first_token_seconds", "Time from the chat request to ollama until its first token.", ["model"])
+tokens_per_second = metrics.histogram(
+    "chat_tokens_per_second", "Generation speed of the chat responses.", ["model"],
+    buckets=[1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300]
+    )
+
+
+def record_stage(stage: str, seconds: float):
+    """
+    Add the duration of a stage to its histogram and to the Server-Timing of the current request.
+    """
+    stage_seconds.observe(seconds, stage=stage)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed_stage(stage: str):
+    """
+    Measure the code of a with block as a stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+class ServerTimingMiddleware():
+    """
+    ASGI middleware that adds a Server-Timing header with the stages measured before the response starts.
+    Non-streaming responses start when the endpoint has finished, so they get every stage; streamed ones
+    get the stages before their first chunk.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = {}
+        token = request_timings.set(timings)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                entries = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in timings.items()]
+                entries.append(f"total;dur={(time.perf_counter() - start) * 1000:.2f}")
+                message.setdefault("headers", [])
+                message["headers"] = [*message["headers"], (b"server-timing", ", ".join(entries).encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_timings.reset(token)
@@ -0,0 +1,105 @@
+import threading, time
+
+
+class ModelInventory():
+    """
+    Cache of the installed ollama models with stale-while-revalidate:
+    - Younger than ttl: returned as is.
+    - Older than ttl and younger than max_stale: returned as is while a background thread fetches it again.
+    - Older than max_stale, never fetched or invalidated: fetched before returning.
+    """
+    def __init__(self, fetch, ttl: float = 60, max_stale: float = 3600):
+        """
+        :param fetch: Function that returns the models as a list of dicts
+        :param ttl: Seconds the list is fresh
+        :param max_stale: Seconds a stale list can still be returned while it is refreshed
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.max_stale = max_stale
+
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+        self.models: list[dict] = None
+        self.fetched_at = 0.0
+        self.refreshing = False
+        self.stats = {"hits": 0, "stale_hits": 0, "fetches": 0, "background_refreshes": 0, "invalidations": 0, "errors": 0}
+
+    def get(self) -> list[dict]:
+        """
+        Returns the installed models.
+        """
+        with self.lock:
+            age = time.monotonic() - self.fetched_at
+            if self.models is not None and age < self.ttl:
+                self.stats["hits"] += 1
+                return self.models
+
+            if self.models is not None and age < self.max_stale:
+                self.stats["stale_hits"] += 1
+                if not self.refreshing:
+                    self.refreshing = True
+                    threading.Thread(target=self._refresh_in_background, daemon=True).start()
+                return self.models
+
+        return self.refresh()
+
+    def refresh(self) -> list[dict]:
+        """
+        Fetch the models now, concurrent callers share the same fetch.
+        """
+        requested_at = time.monotonic()
+        with self.fetch_lock:
+            with self.lock:
+                if self.models is not None and self.fetched_at >= requested_at:
+                    return self.models
+
+            try:
+                models = self.fetch()
+            except Exception:
+                with self.lock:
+                    self.stats["errors"] += 1
+                raise
+
+            with self.lock:
+                self.models = models
+                self.fetched_at = time.monotonic()
+                self.stats["fetches"] += 1
+                return models
+
+    def invalidate(self):
+        """
+        Forget the cached models, the next get fetches them again.
+        """
+        with self.lock:
+            self.models = None
+            self.fetched_at = 0.0
+            self.stats["invalidations"] += 1
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                **self.stats,
+                "cached_models": len(self.models) if self.models is not None else 0,
+                "age_seconds": round(time.monotonic() - self.fetched_at, 3) if self.models is not None else None,
+                "ttl_seconds": self.ttl
+            }
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+            with self.lock:
+                self.stats["background_refreshes"] += 1
+        except Exception:
+            pass
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+
+def is_model_not_found(error: Exception) -> bool:
+    """
+    True if an ollama error says that the requested model is not installed.
+    """
+    message = str(error).lower()
+    return getattr(error, "status_code", None) == 404 or ("model" in message and "not found" in message)
@@ -0,0 +1,254 @@
+import logging, math, threading, time
+from collections import deque
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class ModelResidency():
+    """
+    Decides which ollama models stay loaded:
+    - Pinned models (embedding model, configured agents, MODEL_WARMUP) and models with requests in the last idle_seconds
+      are the warm set, ranked pinned first and then by their recent request rate, up to memory_budget bytes.
+    - Calls to warm models ask ollama to keep them loaded keep_alive seconds, the rest only idle_keep_alive seconds.
+    - Every interval seconds warm models that are not loaded, or about to expire, are loaded again, and models outside
+      the warm set are unloaded while the loaded models exceed the memory budget.
+    Loads, unloads and models expired by ollama are kept as events.
+    When it is not enabled requests send no keep_alive, ollama loads and unloads the models with its own default.
+    """
+    def __init__(self, load, unload, list_loaded, model_size, pinned: list = None, memory_budget: int = 0,
+                 keep_alive: float = 1800, idle_keep_alive: float = 60, idle_seconds: float = 900,
+                 interval: float = 60, half_life: float = 600, max_events: int = 100, enabled: bool = True):
+        """
+        :param load: Function (model, keep_alive seconds) that loads a model or extends its keep-alive
+        :param unload: Function (model) that unloads a model
+        :param list_loaded: Function that returns the loaded models as {model: size in bytes}
+        :param model_size: Function (model) that returns the size of a model not loaded, or None
+        :param pinned(optional): Models always in the warm set if they fit the budget
+        :param memory_budget(optional): Bytes of the loaded models, 0 for no budget
+        :param keep_alive(optional): Seconds warm models stay loaded after a request
+        :param idle_keep_alive(optional): Seconds the rest of the models stay loaded after a request
+        :param idle_seconds(optional): Seconds without requests before a model leaves the warm set
+        :param interval(optional): Seconds between two checks of the loaded models
+        :param half_life(optional): Seconds for the request rate of a model to halve
+        :param enabled(optional): False leaves the keep-alive of every model to ollama
+        """
+        self.load = load
+        self.unload = unload
+        self.list_loaded = list_loaded
+        self.model_size = model_size
+        self.pinned = [model_name(model) for model in pinned or []]
+        self.pinned_sources = []
+        #Pinned models of the last check, the sources are not read in the request path
+        self.pinned_models = list(self.pinned)
+        self.memory_budget = memory_budget
+        self.keep_alive = keep_alive
+        self.idle_keep_alive = idle_keep_alive
+        self.idle_seconds = idle_seconds
+        self.interval = interval
+        self.half_life = half_life
+        self.enabled = enabled
+
+        self.lock = threading.Lock()
+        self.traffic: dict[str, dict] = {}
+        self.sizes: dict[str, int] = {}
+        self.loaded: dict[str, int] = {}
+        self.expires: dict[str, float] = {}
+        self.warm: list[str] = []
+        self.events = deque(maxlen=max_events)
+        self.stats = {"loads": 0, "keep_alive_refreshes": 0, "unloads": 0, "expired": 0, "load_errors": 0, "checks": 0}
+
+        self.stopped = threading.Event()
+        self.thread: threading.Thread = None
+
+    def add_pinned_source(self, source):
+        """
+        Function that returns more models to pin, called on every check (for example the models of the configured agents).
+        """
+        self.pinned_sources.append(source)
+
+    def use(self, model: str) -> float | None:
+        """
+        Record a request to a model.
+        :return keep_alive seconds to send with the request, None for the default of ollama
+        """
+        if not self.enabled:
+            return None
+
+        model = model_name(model)
+        now = time.monotonic()
+        with self.lock:
+            traffic = self.traffic.setdefault(model, {"rate": 0.0, "updated": now, "last_used": now, "requests": 0})
+            traffic["rate"] = self._decayed_rate(traffic, now) + 1
+            traffic["updated"] = traffic["last_used"] = now
+            traffic["requests"] += 1
+
+            if model not in self.warm:
+                self.warm = self._plan(now, self.pinned_models)
+            keep_alive = self.keep_alive if model in self.warm else self.idle_keep_alive
+            self.expires[model] = now + keep_alive
+
+        return keep_alive
+
+    def check(self):
+        """
+        Compare the loaded models with the warm set: unload what exceeds the budget, load what is missing.
+        """
+        try:
+            loaded = {model_name(model): size for model, size in self.list_loaded().items()}
+        except Exception as e:
+            logger.warning(f"Could not list the loaded models: {e}")
+            return
+
+        pinned = self._pinned_models()
+        for model in {*pinned, *self.traffic} - set(loaded) - set(self.sizes):
+            try:
+                size = self.model_size(model)
+            except Exception:
+                size = None
+            if size:
+                with self.lock:
+                    self.sizes[model] = size
+
+        now = time.monotonic()
+        with self.lock:
+            self.stats["checks"] += 1
+            for model in set(self.loaded) - set(loaded):
+                self._event(model, "expired", "unloaded by ollama")
+                self.stats["expired"] += 1
+            for model in set(loaded) - set(self.loaded):
+                self._event(model, "load", "request")
+            self.loaded = dict(loaded)
+            self.sizes.update(loaded)
+            self.pinned_models = pinned
+            self.warm = self._plan(now, pinned)
+            warm = list(self.warm)
+            scores = {model: self._score(model, now, pinned) for model in loaded}
+
+        #Unload first so the models to load have room
+        if self.memory_budget:
+            loaded_bytes = sum(loaded.values())
+            for model in sorted((model for model in loaded if model not in warm), key=lambda model: scores[model]):
+                if loaded_bytes <= self.memory_budget:
+                    break
+                try:
+                    self.unload(model)
+                except Exception as e:
+                    logger.warning(f"Could not unload {model}: {e}")
+                    continue
+                loaded_bytes -= loaded[model]
+                with self.lock:
+                    self.loaded.pop(model, None)
+                    self.stats["unloads"] += 1
+                    self._event(model, "unload", "memory budget")
+
+        for model in warm:
+            #Loaded models are touched only when their keep-alive is about to end
+            with self.lock:
+                expires = self.expires.get(model, 0)
+            if model in loaded and expires - now > 2 * self.interval:
+                continue
+            start = time.perf_counter()
+            try:
+                self.load(model, self.keep_alive)
+            except Exception as e:
+                with self.lock:
+                    self.stats["load_errors"] += 1
+                logger.warning(f"Could not load {model}: {e}")
+                continue
+
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.expires[model] = time.monotonic() + self.keep_alive
+                if model in loaded:
+                    self.stats["keep_alive_refreshes"] += 1
+                else:
+                    self.stats["loads"] += 1
+                    self.loaded[model] = self.sizes.get(model, 0)
+                    self._event(model, "load", "pinned" if model in pinned else "recent traffic", seconds)
+
+    def start(self):
+        """
+        Warm up the models now and check them every interval seconds in a background thread.
+        """
+        if self.thread is not None or not self.enabled:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True, name="model-residency")
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread = None
+
+    def get_stats(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            return {
+                **self.stats,
+                "memory_budget_bytes": self.memory_budget,
+                "loaded": dict(self.loaded),
+                "loaded_bytes": sum(self.loaded.values()),
+                "warm": list(self.warm),
+                "traffic": {model: {
+                    "requests": traffic["requests"],
+                    "rate": round(self._decayed_rate(traffic, now), 3),
+                    "idle_seconds": round(now - traffic["last_used"], 1)
+                    } for model, traffic in self.traffic.items()},
+                "events": list(self.events)
+            }
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"Error checking the loaded models: {e}")
+            if self.stopped.wait(self.interval):
+                return
+
+    def _pinned_models(self) -> list:
+        models = list(self.pinned)
+        for source in self.pinned_sources:
+            try:
+                models += [model_name(model) for model in source() if model]
+            except Exception as e:
+                logger.warning(f"Could not read the models to pin: {e}")
+        return list(dict.fromkeys(models))
+
+    def _decayed_rate(self, traffic: dict, now: float) -> float:
+        return traffic["rate"] * math.pow(0.5, (now - traffic["updated"]) / self.half_life)
+
+    def _score(self, model: str, now: float, pinned: list) -> float:
+        traffic = self.traffic.get(model)
+        return (math.inf if model in pinned else 0.0) + (self._decayed_rate(traffic, now) if traffic else 0.0)
+
+    def _plan(self, now: float, pinned: list) -> list:
+        """
+        Warm set: pinned models and models used in the last idle_seconds, by score, within the memory budget.
+        """
+        recent = [model for model, traffic in self.traffic.items() if now - traffic["last_used"] <= self.idle_seconds]
+        candidates = sorted(dict.fromkeys([*pinned, *recent]), key=lambda model: self._score(model, now, pinned), reverse=True)
+
+        warm, used = [], 0
+        for model in candidates:
+            size = self.sizes.get(model, 0)
+            if self.memory_budget and used + size > self.memory_budget:
+                continue
+            warm.append(model)
+            used += size
+        return warm
+
+    def _event(self, model: str, event: str, reason: str, seconds: float = None):
+        entry = {"time": datetime.now(timezone.utc).isoformat(), "model": model, "event": event, "reason": reason}
+        if seconds is not None:
+            entry["seconds"] = round(seconds, 3)
+        self.events.append(entry)
+        logger.info(f"Model {event}: {model} ({reason})")
+
+
+def model_name(model: str) -> str:
+    """
+    Name of a model as ollama lists it, with the latest tag when it has none.
+    """
+    return model if ":" in model else f"{model}:latest"
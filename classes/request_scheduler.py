@@ -0,0 +1,266 @@
+import asyncio, heapq, itertools, math, threading, time
+from contextlib import contextmanager, asynccontextmanager
+
+from calculations.dynamic_wait_time import get_resource_usage, scale_wait_time
+
+#Lower values are served first
+PRIORITY_CHAT = 0
+PRIORITY_SUMMARY = 1
+PRIORITY_BACKFILL = 2
+
+PRIORITY_NAMES = {PRIORITY_CHAT: "chat", PRIORITY_SUMMARY: "summary", PRIORITY_BACKFILL: "backfill"}
+
+
+class SchedulerOverloaded(Exception):
+    """
+    The request was not admitted, it can be retried after retry_after seconds.
+    """
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter():
+    def __init__(self, model: str, priority: int, notify):
+        self.model = model
+        self.priority = priority
+        self.notify = notify
+        self.granted = False
+        self.cancelled = False
+        self.enqueued = time.monotonic()
+
+
+class RequestScheduler():
+    """
+    Admission control in front of the ollama calls.
+    - Every model has a limit of concurrent requests, the rest wait in a priority queue
+      (chat before summaries before backfill, first come first served inside a priority).
+    - The queue is bounded: when it is full, or a request would wait longer than max_wait, it is rejected.
+    - Under CPU or memory pressure (psutil) background requests are rejected and chat requests are only
+      admitted if they don't need to queue.
+    Rejections raise SchedulerOverloaded with the seconds to wait before retrying.
+    """
+    def __init__(self, default_limit: int = 2, model_limits: dict = None, max_queue: int = 64, max_wait: float = 120,
+                 max_cpu_percent: float = 95, max_memory_percent: float = 95, sample_every: float = 1.0):
+        self.default_limit = default_limit
+        self.model_limits = model_limits or {}
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_cpu_percent = max_cpu_percent
+        self.max_memory_percent = max_memory_percent
+        self.sample_every = sample_every
+
+        self.lock = threading.Lock()
+        self.queue: list = []
+        self.sequence = itertools.count()
+        self.running: dict[str, int] = {}
+        self.service_seconds: dict[str, float] = {}
+
+        self.resource_usage = (0.0, 0.0)
+        self.sampled_at = 0.0
+
+        self.stats = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_pressure": 0, "rejected_timeout": 0}
+        self.waits = {name: {"count": 0, "total_ms": 0.0, "max_ms": 0.0} for name in PRIORITY_NAMES.values()}
+
+    def limit(self, model: str) -> int:
+        return self.model_limits.get(model, self.default_limit)
+
+    @contextmanager
+    def slot(self, model: str, priority: int = PRIORITY_CHAT):
+        """
+        Hold one of the concurrent requests of a model, blocking the thread while queued.
+        """
+        event = threading.Event()
+        waiter = self._enqueue(model, priority, event.set)
+        if not waiter.granted and not event.wait(self.max_wait) and not self._abandon(waiter):
+            raise self._timeout_error(waiter)
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(waiter, time.monotonic() - started)
+
+    @asynccontextmanager
+    async def aslot(self, model: str, priority: int = PRIORITY_CHAT):
+        """
+        Async version of slot, the event loop keeps running while the request is queued.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        notify = lambda: loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+        waiter = self._enqueue(model, priority, notify)
+        if not waiter.granted:
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+            except asyncio.TimeoutError:
+                if not self._abandon(waiter):
+                    raise self._timeout_error(waiter)
+            except asyncio.CancelledError:
+                if self._abandon(waiter):
+                    self._release(waiter, 0.0)
+                raise
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(waiter, time.monotonic() - started)
+
+    def check_admission(self, model: str, priority: int = PRIORITY_CHAT):
+        """
+        Raises SchedulerOverloaded if a request would be rejected now, used before starting a streamed response.
+        """
+        with self.lock:
+            self._sample_resources()
+            self._admission_error(model, priority)
+
+    def retry_after(self, model: str) -> int:
+        """
+        Estimated seconds until a new request of a model could start.
+        """
+        with self.lock:
+            return self._retry_after(model)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            cpu_usage, memory_usage = self.resource_usage
+            queued = [waiter for _, _, waiter in self.queue if not waiter.cancelled]
+            models = set(self.running) | {waiter.model for waiter in queued}
+            return {
+                **self.stats,
+                "queue_depth": len(queued),
+                "queue_by_priority": {name: sum(waiter.priority == priority for waiter in queued) for priority, name in PRIORITY_NAMES.items()},
+                "models": {model: {
+                    "running": self.running.get(model, 0),
+                    "limit": self.limit(model),
+                    "queued": sum(waiter.model == model for waiter in queued),
+                    "mean_service_seconds": round(self.service_seconds.get(model, 0.0), 3)
+                    } for model in sorted(models)},
+                "wait_ms": {name: {
+                    "count": wait["count"],
+                    "mean": round(wait["total_ms"] / wait["count"], 2) if wait["count"] else 0.0,
+                    "max": round(wait["max_ms"], 2)
+                    } for name, wait in self.waits.items()},
+                "cpu_percent": cpu_usage,
+                "memory_percent": memory_usage,
+                "under_pressure": self._under_pressure()
+            }
+
+    def _enqueue(self, model: str, priority: int, notify) -> _Waiter:
+        with self.lock:
+            self._sample_resources()
+            self._admission_error(model, priority)
+
+            waiter = _Waiter(model, priority, notify)
+            if self.running.get(model, 0) < self.limit(model) and not self._has_queued(model, priority):
+                self._grant(waiter)
+            else:
+                heapq.heappush(self.queue, (priority, next(self.sequence), waiter))
+                self.stats["queued"] += 1
+            return waiter
+
+    def _admission_error(self, model: str, priority: int):
+        free_slot = self.running.get(model, 0) < self.limit(model) and not self._has_queued(model, priority)
+
+        if self._under_pressure() and (priority > PRIORITY_CHAT or not free_slot):
+            self.stats["rejected_pressure"] += 1
+            raise SchedulerOverloaded("The server is under CPU or memory pressure", self._retry_after(model))
+
+        if free_slot:
+            return
+
+        if len(self.queue) >= self.max_queue:
+            self.stats["rejected_queue_full"] += 1
+            raise SchedulerOverloaded("Too many queued requests", self._retry_after(model))
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """
+        Leave the queue after a timeout or a cancellation.
+        :return True if the slot was granted in the meantime, it must be used or released
+        """
+        with self.lock:
+            if waiter.granted:
+                return True
+            waiter.cancelled = True
+            self.queue = [entry for entry in self.queue if entry[2] is not waiter]
+            heapq.heapify(self.queue)
+            return False
+
+    def _timeout_error(self, waiter: _Waiter) -> SchedulerOverloaded:
+        with self.lock:
+            self.stats["rejected_timeout"] += 1
+            return SchedulerOverloaded(f"Waited more than {self.max_wait} seconds for {waiter.model}", self._retry_after(waiter.model))
+
+    def _release(self, waiter: _Waiter, seconds: float):
+        with self.lock:
+            self.running[waiter.model] -= 1
+            if not self.running[waiter.model]:
+                del self.running[waiter.model]
+
+            #Moving average of the time a request holds its slot, used for Retry-After
+            previous = self.service_seconds.get(waiter.model)
+            self.service_seconds[waiter.model] = seconds if previous is None else previous * 0.8 + seconds * 0.2
+
+            self._grant_queued()
+
+    def _grant_queued(self):
+        blocked = []
+        while self.queue:
+            entry = heapq.heappop(self.queue)
+            waiter = entry[2]
+            if waiter.cancelled:
+                continue
+            if self.running.get(waiter.model, 0) < self.limit(waiter.model):
+                self._grant(waiter)
+                waiter.notify()
+            else:
+                blocked.append(entry)
+        for entry in blocked:
+            heapq.heappush(self.queue, entry)
+
+    def _grant(self, waiter: _Waiter):
+        waiter.granted = True
+        self.running[waiter.model] = self.running.get(waiter.model, 0) + 1
+        self.stats["admitted"] += 1
+
+        wait_ms = (time.monotonic() - waiter.enqueued) * 1000
+        wait = self.waits[PRIORITY_NAMES.get(waiter.priority, "backfill")]
+        wait["count"] += 1
+        wait["total_ms"] += wait_ms
+        wait["max_ms"] = max(wait["max_ms"], wait_ms)
+
+    def _has_queued(self, model: str, priority: int) -> bool:
+        return any(waiter.model == model and waiter.priority <= priority and not waiter.cancelled for _, _, waiter in self.queue)
+
+    def _sample_resources(self):
+        now = time.monotonic()
+        if now - self.sampled_at < self.sample_every:
+            return
+        self.sampled_at = now
+        try:
+            self.resource_usage = get_resource_usage()
+        except Exception:
+            self.resource_usage = (0.0, 0.0)
+
+    def _under_pressure(self) -> bool:
+        cpu_usage, memory_usage = self.resource_usage
+        return cpu_usage >= self.max_cpu_percent or memory_usage >= self.max_memory_percent
+
+    def _retry_after(self, model: str) -> int:
+        queued = sum(waiter.model == model and not waiter.cancelled for _, _, waiter in self.queue)
+        base_wait_time = (queued + 1) * self.service_seconds.get(model, 1.0) / self.limit(model)
+        cpu_usage, memory_usage = self.resource_usage
+        return max(1, math.ceil(scale_wait_time(base_wait_time, cpu_usage, memory_usage, max(base_wait_time, self.max_wait))))
+
+
+def parse_model_limits(value: str) -> dict:
+    """
+    Parse limits with format model=limit,model=limit
+    """
+    limits = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            model, limit = item.rsplit("=", 1)
+            limits[model.strip()] = int(limit)
+    return limits
@@ -0,0 +1,196 @@
+import numpy as np
+
+#Types the normalized rows can be kept in: float16 takes half the memory of float32, int8 (one float32 scale per row) a quarter
+QUANTIZATIONS = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+class RetrievalEngine():
+    """
+    Keeps the embeddings of a conversation as a contiguous matrix of L2 normalized rows,
+    so the cosine similarity against every stored vector is a single matrix-vector product.
+    The matrix grows by doubling its capacity when new vectors are added.
+
+    The rows can be kept quantized (float16 or int8) to save memory. Searches then score the quantized rows and,
+    when full_precision gives the original embeddings, score again the best rerank_factor * top_k candidates
+    with them: results and scores are the float32 ones unless a true neighbour is ranked outside the candidates.
+    """
+    def __init__(self, dim: int = 0, initial_capacity: int = 64, quantization: str = "float32", full_precision=None, rerank_factor: int = 4, block_rows: int = 256):
+        """
+        :param dim(optional): Dimension of the vectors, taken from the first vectors added if 0
+        :param quantization(optional): float32, float16 or int8
+        :param full_precision(optional): Function (array of row positions) that returns the original embeddings of those rows
+        :param rerank_factor(optional): Candidates scored with full precision per result
+        :param block_rows(optional): Quantized rows converted to float32 at a time while scoring, a block that fits in the CPU cache
+        """
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"quantization must be one of {list(QUANTIZATIONS)}")
+        self.dim = dim
+        self.count = 0
+        self.quantization = quantization
+        self.full_precision = full_precision
+        self.rerank_factor = max(1, rerank_factor)
+        self.block_rows = block_rows
+        self._matrix = np.empty((initial_capacity, dim), dtype=QUANTIZATIONS[quantization]) if dim else None
+        self._scales = np.empty(initial_capacity, dtype=np.float32) if dim else None
+        self._initial_capacity = initial_capacity
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        Normalized stored vectors with shape (count, dim), a float32 copy when the rows are quantized.
+        """
+        if self._matrix is None:
+            return np.empty((0, self.dim), dtype=np.float32)
+        if self.quantization == "float32":
+            return self._matrix[:self.count]
+        return self.rows(slice(0, self.count))
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory of the stored rows.
+        """
+        scale_bytes = self.count * 4 if self.quantization == "int8" else 0
+        return self.count * self.dim * np.dtype(QUANTIZATIONS[self.quantization]).itemsize + scale_bytes
+
+    @property
+    def reranks(self) -> bool:
+        return self.quantization != "float32" and self.full_precision is not None
+
+    def rows(self, positions) -> np.ndarray:
+        """
+        Normalized rows at some positions (a slice or an array) as float32.
+        """
+        rows = self._matrix[:self.count][positions].astype(np.float32)
+        if self.quantization == "int8":
+            rows *= self._scales[:self.count][positions][:, None]
+        return rows
+
+    def add(self, vectors: np.ndarray):
+        """
+        Normalize and add one vector with shape (dim,) or several with shape (n, dim).
+        """
+        rows = normalize_rows(vectors)
+        if rows.size == 0:
+            return
+
+        if self._matrix is None:
+            self.dim = rows.shape[1]
+            self._matrix = np.empty((max(self._initial_capacity, len(rows)), self.dim), dtype=QUANTIZATIONS[self.quantization])
+            self._scales = np.empty(len(self._matrix), dtype=np.float32)
+
+        required = self.count + len(rows)
+        if required > len(self._matrix):
+            capacity = len(self._matrix)
+            while capacity < required:
+                capacity *= 2
+            grown = np.empty((capacity, self.dim), dtype=self._matrix.dtype)
+            grown[:self.count] = self._matrix[:self.count]
+            self._matrix = grown
+            grown_scales = np.empty(capacity, dtype=np.float32)
+            grown_scales[:self.count] = self._scales[:self.count]
+            self._scales = grown_scales
+
+        if self.quantization == "int8":
+            #Symmetric per row scale, the largest component of a row is stored as +-127
+            scales = np.abs(rows).max(axis=1) / 127
+            scales[scales == 0] = 1
+            self._scales[self.count:required] = scales
+            rows = np.rint(rows / scales[:, None])
+        self._matrix[self.count:required] = rows
+        self.count = required
+
+    def search(self, queries: np.ndarray, top_k: int = 3, limit: int = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the most similar stored vectors for one query with shape (dim,) or a batch with shape (m, dim).
+        :param queries: Query embeddings, they don't need to be normalized
+        :param top_k: Number of results for each query
+        :param limit(optional): Only search the first limit stored vectors
+        :return (indices, scores) ordered from most to least similar, with shape (k,) for one query or (m, k) for a batch
+        """
+        single_query = np.ndim(queries) == 1
+        normalized_queries = normalize_rows(queries)
+
+        stored_count = self.count if limit is None else min(limit, self.count)
+        k = min(top_k, stored_count)
+
+        if k == 0:
+            empty_indices = np.empty((len(normalized_queries), 0), dtype=np.int64)
+            empty_scores = np.empty((len(normalized_queries), 0), dtype=np.float32)
+            return (empty_indices[0], empty_scores[0]) if single_query else (empty_indices, empty_scores)
+
+        scores = self._scores(normalized_queries, stored_count)
+
+        if self.reranks:
+            positions = np.arange(stored_count)
+            results = [self.rerank(query, positions, query_scores, k) for query, query_scores in zip(normalized_queries, scores)]
+            top_indices = np.vstack([indices for indices, _ in results])
+            top_scores = np.vstack([query_scores for _, query_scores in results])
+        else:
+            if k < stored_count:
+                candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                candidates = np.broadcast_to(np.arange(stored_count), scores.shape)
+
+            candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+            order = np.argsort(-candidate_scores, axis=1)
+            top_indices = np.take_along_axis(candidates, order, axis=1)
+            top_scores = np.take_along_axis(candidate_scores, order, axis=1)
+
+        if single_query:
+            return top_indices[0], top_scores[0]
+        return top_indices, top_scores
+
+    def rerank(self, query: np.ndarray, candidates: np.ndarray, scores: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Best top_k of some candidates of a normalized query, from their scores against the stored rows.
+        With quantized rows the best rerank_factor * top_k candidates are scored again with full precision.
+        :return (indices, scores) ordered from most to least similar
+        """
+        k = min(top_k, len(candidates))
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        if self.reranks:
+            n_candidates = min(len(candidates), k * self.rerank_factor)
+            best = np.argpartition(-scores, n_candidates - 1)[:n_candidates] if n_candidates < len(candidates) else np.arange(len(candidates))
+            candidates = candidates[best]
+            scores = normalize_rows(self.full_precision(candidates)) @ query
+
+        best = np.argpartition(-scores, k - 1)[:k] if k < len(candidates) else np.arange(len(candidates))
+        best = best[np.argsort(-scores[best])]
+        return candidates[best], scores[best]
+
+    def _scores(self, queries: np.ndarray, stored_count: int) -> np.ndarray:
+        """
+        Similarity of normalized queries with shape (m, dim) against the first stored_count rows.
+        Quantized rows are converted to float32 in blocks of block_rows, never all at once.
+        """
+        if self.quantization == "float32":
+            return queries @ self._matrix[:stored_count].T
+
+        scores = np.empty((len(queries), stored_count), dtype=np.float32)
+        block = np.empty((self.block_rows, self.dim), dtype=np.float32)
+        for start in range(0, stored_count, self.block_rows):
+            stop = min(stored_count, start + self.block_rows)
+            np.copyto(block[:stop - start], self._matrix[start:stop], casting="unsafe")
+            scores[:, start:stop] = queries @ block[:stop - start].T
+            if self.quantization == "int8":
+                scores[:, start:stop] *= self._scales[start:stop]
+        return scores
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """
+    Returns the vectors as float32 rows with L2 norm 1. Zero vectors are left at zero.
+    """
+    rows = np.asarray(vectors, dtype=np.float32)
+    if rows.ndim == 1:
+        rows = rows.reshape(1, -1)
+
+    norms = np.linalg.norm(rows, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return rows / norms
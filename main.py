@@ -1,10 +1,21 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+
+from classes.agent_functions import model_residency
+from classes.metrics import ServerTimingMiddleware
+from classes.request_scheduler import SchedulerOverloaded
 
 from routers.ia_agents import IAAgents, get_ollama_local_agents
 from routers.conversations import Conversations
-from routers.file_manager import Conversation_Files
+from routers.file_manager import Conversation_Files, flush_all_sessions
 from routers.ia_models import IAModels, get_ollama_intalled_models
+from routers.search import Search, build_keyword_index_in_background
+from routers.embeddings_backfill import Backfill
+from routers.metrics import Metrics
+from routers.conversation_archive import Archive, archive_after_days, start_archive_job, stop_archive_job
 
 
 
@@ -13,7 +24,24 @@ origins = [
     "http://127.0.0.1:5173",  # Otra forma de acceder a React
 ]
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    #Preloads the embedding, agent and MODEL_WARMUP models and keeps the used ones warm
+    model_residency.start()
+    #Indexes the conversations written before the keyword index, only the first time
+    build_keyword_index_in_background()
+    #Compresses the conversations idle longer than ARCHIVE_AFTER_DAYS
+    if archive_after_days > 0:
+        start_archive_job()
+    yield
+    model_residency.stop()
+    stop_archive_job()
+    #Writes the conversations with turns not flushed yet
+    flush_all_sessions()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 app.add_middleware(
@@ -21,22 +49,41 @@ app.add_middleware(
     allow_origins = origins,
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Full-History-Total", "Retry-After", "Server-Timing"]
 )
 
+#Server-Timing header with the duration of the stages of every request
+app.add_middleware(ServerTimingMiddleware)
+
+@app.exception_handler(SchedulerOverloaded)
+async def scheduler_overloaded_handler(request: Request, error: SchedulerOverloaded):
+    """
+    Requests rejected by the request scheduler are answered with 429 and the seconds to wait.
+    """
+    return JSONResponse(status_code=429, content={"detail": str(error)}, headers={"Retry-After": str(error.retry_after)})
+
+
 app.include_router(router=IAModels)
 app.include_router(router=IAAgents)
 app.include_router(router=Conversation_Files)
 app.include_router(router=Conversations)
+app.include_router(router=Search)
+app.include_router(router=Backfill)
+app.include_router(router=Metrics)
+app.include_router(router=Archive)
 
 
 @app.get("/config/", tags=["Config"], status_code=200)
 def getBasicConfig():
     """
     Checks if there are any ollama models installed and if there are any agent configurations and returns them.
+    The models come from the model inventory cache, models_details has their size and family.
     """
+    models = get_ollama_intalled_models(details=True)
     opciones = {
-            "models": get_ollama_intalled_models(),
+            "models": [model["model"] for model in models],
+            "models_details": models,
             "agents": get_ollama_local_agents()
             }
         
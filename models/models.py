@@ -26,6 +26,9 @@ class ContentFileTemplate(BaseModel):
     resume_context: str
     full_history: Optional[list[Message]] = []
     embeddings_vectors: Optional[list[list[float]]] = []
+    #Fast ingestion: the embeddings as base64 of float32 little-endian rows of embeddings_dim values, not validated per float
+    embeddings_base64: Optional[str] = None
+    embeddings_dim: Optional[int] = None
     
 class AgentModel(BaseModel):
     id: Optional[str] = None
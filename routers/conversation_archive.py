@@ -0,0 +1,120 @@
+import os, sys, threading, logging
+from datetime import datetime, timedelta
+from fastapi import APIRouter, HTTPException
+
+from routers.file_manager import (get_conversation_index, get_conversation_file_path, archive_conversation, close_conversation_session,
+                                  conversation_sessions, conversation_hot_set, archive_compression)
+
+Archive = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+#Conversations neither written nor opened for ARCHIVE_AFTER_DAYS are compressed into the archive tier, 0 disables it
+archive_after_days = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+archive_check_seconds = float(os.getenv("ARCHIVE_CHECK_SECONDS", "3600"))
+
+archive_job_lock = threading.Lock()
+archive_job_stopped = threading.Event()
+
+
+def archive_idle_conversations(idle_days: float = None, limit: int = None) -> dict:
+    """
+    Archive the conversations neither written nor opened for idle_days. Conversations open in memory are skipped.
+    :param idle_days(optional): ARCHIVE_AFTER_DAYS by default
+    :param limit(optional): Maximum number of conversations to archive
+    :return {archived, skipped, errors, byte_size, archived_size}
+    """
+    idle_days = archive_after_days if idle_days is None else idle_days
+    before = (datetime.now() - timedelta(days=idle_days)).isoformat()
+
+    report = {"archived": 0, "skipped": 0, "errors": {}, "byte_size": 0, "archived_size": 0}
+    with archive_job_lock:
+        for conversation in get_conversation_index().idle(before, limit):
+            try:
+                archived = archive_conversation(conversation["id"])
+            except Exception as e:
+                report["errors"][conversation["id"]] = str(getattr(e, "detail", e))
+                continue
+
+            if archived is None:
+                report["skipped"] += 1
+                continue
+            report["archived"] += 1
+            report["byte_size"] += archived["byte_size"]
+            report["archived_size"] += archived["archived_size"]
+
+    return report
+
+
+def get_archive_report() -> dict:
+    """
+    Archived conversations, the disk saved by their compression and the conversations kept in memory.
+    """
+    stats = get_conversation_index().archive_stats()
+    return {
+        **stats,
+        "saved_bytes": stats["original_bytes"] - stats["archived_bytes"],
+        "compression_ratio": round(stats["original_bytes"] / stats["archived_bytes"], 2) if stats["archived_bytes"] else None,
+        "compression": archive_compression,
+        "archive_after_days": archive_after_days,
+        "hot_sessions": len(conversation_sessions),
+        "hot_set": conversation_hot_set
+    }
+
+
+def start_archive_job():
+    """
+    Archive the idle conversations every ARCHIVE_CHECK_SECONDS in a background thread.
+    """
+    def run():
+        while not archive_job_stopped.wait(archive_check_seconds):
+            try:
+                report = archive_idle_conversations()
+                if report["archived"]:
+                    logger.info(f"Archived {report['archived']} conversations, {report['byte_size'] - report['archived_size']} bytes saved")
+            except Exception as e:
+                logger.error(f"Error archiving the idle conversations: {e}")
+
+    archive_job_stopped.clear()
+    threading.Thread(target=run, daemon=True, name="conversation-archive").start()
+
+
+def stop_archive_job():
+    archive_job_stopped.set()
+
+
+#ENDPOINTS
+@Archive.post("/conversations/archive", tags=["Conversations"])
+def archive_conversations(idle_days: float = None, limit: int = None) -> dict:
+    """
+    Archive now the conversations neither written nor opened for idle_days (ARCHIVE_AFTER_DAYS by default).
+    """
+    return archive_idle_conversations(idle_days, limit)
+
+
+@Archive.get("/conversations/archive", tags=["Conversations"])
+def get_archive() -> dict:
+    """
+    Returns the archived conversations and the disk saved by the archive tier.
+    """
+    return get_archive_report()
+
+
+@Archive.post("/conversation/{conversation_id}/archive", tags=["Conversations"])
+def archive_one_conversation(conversation_id: str) -> dict:
+    """
+    Close a conversation and move it to the archive tier. It is decompressed on its next read or chat.
+    """
+    get_conversation_file_path(conversation_id)
+    close_conversation_session(conversation_id)
+
+    archived = archive_conversation(conversation_id)
+    if archived is None:
+        raise HTTPException(status_code=409, detail="The conversation is archived, open or has messages without embedding")
+    return archived
+
+
+if __name__ == "__main__":
+    #python -m routers.conversation_archive [idle_days]
+    print(archive_idle_conversations(float(sys.argv[1]) if len(sys.argv) > 1 else None))
+    print(get_archive_report())
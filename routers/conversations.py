@@ -1,47 +1,140 @@
-from fastapi import APIRouter
+import os
+from typing import Optional
+import numpy as np
+from fastapi import APIRouter, HTTPException, Request, Response, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
 
 from models.models import Conversation_Chat, ContentFileTemplate
 
-from routers.ia_agents import chat_with_agent
-from routers.file_manager import create_conversation, get_all_conversations_indexed, get_conversation_content
+from routers.ia_agents import chat_with_agent, chat_with_agent_async
+from routers.embeddings_backfill import schedule_conversation_backfill
+from routers.file_manager import (create_conversation, get_all_conversations_indexed, get_conversation_projection, iter_conversation_json,
+                                  get_conversation_session, count_template_embeddings, decode_embeddings)
+from routers.search import add_messages_to_search_index
 
 Conversations = APIRouter()
 
+#CHAT_ASYNC=0 goes back to generating the responses in threadpool workers
+chat_async = os.getenv("CHAT_ASYNC", "1") != "0"
+
+def add_conversation_embeddings(file_id: str, embeddings: np.ndarray, offset: int = None) -> dict:
+    """
+    Store the embeddings of the messages of a conversation from its first message without embedding.
+    :param file_id: Id in index
+    :param embeddings: One row per message
+    :param offset(optional): Position of the first message, it must be the first message without embedding
+    :return {embeddings_count, missing_embeddings}
+    """
+    session = get_conversation_session(file_id)
+    start, messages = session.missing_embeddings()
+    
+    if offset is not None and offset != start:
+        raise HTTPException(status_code=409, detail=f"The first message without embedding is {start}")
+    if len(embeddings) > len(messages):
+        raise HTTPException(status_code=400, detail=f"{len(embeddings)} embeddings for {len(messages)} messages without embedding")
+    if session.embedding_store.dim and embeddings.shape[1] != session.embedding_store.dim:
+        raise HTTPException(status_code=400, detail=f"The embeddings of the conversation have dimension {session.embedding_store.dim}")
+    
+    #A chat turn or the backfill added embeddings meanwhile
+    if not session.add_missing_embeddings(start, embeddings):
+        raise HTTPException(status_code=409, detail="The conversation embeddings changed, send them again")
+    
+    add_messages_to_search_index(file_id, start, embeddings, messages[:len(embeddings)])
+    return {"embeddings_count": session.embeddings_count, "missing_embeddings": len(messages) - len(embeddings)}
+
+
 #CONVERSATION
 @Conversations.post('/new_conversation/', tags=["Conversations"])
-def create_new_conversation(content: ContentFileTemplate) -> dict:
+def create_new_conversation(content: ContentFileTemplate, backfill: bool = True) -> dict:
     """
     Creates a new conversation with a receiving content in the ContentFileTemplate format.
+    Embeddings can be sent as embeddings_vectors lists or, much faster, as embeddings_base64 with embeddings_dim.
     Returns the conversation_id
+    :param backfill(optional): Embed in the background the messages of full_history without embedding.
+    False when they are uploaded afterwards to /conversation/{id}/embeddings
     """
     conversation_id = create_conversation(content)
+    
+    #A pre-filled full_history is embedded in the background
+    if backfill and len(content.full_history) > count_template_embeddings(content):
+        schedule_conversation_backfill(conversation_id)
+    
     return {"conversation id": conversation_id}
 
 
+@Conversations.put('/conversation/{convesation_id}/embeddings', tags=["Conversations"])
+async def upload_conversation_embeddings(convesation_id: str, request: Request, dim: int = Query(ge=1), offset: Optional[int] = Query(default=None, ge=0)) -> dict:
+    """
+    Store embeddings of full_history sent as the raw request body (application/octet-stream): float32 little-endian rows
+    of dim values, row i for the message offset + i. Nothing is parsed as JSON or validated per float.
+    :param dim: Dimension of the embeddings
+    :param offset(optional): Position of the first message, the first message without embedding by default
+    :return {embeddings_count, missing_embeddings}
+    """
+    embeddings = decode_embeddings(await request.body(), dim)
+    return await run_in_threadpool(add_conversation_embeddings, convesation_id, embeddings, offset)
+
+
 @Conversations.get('/get_conversations/', tags=["Conversations"])
-def get_all_conversations() -> list:
+def get_all_conversations(response: Response, limit: Optional[int] = Query(default=None, ge=1, le=1000), cursor: Optional[str] = None, sort: str = "updated") -> list:
     """
-    Return a list with id and conversations name for a index with format {id, name}
+    Return a list of conversations from most to least recent with format {id, name, created, updated, turn_count, byte_size}.
+    With limit the list is paginated, the cursor of the next page is returned in the X-Next-Cursor header.
+    :param limit(optional): Conversations per page
+    :param cursor(optional): X-Next-Cursor of the previous page
+    :param sort(optional): updated or created
     """
-    return get_all_conversations_indexed()
+    conversation_list, next_cursor = get_all_conversations_indexed(limit=limit, cursor=cursor, sort=sort)
+    
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+        
+    return conversation_list
 
 
 @Conversations.get('/conversation/{convesation_id}', tags=["Conversations"])
-def get_conversation(convesation_id: str) -> dict:
+def get_conversation(
+    convesation_id: str, 
+    fields: Optional[str] = None, 
+    exclude: Optional[str] = None, 
+    offset: int = Query(default=0, ge=0), 
+    limit: Optional[int] = Query(default=None, ge=0), 
+    last: Optional[int] = Query(default=None, ge=0)
+    ) -> StreamingResponse:
     """
-    Take all the content of a conversation.
+    Take the content of a conversation, streamed as JSON. Without parameters all of it is returned.
+    The total number of messages of full_history is returned in the X-Full-History-Total header.
+    :param fields(optional): Comma separated fields to return, for example full_history,resume_context
+    :param exclude(optional): Comma separated fields not to return, for example embeddings_vectors
+    :param offset(optional): First message of full_history
+    :param limit(optional): Messages of full_history to return
+    :param last(optional): Return the last N messages of full_history, overrides offset and limit
     """
-    return get_conversation_content(convesation_id)
+    split = lambda names: [name.strip() for name in names.split(",") if name.strip()] if names else None
+    
+    conversation_content, total = get_conversation_projection(
+        convesation_id, fields=split(fields), exclude=split(exclude), offset=offset, limit=limit, last=last
+        )
+    
+    return StreamingResponse(
+        iter_conversation_json(conversation_content), 
+        media_type="application/json", 
+        headers={"X-Full-History-Total": str(total)}
+        )
 
 
 #CHAT
 @Conversations.post('/chat/', tags=["Conversations"])
-def chatting(conversation: Conversation_Chat) -> StreamingResponse:
+async def chatting(conversation: Conversation_Chat, sse: bool = False) -> StreamingResponse:
     """
     Start a chat with an AI agent defined in a conversation file.
+    If the client disconnects the generation stops and the partial answer is saved with interrupted: true.
     :param conversation: {conversation_id: str, message: str}
+    :param sse(optional): Answer with server-sent events, {"content"} frames with several chunks each and a final done event
     :return StreamingResponse
     """
+    if chat_async:
+        return await chat_with_agent_async(conversation, sse)
     
-    return chat_with_agent(conversation)
\ No newline at end of file
+    return await run_in_threadpool(chat_with_agent, conversation, sse)
\ No newline at end of file
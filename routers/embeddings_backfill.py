@@ -0,0 +1,193 @@
+import os, json, sys, threading, time, logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fastapi import APIRouter, HTTPException
+
+from classes.agent_functions import generate_embeddings, embedding_batch_size
+from classes.file_lock import write_file_atomically
+from classes.request_scheduler import PRIORITY_BACKFILL, SchedulerOverloaded
+
+from routers.file_manager import (json_local_path, read_file_index, get_conversation_session, close_conversation_session, conversation_sessions,
+                                  is_conversation_archived)
+from routers.search import add_messages_to_search_index
+
+Backfill = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+#Conversations embedded at the same time by the backfill
+backfill_workers = int(os.getenv("EMBEDDING_BACKFILL_WORKERS", "2"))
+
+#Conversations already backfilled by an interrupted job, they are skipped when it runs again
+checkpoint_path = os.path.join(json_local_path, "backfill_checkpoint.json")
+
+backfill_executor = ThreadPoolExecutor(max_workers=backfill_workers, thread_name_prefix="backfill")
+scheduled_conversations: set = set()
+scheduled_lock = threading.Lock()
+
+backfill_status = {"running": False}
+backfill_lock = threading.Lock()
+
+
+def backfill_conversation(file_id: str, batch_size: int = None) -> int:
+    """
+    Embed the messages of a conversation without embedding, in batches. Every batch is written when embedded,
+    so an interrupted backfill goes on from the first message still without embedding.
+    :param file_id: Id in index
+    :param batch_size(optional): Messages per batch, embedding_batch_size by default
+    :return number of messages embedded
+    """
+    batch_size = batch_size or embedding_batch_size
+    was_open = file_id in conversation_sessions
+    session = get_conversation_session(file_id)
+
+    embedded = 0
+    try:
+        while True:
+            start, messages = session.missing_embeddings()
+            if not messages:
+                return embedded
+
+            batch = messages[:batch_size]
+            try:
+                vectors = generate_embeddings([message["content"] for message in batch], priority=PRIORITY_BACKFILL)
+            except SchedulerOverloaded as e:
+                #Backfill requests are the first shed by the request scheduler, wait until it admits them again
+                time.sleep(e.retry_after)
+                continue
+
+            #A chat turn or another job added embeddings meanwhile, read the missing messages again
+            if not session.add_missing_embeddings(start, vectors):
+                continue
+
+            add_messages_to_search_index(file_id, start, vectors, batch)
+            embedded += len(batch)
+    finally:
+        #Conversations opened only for the backfill are not kept in memory
+        if not was_open:
+            close_conversation_session(file_id)
+
+
+def schedule_conversation_backfill(file_id: str):
+    """
+    Backfill a conversation in the background, if it is not scheduled already.
+    """
+    with scheduled_lock:
+        if file_id in scheduled_conversations:
+            return
+        scheduled_conversations.add(file_id)
+
+    def run():
+        try:
+            backfill_conversation(file_id)
+        except Exception as e:
+            logger.error(f"Error backfilling the embeddings of {file_id}: {e}")
+        finally:
+            with scheduled_lock:
+                scheduled_conversations.discard(file_id)
+
+    backfill_executor.submit(run)
+
+
+def read_checkpoint() -> dict:
+    if not os.path.exists(checkpoint_path):
+        return {"done": []}
+    with open(checkpoint_path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def begin_backfill() -> tuple[list, set]:
+    """
+    Mark a backfill job as running. The running flag is checked and set under the same lock, so only one job runs.
+    :return (conversations to backfill, conversations done by an interrupted job)
+    """
+    with backfill_lock:
+        if backfill_status["running"]:
+            raise RuntimeError("The backfill is already running")
+
+        checkpoint = read_checkpoint()
+        done = set(checkpoint["done"])
+        #Archived conversations have every embedding, conversations with missing ones are not archived
+        file_ids = [file_id for file_id in read_file_index() if file_id not in done and not is_conversation_archived(file_id)]
+
+        backfill_status.clear()
+        backfill_status.update({
+            "running": True,
+            "started": datetime.now().isoformat(),
+            "finished": None,
+            "conversations": len(file_ids) + len(done),
+            "conversations_done": len(done),
+            "messages_embedded": 0,
+            "errors": {}
+            })
+
+    return file_ids, done
+
+
+def run_backfill(workers: int = None, batch_size: int = None, job: tuple[list, set] = None) -> dict:
+    """
+    Embed every message of every conversation without embedding, with at most workers conversations at a time.
+    Finished conversations are saved in a checkpoint file, an interrupted job skips them when it runs again.
+    :param job(optional): Job started with begin_backfill, a new one by default
+    :return status of the job
+    """
+    file_ids, done = job or begin_backfill()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers or backfill_workers, thread_name_prefix="backfill-job") as executor:
+            futures = {executor.submit(backfill_conversation, file_id, batch_size): file_id for file_id in file_ids}
+
+            for future in as_completed(futures):
+                file_id = futures[future]
+                try:
+                    embedded = future.result()
+                except Exception as e:
+                    with backfill_lock:
+                        backfill_status["errors"][file_id] = str(e)
+                    continue
+
+                with backfill_lock:
+                    done.add(file_id)
+                    backfill_status["conversations_done"] += 1
+                    backfill_status["messages_embedded"] += embedded
+                    write_file_atomically(checkpoint_path, json.dumps({"done": sorted(done)}).encode("utf-8"))
+
+        #A complete job starts from scratch the next time
+        if not backfill_status["errors"] and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+    finally:
+        with backfill_lock:
+            backfill_status["running"] = False
+            backfill_status["finished"] = datetime.now().isoformat()
+
+    return dict(backfill_status)
+
+
+#ENDPOINTS
+@Backfill.post("/embeddings/backfill", tags=["Models"], status_code=202)
+def start_backfill(workers: int = None) -> dict:
+    """
+    Start embedding in the background every history message without embedding.
+    :param workers(optional): Conversations embedded at the same time
+    """
+    try:
+        job = begin_backfill()
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    threading.Thread(target=run_backfill, kwargs={"workers": workers, "job": job}, daemon=True).start()
+    return {"message": "Backfill started"}
+
+
+@Backfill.get("/embeddings/backfill", tags=["Models"])
+def get_backfill_status() -> dict:
+    """
+    Returns the progress of the last backfill job.
+    """
+    with backfill_lock:
+        return {**backfill_status, "checkpoint": len(read_checkpoint()["done"])}
+
+
+if __name__ == "__main__":
+    #python -m routers.embeddings_backfill [workers]
+    print(run_backfill(workers=int(sys.argv[1]) if len(sys.argv) > 1 else None))
@@ -1,10 +1,18 @@
-import os, json
+import os, sys, json, base64, binascii, threading
 import numpy as np
-from typing import List
 from datetime import datetime
 
 from calculations.utilities import id_generator
 
+from classes.conversation_archive import ARCHIVE_EXTENSIONS, default_compression, write_archive, read_archive
+from classes.conversation_index import ConversationIndex
+from classes.embedding_store import EmbeddingStore
+from classes.file_lock import FileLock, write_file_atomically
+from classes.history_journal import HistoryJournal
+from classes.keyword_index import KeywordIndex
+from classes.metrics import timed_stage
+from classes.retrieval_engine import RetrievalEngine
+
 from fastapi import APIRouter, HTTPException
 
 from models.models import ContentFileTemplate
@@ -12,22 +20,86 @@ from models.models import ContentFileTemplate
 Conversation_Files = APIRouter()
 
 actual_path = os.path.dirname(__file__)
-json_path = os.path.join("..", "conversations")
+json_path = os.getenv("CONVERSATIONS_DIR", os.path.join("..", "conversations"))
 json_local_path = os.path.join(actual_path, json_path)
 
+#MULTI_WORKER=1 when the server runs with several worker processes (uvicorn main:app --workers N):
+#every turn is written right away and sessions reload the conversations changed by other workers
+multi_worker = os.getenv("MULTI_WORKER", "0") == "1"
+
+#FLUSH POLICIES OF THE CONVERSATION SESSIONS
+FLUSH_PER_TURN = "turn"
+FLUSH_EVERY_N_TURNS = "every_n"
+FLUSH_ON_IDLE = "idle"
+
+session_flush_policy = os.getenv("CONVERSATION_FLUSH_POLICY", FLUSH_PER_TURN)
+session_flush_every = int(os.getenv("CONVERSATION_FLUSH_EVERY", "5"))
+session_idle_seconds = float(os.getenv("CONVERSATION_FLUSH_IDLE_SECONDS", "30"))
+
+#Messages in the history journal before they are folded back into the conversation file
+history_compact_every = int(os.getenv("HISTORY_JOURNAL_COMPACT_EVERY", "500"))
+
+#Conversations kept loaded in memory, the least recently used are flushed and closed
+conversation_hot_set = int(os.getenv("CONVERSATION_HOT_SET", "256"))
+
+#Compression of the archive tier: zstd (needs the zstandard package) or gzip
+archive_compression = os.getenv("ARCHIVE_COMPRESSION") or default_compression()
+
+#Type of the embeddings kept in memory for retrieval and search: float32, float16 or int8.
+#Quantized candidates are re-ranked with the float32 embeddings files, EMBEDDING_RERANK_FACTOR candidates per result
+embedding_quantization = os.getenv("EMBEDDING_QUANTIZATION", "float32")
+embedding_rerank_factor = int(os.getenv("EMBEDDING_RERANK_FACTOR", "4"))
+
+#Fields of the conversation that change every turn, they are written to the small state file
+STATE_FIELDS = ["messages_history", "resume_context", "embeddings_dim", "embeddings_count", "history_count"]
+
 
 #INDEX
+conversation_index: ConversationIndex = None
+conversation_index_lock = threading.Lock()
+
+
+def get_conversation_index() -> ConversationIndex:
+    """
+    Returns the SQLite index of conversations. The first time it is opened the conversations of the old index.json are imported.
+    """
+    global conversation_index
+    
+    with conversation_index_lock:
+        if conversation_index is None:
+            conversation_index = ConversationIndex(os.path.join(json_local_path, "index.sqlite"))
+            conversation_index.import_index_json(os.path.join(json_local_path, "index.json"), read_metadata=read_conversation_metadata)
+        return conversation_index
+
+
+keyword_index: KeywordIndex = None
+keyword_index_lock = threading.Lock()
+
+#Keyword queries matching more messages than this rank only the most recent ones
+keyword_search_max_ranked = int(os.getenv("KEYWORD_SEARCH_MAX_RANKED", "5000"))
+
+
+def get_keyword_index() -> KeywordIndex:
+    """
+    Returns the full text index of the messages of every conversation (keywords.sqlite).
+    """
+    global keyword_index
+    
+    with keyword_index_lock:
+        if keyword_index is None:
+            keyword_index = KeywordIndex(os.path.join(json_local_path, "keywords.sqlite"), max_ranked=keyword_search_max_ranked)
+        return keyword_index
+
+
 def add_file_to_index(file_path: str, conversation_name: str) -> str:
     """
     Add file to index
     :return index_file_id
     """
     index_file_id = id_generator()
-    to_add = {"conversation_name":conversation_name, "file_path": file_path}
-    file_content: dict  = read_file_index()
-    file_content[index_file_id] = to_add
+    get_conversation_index().add(index_file_id, conversation_name, file_path, byte_size=get_conversation_byte_size(file_path))
     
-    if write_file_index(file_content): return index_file_id
+    return index_file_id
 
 
 def read_file_index() -> json:
@@ -38,46 +110,64 @@ def read_file_index() -> json:
         file_path
     }
     """
-    
-    index_file_path = os.path.join(json_local_path, "index.json")
-    if not os.path.exists(index_file_path):
-        raise HTTPException(status_code=404, detail="Index file no exist")
-    
-    try:
-        with open(index_file_path, "r", encoding="utf-8") as file:
-            return json.loads(file.read())
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=404, detail="File not reader.")  
+    return get_conversation_index().all()
 
 
-def write_file_index(content: dict) -> bool:
+def get_all_conversations_indexed(limit: int = None, cursor: str = None, sort: str = "updated") -> tuple[list, str | None]:
     """
-    Writes a new value to the index file and returns True if created
+    Return a list of conversations sorted from most to least recent with format {id, name, created, updated, turn_count, byte_size}
+    :param limit(optional): Conversations per page, all of them if None
+    :param cursor(optional): Cursor of the page returned by the previous call
+    :param sort(optional): updated or created
+    :return (conversation_list, next cursor or None)
     """
-    index_file_path = os.path.join(json_local_path, "index.json")
-    if not os.path.exists(index_file_path):
-        raise HTTPException(status_code=404, detail="File no fount")
-    
     try:
-        with open(index_file_path, "w", encoding="utf-8") as file:     
-            json.dump(content, file, indent=4, ensure_ascii=False)
-            return True
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=404, detail="File not found.")
+        conversations, next_cursor = get_conversation_index().list(limit=limit, cursor=cursor, sort=sort)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
+    conversation_list: list = [{
+        "id": conversation["id"], 
+        "name": conversation["name"],
+        "created": conversation["created"],
+        "updated": conversation["updated"],
+        "turn_count": conversation["turn_count"],
+        "byte_size": conversation["byte_size"]
+        } for conversation in conversations]
+
+    return conversation_list, next_cursor
+
 
-def get_all_conversations_indexed() -> json:
+def get_conversation_byte_size(file_path: str, content: dict = None) -> int:
     """
-    Return a list with id and conversations name for a index with format {id, name}
+    Size on disk of a conversation file and the files stored next to it.
     """
-    file_content: dict = read_file_index()
+    file_names = [os.path.basename(file_path)]
+    if content is not None:
+        file_names += [content.get(key) for key in ("embeddings_file", "history_journal_file", "state_file") if content.get(key)]
     
-    conversation_list: list = [{
-        "id": conversation, 
-        "name": file_content[conversation]["conversation_name"]
-        } for conversation in file_content]
+    paths = [get_conversation_side_file_path(file_path, file_name) for file_name in file_names]
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
 
-    return conversation_list
+
+def read_conversation_metadata(file_path: str) -> dict:
+    """
+    Metadata of a conversation file for the index, used when importing index.json.
+    :return {created, updated, turn_count, byte_size}
+    """
+    local_path = os.path.join(actual_path, file_path)
+    if not os.path.exists(local_path):
+        return {}
+    
+    content, _ = load_conversation_content(file_path)
+    updated = datetime.fromtimestamp(os.path.getmtime(local_path)).isoformat()
+    
+    return {
+        "created": content.get("timestamp") or updated,
+        "updated": updated,
+        "turn_count": len([message for message in content["full_history"] if message["role"] == "user"]),
+        "byte_size": get_conversation_byte_size(file_path, content)
+    }
 
 
 #FILE
@@ -90,9 +180,11 @@ def create_conversation_file(format_file_name: str, content: ContentFileTemplate
     messages_history: [{role, content}],
     resume_context,
     full_history: [{role, content}],
-    embeddings_vectors": [[]],
+    embeddings_file, embeddings_dim, embeddings_count,
+    history_journal_file, state_file, history_count,
     timestamp
     }
+    The embeddings_vectors received are stored in the binary embeddings file of the conversation.
     
     :Param format_file_name
     :Param content
@@ -101,16 +193,27 @@ def create_conversation_file(format_file_name: str, content: ContentFileTemplate
     
     file_path = f"{json_local_path}/{format_file_name}"
     
-    #Converts the BaseModel to dict
-    file_content = dict(content)
-    file_content["agent_config"] = dict(file_content["agent_config"])
+    embeddings_vectors = get_template_embeddings(content)
+    
+    #Converts the BaseModel to dict, nested models (agent_config, messages) included
+    file_content = content.model_dump(exclude={"embeddings_vectors", "embeddings_base64", "embeddings_dim"})
     
     file_content["agent_id"] = id_generator()
     file_content["timestamp"] = datetime.now().isoformat()
+    
+    file_content["embeddings_file"] = get_embeddings_file_name(format_file_name)
+    file_content["history_journal_file"] = get_history_journal_file_name(format_file_name)
+    file_content["state_file"] = get_state_file_name(format_file_name)
+    file_content["history_count"] = len(file_content["full_history"] or [])
 
     try:
-        with open(file_path, "w",  encoding="utf-8") as file:
-            json.dump(file_content, file, indent=4, ensure_ascii=False)
+        store = EmbeddingStore(os.path.join(json_local_path, file_content["embeddings_file"]))
+        if len(embeddings_vectors):
+            store.append(embeddings_vectors)
+        file_content["embeddings_dim"] = store.dim
+        file_content["embeddings_count"] = store.count
+        
+        write_file_atomically(file_path, dump_conversation_json(file_content))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error to create conversation file: {str(e)}")
@@ -118,92 +221,307 @@ def create_conversation_file(format_file_name: str, content: ContentFileTemplate
     return os.path.join(json_path, format_file_name)
 
 
-def add_embedding_to_conversation_file(file_id: str, embedding: np.ndarray):
+def dump_conversation_json(file_content: dict) -> bytes:
     """
-    Add new messages to the entire conversation history.
+    Serialize a conversation file. Without indentation, files are written and parsed several times faster.
     """
-    file_content: dict  = read_file_index()
-    
-    convert_embedding = embedding.tolist()
+    return json.dumps(file_content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+#EMBEDDINGS
+def decode_embeddings(data: bytes, dim: int) -> np.ndarray:
+    """
+    Embeddings from a buffer of float32 little-endian rows, without copying it.
+    :param data: Rows of dim values
+    :param dim: Dimension of the embeddings
+    :return array with shape (n, dim)
+    """
+    if not dim or dim <= 0:
+        raise HTTPException(status_code=400, detail="The embeddings dimension is required")
+    if len(data) % (4 * dim):
+        raise HTTPException(status_code=400, detail=f"{len(data)} bytes are not a whole number of float32 embeddings of dimension {dim}")
     
-    if(file_id not in file_content):
-        raise HTTPException(status_code=404, detail="File not found in index")
+    return np.frombuffer(data, dtype="<f4").reshape(-1, dim)
+
+
+def get_template_embeddings(content: ContentFileTemplate) -> np.ndarray:
+    """
+    Embeddings received with a new conversation, from embeddings_base64 when it is set or else from embeddings_vectors.
+    Row i is the embedding of message i of full_history, so there can't be more rows than messages.
+    :return float32 array with one row per message
+    """
+    if content.embeddings_base64:
+        try:
+            data = base64.b64decode(content.embeddings_base64, validate=True)
+        except binascii.Error:
+            raise HTTPException(status_code=400, detail="embeddings_base64 is not valid base64")
+        embeddings = decode_embeddings(data, content.embeddings_dim)
+    else:
+        dims = {len(vector) for vector in content.embeddings_vectors or []}
+        if len(dims) > 1 or 0 in dims:
+            raise HTTPException(status_code=400, detail="Every embedding of embeddings_vectors must have the same dimension")
+        embeddings = np.array(content.embeddings_vectors or [], dtype=np.float32)
     
-    file_path = file_content[file_id]["file_path"]
+    messages = len(content.full_history or [])
+    if len(embeddings) > messages:
+        raise HTTPException(status_code=400, detail=f"{len(embeddings)} embeddings for {messages} messages of full_history")
     
-    conversation_content = get_conversation_content(file_id)
-    conversation_content["embeddings_vectors"].append(convert_embedding)
-    add_conversation_file(file_path, conversation_content)
+    return embeddings
 
 
-def get_embeddings_of_conversation(file_id: str) -> List[np.ndarray]:
+def count_template_embeddings(content: ContentFileTemplate) -> int:
     """
-    Get all info from a file of a conversation if file exist.
-    :param file_id: Id in index
-    :return List[np.ndarray]
+    Number of embeddings received with a new conversation, without decoding them.
     """
+    if content.embeddings_base64 and content.embeddings_dim:
+        data_bytes = len(content.embeddings_base64) * 3 // 4 - content.embeddings_base64[-2:].count("=")
+        return data_bytes // (4 * content.embeddings_dim)
     
-    file_content: dict  = read_file_index()
-    if(file_id not in file_content):
-        raise HTTPException(status_code=404, detail="File not found in index")
-    
-    file_path = os.path.join(actual_path, file_content[file_id]["file_path"])
+    return len(content.embeddings_vectors or [])
 
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Conversation file no fount")
+
+def get_embeddings_file_name(conversation_file_name: str) -> str:
+    """
+    Name of the binary float32 file that keeps the embeddings of a conversation file.
+    """
+    return f"{os.path.splitext(os.path.basename(conversation_file_name))[0]}.emb.f32"
+
+
+def open_embedding_store(file_path: str, content: dict) -> EmbeddingStore:
+    """
+    Opens the embeddings file referenced by a conversation.
+    :param file_path: Conversation file path as stored in the index
+    :param content: Conversation content
+    """
+    if "embeddings_file" not in content:
+        content["embeddings_file"] = get_embeddings_file_name(file_path)
+        
+    store_path = os.path.join(actual_path, os.path.dirname(file_path), content["embeddings_file"])
+    return EmbeddingStore(store_path, dim=content.get("embeddings_dim", 0), count=content.get("embeddings_count", 0))
+
+
+def add_embedding_to_conversation_file(file_id: str, embedding: np.ndarray):
+    """
+    Add a new embedding to the conversation and write it to the file.
+    """
+    session = get_conversation_session(file_id)
+    session.add_embedding(embedding)
+    session.flush()
+
+
+def add_conversation_file(file_path: str, file_content):
+    """
+    Agrega informacion a un archivo de conversación existente.
+    The file is replaced atomically, a reader never sees it half written.
+    :Param file_name
+    :Param content
+    """
+    local_path = os.path.join(actual_path, file_path)
     
     try:
-        with open(file_path, "r", encoding="utf-8") as file:
-            file_content = json.loads(file.read())
-            embedding = file_content["embeddings_vectors"]
-            return embedding
+        write_file_atomically(local_path, dump_conversation_json(file_content))
         
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="File JSON corrupted")
-
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error to create file: {str(e)}")
     
-def get_full_history_of_conversation(file_id: str) -> dict:
+    return file_path
+
+
+def get_conversation_file_path(file_id: str) -> str:
     """
-    Get all info from a file of a conversation if file exist.
+    Returns the path of a conversation file as stored in the index.
     :param file_id: Id in index
-    :return full_history at format dict
     """
-    file_content: dict  = read_file_index()
-    if(file_id not in file_content):
+    conversation = get_conversation_index().get(file_id)
+    if(conversation is None):
         raise HTTPException(status_code=404, detail="Conversation file no fount")
     
-    file_path = os.path.join(actual_path, file_content[file_id]["file_path"])
+    file_path = conversation["file_path"]
 
-    if not os.path.exists(file_path):
+    if not os.path.exists(os.path.join(actual_path, file_path)) and find_conversation_archive(file_path) is None:
         raise HTTPException(status_code=404, detail="Conversation file no fount")
     
+    return file_path
+
+
+#HISTORY JOURNAL
+def get_history_journal_file_name(conversation_file_name: str) -> str:
+    """
+    Name of the JSONL file with the messages added to the full history since the last snapshot.
+    """
+    return f"{os.path.splitext(os.path.basename(conversation_file_name))[0]}.history.jsonl"
+
+
+def get_state_file_name(conversation_file_name: str) -> str:
+    """
+    Name of the small JSON file with the fields that change every turn (STATE_FIELDS).
+    """
+    return f"{os.path.splitext(os.path.basename(conversation_file_name))[0]}.state.json"
+
+
+def get_conversation_side_file_path(file_path: str, file_name: str) -> str:
+    """
+    Local path of a file stored next to a conversation file.
+    """
+    return os.path.join(actual_path, os.path.dirname(file_path), file_name)
+
+
+conversation_locks: dict[str, FileLock] = {}
+conversation_locks_lock = threading.Lock()
+
+
+def get_conversation_lock(file_path: str) -> FileLock:
+    """
+    Advisory lock (<id>.lock) held while a conversation is read or written, shared by every worker process.
+    :param file_path: Conversation file path as stored in the index
+    """
+    with conversation_locks_lock:
+        if file_path not in conversation_locks:
+            lock_name = f"{os.path.splitext(os.path.basename(file_path))[0]}.lock"
+            conversation_locks[file_path] = FileLock(get_conversation_side_file_path(file_path, lock_name))
+        return conversation_locks[file_path]
+
+
+def load_conversation_content(file_path: str) -> tuple[dict, HistoryJournal]:
+    """
+    Reads a conversation as one dict like the original file format: the snapshot in the conversation file,
+    the fields of the state file when it is newer than the snapshot and the messages of the history journal.
+    :param file_path: Conversation file path as stored in the index
+    :return (content, history journal)
+    """
+    with get_conversation_lock(file_path), timed_stage("storage_load"):
+        return _load_conversation_content(file_path)
+
+
+def _load_conversation_content(file_path: str) -> tuple[dict, HistoryJournal]:
+    #Archived conversations are decompressed on their first read
+    if not os.path.exists(os.path.join(actual_path, file_path)):
+        restore_conversation(file_path)
+    
     try:
-        with open(file_path, "r", encoding="utf-8") as file:
-            file_content = json.loads(file.read())
-            return file_content["full_history"]
-        
+        with open(os.path.join(actual_path, file_path), "r", encoding="utf-8") as file:
+            content = json.loads(file.read())
     except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="File JSON corrupted")    
+        raise HTTPException(status_code=400, detail="File JSON corrupted")
+    
+    content.setdefault("full_history", [])
+    snapshot_count = len(content["full_history"])
+    content.setdefault("history_count", snapshot_count)
+    
+    state_path = get_conversation_side_file_path(file_path, content.get("state_file", get_state_file_name(file_path)))
+    if os.path.exists(state_path):
+        with open(state_path, "r", encoding="utf-8") as file:
+            state = json.loads(file.read())
+        
+        #A state older than the snapshot is left by an interrupted compaction
+        if state.get("history_count", 0) >= content["history_count"]:
+            content.update(state)
+    
+    journal = HistoryJournal(get_conversation_side_file_path(file_path, content.get("history_journal_file", get_history_journal_file_name(file_path))))
+    content["full_history"].extend(journal.read(content["history_count"] - snapshot_count))
+    content["history_count"] = len(content["full_history"])
+    
+    return content, journal
 
 
-def add_conversation_file(file_path: str, file_content):
+def write_state_file(file_path: str, content: dict):
     """
-    Agrega informacion a un archivo de conversación existente
-    :Param file_name
-    :Param content
+    Writes the STATE_FIELDS of a conversation to its state file, replacing the previous one atomically.
+    :param file_path: Conversation file path as stored in the index
+    :param content: Conversation content
     """
-    local_path = os.path.join(actual_path, file_path)
+    state_path = get_conversation_side_file_path(file_path, content["state_file"])
+    state = {field: content.get(field) for field in STATE_FIELDS}
     
     try:
-        with open(local_path, "w",  encoding="utf-8") as file:
-            json.dump(file_content, file, indent=4, ensure_ascii=False)
+        write_file_atomically(state_path, json.dumps(state, ensure_ascii=False).encode("utf-8"))
         
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error to create file: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error to write the conversation state: {str(e)}")
+
+
+#ARCHIVE TIER
+def find_conversation_archive(file_path: str) -> str | None:
+    """
+    Local path of the archive of a conversation (<id>.tar.zst or <id>.tar.gz), None if it is not archived.
+    """
+    local_path = os.path.splitext(os.path.join(actual_path, file_path))[0]
+    for extension in ARCHIVE_EXTENSIONS.values():
+        if os.path.exists(local_path + extension):
+            return local_path + extension
+    return None
+
+
+def is_conversation_archived(file_id: str) -> bool:
+    conversation = get_conversation_index().get(file_id)
+    return conversation is not None and conversation["archived_size"] is not None
+
+
+def archive_conversation(file_id: str) -> dict | None:
+    """
+    Move a conversation that is not open in this process to the archive tier: the conversation file, its embeddings,
+    history journal and state file are compressed into a single archive and removed.
+    Conversations with messages still without embedding are left for the backfill.
+    :param file_id: Id in index
+    :return {id, byte_size, archived_size} or None if the conversation was not archived
+    """
+    file_path = get_conversation_file_path(file_id)
+    local_path = os.path.join(actual_path, file_path)
     
-    return file_path
+    #Sessions are loaded and added to conversation_sessions holding this lock
+    with get_conversation_lock(file_path), timed_stage("storage_archive"):
+        if file_id in conversation_sessions or not os.path.exists(local_path):
+            return None
+        
+        content, _ = _load_conversation_content(file_path)
+        if content.get("embeddings_count", 0) < content["history_count"]:
+            return None
+        
+        file_names = [os.path.basename(file_path)]
+        file_names += [content[key] for key in ("embeddings_file", "history_journal_file", "state_file") if content.get(key)]
+        paths = [path for path in (get_conversation_side_file_path(file_path, name) for name in file_names) if os.path.exists(path)]
+        byte_size = sum(os.path.getsize(path) for path in paths)
+        
+        archive_paths = [os.path.splitext(local_path)[0] + extension for extension in ARCHIVE_EXTENSIONS.values()]
+        archive_path = os.path.splitext(local_path)[0] + ARCHIVE_EXTENSIONS[archive_compression]
+        archive = write_archive(paths, archive_compression)
+        write_file_atomically(archive_path, archive)
+        
+        #The conversation file goes last: while it exists the archive is ignored
+        for path in [*reversed(paths), *archive_paths]:
+            if path != archive_path and os.path.exists(path):
+                os.remove(path)
+        
+        get_conversation_index().set_archived(file_path, len(archive), byte_size)
+    
+    return {"id": file_id, "byte_size": byte_size, "archived_size": len(archive)}
 
+
+def restore_conversation(file_path: str) -> bool:
+    """
+    Decompress an archived conversation next to its archive and remove the archive. Called holding the conversation lock.
+    :param file_path: Conversation file path as stored in the index
+    :return False if the conversation has no archive
+    """
+    archive_path = find_conversation_archive(file_path)
+    if archive_path is None:
+        return False
     
+    with timed_stage("storage_restore"):
+        files = read_archive(archive_path)
+        file_name = os.path.basename(file_path)
+        
+        #The conversation file is written last, an interrupted restore is done again on the next read
+        for name, data in files.items():
+            if name != file_name:
+                write_file_atomically(get_conversation_side_file_path(file_path, name), data)
+        write_file_atomically(os.path.join(actual_path, file_path), files[file_name])
+        os.remove(archive_path)
+        
+    get_conversation_index().set_archived(file_path, None)
+    return True
+
+
 # CONVERSATION
 def create_conversation(file_content: ContentFileTemplate) -> str:
     """
@@ -220,10 +538,15 @@ def create_conversation(file_content: ContentFileTemplate) -> str:
     and add to index.
     """
     
+    #Histories sent as null are stored as empty lists
+    file_content.full_history = file_content.full_history or []
+    file_content.messages_history = file_content.messages_history or []
+    
     format_file_name = f"{id_generator()}.json"
     
     file_path = create_conversation_file(format_file_name, file_content)
     conversation_id = add_file_to_index(file_path, conversation_name=file_content.conversation_name)
+    get_keyword_index().add_messages(conversation_id, 0, [message.model_dump() for message in file_content.full_history])
 
     return conversation_id
 
@@ -231,53 +554,525 @@ def create_conversation(file_content: ContentFileTemplate) -> str:
 def get_conversation_content(file_id: str) -> json:
     """
     Get all info from a file of a conversation if file exist.
+    If the conversation has an open session the in memory content is returned, which includes turns not flushed yet.
+    The embeddings are returned as embeddings_vectors lists like in the original file format.
     :param file_id: Id in index
     """
-    file_path = ""
-    file_content: dict  = read_file_index()
-    if(file_id in file_content):
-        file_path = os.path.join(actual_path, file_content[file_id]["file_path"])
+    session = get_conversation_session(file_id)
+    
+    with session.lock, timed_stage("storage_content"):
+        conversation_content = dict(session.content)
+        conversation_content["embeddings_vectors"] = session.embeddings_vectors.tolist()
+    
+    return conversation_content
 
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Conversation file no fount")
+
+def get_conversation_projection(file_id: str, fields: list = None, exclude: list = None, offset: int = 0, limit: int = None, last: int = None) -> tuple[dict, int]:
+    """
+    Get some fields of a conversation and a range of its full_history without copying the rest.
+    embeddings_vectors is returned as an array with the rows of the selected messages.
+    :param file_id: Id in index
+    :param fields(optional): Fields to return, all of them if None
+    :param exclude(optional): Fields not to return
+    :param offset(optional): First message of full_history
+    :param limit(optional): Maximum number of messages of full_history
+    :param last(optional): Return the last messages of full_history instead of offset/limit
+    :return (conversation, total number of messages of full_history)
+    """
+    session = get_conversation_session(file_id)
     
-    try:
-        with open(file_path, "r", encoding="utf-8") as file:
-            return json.loads(file.read())
+    with session.lock, timed_stage("storage_projection"):
+        content = session.content
+        names = [name for name in (fields or [*content.keys(), "embeddings_vectors"]) if name not in (exclude or [])]
         
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="File JSON corrupted")
+        total = len(content["full_history"])
+        start = max(0, total - last) if last is not None else min(offset, total)
+        end = total if last is not None or limit is None else min(total, start + limit)
+        
+        conversation_content = {}
+        for name in names:
+            if name == "full_history":
+                conversation_content[name] = content["full_history"][start:end]
+            elif name == "embeddings_vectors":
+                embeddings = session.embeddings_vectors
+                ranged = last is not None or offset or limit is not None
+                conversation_content[name] = embeddings[start:end] if ranged else embeddings
+            elif name in content:
+                conversation_content[name] = content[name]
+    
+    return conversation_content, total
+
+
+def iter_conversation_json(conversation_content: dict, chunk_items: int = 256):
+    """
+    Serialize a conversation to JSON in chunks, long lists and embeddings are never dumped at once.
+    :param conversation_content: Conversation from get_conversation_projection
+    :param chunk_items(optional): Messages or embeddings per chunk
+    """
+    dumps = lambda value: json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+    
+    yield b"{"
+    for i, (name, value) in enumerate(conversation_content.items()):
+        yield f'{"," if i else ""}{dumps(name)}:'.encode("utf-8")
+        
+        if not isinstance(value, (list, np.ndarray)):
+            yield dumps(value).encode("utf-8")
+            continue
+        
+        yield b"["
+        for first in range(0, len(value), chunk_items):
+            chunk = value[first:first + chunk_items]
+            items = chunk.tolist() if isinstance(chunk, np.ndarray) else chunk
+            yield (("," if first else "") + dumps(items)[1:-1]).encode("utf-8")
+        yield b"]"
+    yield b"}"
 
 
 def add_to_full_history_conversation_file(file_id: str, messages: list):
     """
     Add new messages to the entire conversation history
     """
-    file_content: dict  = read_file_index()
+    session = get_conversation_session(file_id)
+    session.add_to_full_history(messages)
+    session.flush()
+
+
+def update_message_to_conversation_file(file_id: str, messages: list):
+    """
+    Updates the message history that the agent has in memory to the conversation file
+    """
+    session = get_conversation_session(file_id)
+    session.update_messages_history(messages)
+    session.flush()
+
+
+#SESSIONS
+class ConversationSession():
+    """
+    Keeps a conversation loaded in memory (history, embeddings and messages_history) so a chat turn
+    does not parse and rewrite the whole file several times. Changes are written back to disk
+    following the flush policy:
+    - turn: one write per committed turn.
+    - every_n: one write every flush_every turns.
+    - idle: one write when no turn has been committed for idle_seconds.
+    A flush only appends: embeddings to the float32 file, messages to the history journal, and replaces
+    the small state file. The whole conversation file is rewritten when the journal is compacted.
     
-    if(file_id not in file_content):
-        raise HTTPException(status_code=404, detail="Conversation file no fount")
+    Writes hold the advisory lock of the conversation (<id>.lock) and first reload the conversation if
+    another process changed it, so several workers can write to the same conversation without losing turns.
+    """
+    def __init__(self, file_id: str, file_path: str, content: dict, history_journal: HistoryJournal, flush_policy: str = FLUSH_PER_TURN, flush_every: int = 5, idle_seconds: float = 30, compact_every: int = 500):
+        self.file_id = file_id
+        self.file_path = file_path
+        self.compact_every = compact_every
+        
+        self.flush_policy = flush_policy
+        self.flush_every = max(1, flush_every)
+        self.idle_seconds = idle_seconds
+        
+        self.lock = threading.RLock()
+        self.file_lock = get_conversation_lock(file_path)
+        self.dirty = False
+        self.closed = False
+        self.pending_turns = 0
+        self.idle_timer: threading.Timer = None
+        
+        #Times the conversation was reloaded because another process wrote it
+        self.reloads = 0
+        
+        self._set_content(content, history_journal)
+        self._migrate_embeddings_vectors()
+        
+    @property
+    def embeddings_vectors(self) -> np.ndarray:
+        #A flush moves the pending embeddings to the store, both are read holding the session lock
+        with self.lock:
+            stored = self.embedding_store.read()
+            if not self.pending_embeddings:
+                return stored
+            return np.vstack([stored, *self.pending_embeddings]) if len(stored) else np.vstack(self.pending_embeddings)
+    
+    @property
+    def retrieval_engine(self) -> RetrievalEngine:
+        """
+        Normalized embeddings of the conversation, built on first use and grown with every new embedding.
+        """
+        with self.lock:
+            if self._retrieval_engine is None:
+                self._retrieval_engine = RetrievalEngine(
+                    dim=self.embedding_store.dim, quantization=embedding_quantization,
+                    full_precision=self.embedding_rows, rerank_factor=embedding_rerank_factor
+                    )
+                self._retrieval_engine.add(self.embeddings_vectors)
+            return self._retrieval_engine
+    
+    def embedding_rows(self, positions: np.ndarray) -> np.ndarray:
+        """
+        Embeddings at some positions, read from the embeddings file and the pending embeddings without copying the rest.
+        Called by the retrieval engine to re-rank, holding the session lock so a flush doesn't move the pending rows meanwhile.
+        """
+        with self.lock:
+            stored = self.embedding_store.read()
+            if not self.pending_embeddings:
+                return np.asarray(stored[positions])
+            
+            pending = np.vstack(self.pending_embeddings)
+            rows = np.empty((len(positions), pending.shape[1]), dtype=np.float32)
+            in_store = positions < len(stored)
+            rows[in_store] = stored[positions[in_store]]
+            rows[~in_store] = pending[positions[~in_store] - len(stored)]
+            return rows
+    
+    @property
+    def embeddings_count(self) -> int:
+        return len(self.embedding_store) + sum(1 if embedding.ndim == 1 else len(embedding) for embedding in self.pending_embeddings)
+    
+    @property
+    def full_history(self) -> list:
+        return self.content["full_history"]
+    
+    @property
+    def messages_history(self) -> list:
+        return self.content["messages_history"]
+        
+    def add_embedding(self, embedding: np.ndarray):
+        """
+        Add an embedding to the conversation in memory.
+        """
+        with self.lock:
+            self.pending_embeddings.append(np.asarray(embedding, dtype=np.float32))
+            if self._retrieval_engine is not None:
+                self._retrieval_engine.add(embedding)
+            self.dirty = True
+    
+    def add_to_full_history(self, messages: list):
+        """
+        Add messages to the full history in memory.
+        """
+        with self.lock:
+            self.content["full_history"].extend(messages)
+            self.pending_messages.extend(messages)
+            self.dirty = True
+            
+    def update_messages_history(self, messages: list):
+        """
+        Replace the messages history that the agent has in memory.
+        """
+        with self.lock:
+            self.content["messages_history"] = list(messages)
+            self.pending_fields["messages_history"] = self.content["messages_history"]
+            self.dirty = True
+            
+    def missing_embeddings(self) -> tuple[int, list]:
+        """
+        Messages of the full history without embedding, created with a pre-filled history or imported.
+        :return (position of the first message without embedding, messages from it)
+        """
+        with self.lock:
+            start = self.embeddings_count
+            return start, self.full_history[start:]
+    
+    def add_missing_embeddings(self, start: int, embeddings: np.ndarray) -> bool:
+        """
+        Write the embeddings of the messages from position start, if no one else has added them meanwhile.
+        :return False if the embeddings count is not start anymore and nothing was added
+        """
+        with self.lock, self.file_lock:
+            if multi_worker:
+                self.refresh()
+            if self.embeddings_count != start or start + len(embeddings) > len(self.full_history):
+                return False
+            
+            self.add_embedding(np.asarray(embeddings, dtype=np.float32))
+            self.flush()
+            return True
+    
+    def memory_bytes(self) -> int:
+        """
+        Approximate memory of the embeddings held by the session.
+        """
+        engine_bytes = self._retrieval_engine.nbytes if self._retrieval_engine is not None else 0
+        return engine_bytes + sum(embedding.nbytes for embedding in self.pending_embeddings)
+    
+    def update_resume_context(self, resume_context: str):
+        """
+        Replace the summary of the conversation. It is written with the next flush.
+        """
+        with self.lock:
+            self.content["resume_context"] = resume_context
+            self.pending_fields["resume_context"] = resume_context
+            self.dirty = True
+            
+            if self.closed or multi_worker:
+                self.flush()
+            elif self.flush_policy == FLUSH_ON_IDLE:
+                self._schedule_idle_flush()
+            
+    def commit_turn(self, messages: list, messages_history: list, embeddings: list = None) -> tuple[int, bool]:
+        """
+        Record a complete chat turn and persist it according to the flush policy.
+        :param messages: New messages for the full history
+        :param messages_history: Message history of the agent after the turn
+        :param embeddings(optional): One embedding per message
+        :return (position of the first message in the full history, True if the embeddings were stored)
+        """
+        with self.lock, self.file_lock:
+            if multi_worker:
+                self.refresh()
+            
+            first_position = len(self.content["full_history"])
+            
+            #Messages before this turn still without embeddings: the turn embeddings are left to the backfill
+            #so row i of the embeddings keeps belonging to message i
+            embedded = bool(embeddings) and self.embeddings_count >= first_position
+            if embedded:
+                for embedding in embeddings:
+                    self.add_embedding(embedding)
+            self.add_to_full_history(messages)
+            self.update_messages_history(messages_history)
+            self.pending_turns += 1
+            
+            #A closed session is no longer flushed on shutdown, its turns are written right away
+            if self.closed or multi_worker:
+                self.flush()
+            elif self.flush_policy == FLUSH_ON_IDLE:
+                self._schedule_idle_flush()
+            elif self.flush_policy == FLUSH_EVERY_N_TURNS and self.pending_turns < self.flush_every:
+                pass
+            else:
+                self.flush()
+                
+            return first_position, embedded
+    
+    def refresh(self) -> bool:
+        """
+        Reload the conversation if another process wrote it since this session last read or wrote it.
+        Changes not flushed yet are kept on top of the reloaded conversation.
+        :return True if the conversation was reloaded
+        """
+        with self.lock, self.file_lock:
+            if self._state_stamp() == self.state_stamp:
+                return False
+            
+            content, history_journal = load_conversation_content(self.file_path)
+            pending_embeddings = self.pending_embeddings
+            pending_messages = self.pending_messages
+            pending_fields = self.pending_fields
+            
+            self._set_content(content, history_journal)
+            
+            self.pending_embeddings = pending_embeddings
+            self.pending_messages = pending_messages
+            self.pending_fields = pending_fields
+            self.content["full_history"].extend(pending_messages)
+            self.content.update(pending_fields)
+            
+            self.reloads += 1
+            return True
     
-    file_path = os.path.join(actual_path, file_content[file_id]["file_path"])
-    conversation_content = get_conversation_content(file_id)
+    def flush(self):
+        """
+        Write the conversation to disk if there are pending changes.
+        """
+        with self.lock, self.file_lock:
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+                self.idle_timer = None
+            
+            if not self.dirty:
+                return
+            
+            with timed_stage("storage_flush"):
+                self.refresh()
+            
+                if self.pending_embeddings:
+                    self.embedding_store.append(np.vstack(self.pending_embeddings))
+                    self.pending_embeddings = []
+                
+                if self.pending_messages:
+                    self.history_journal.append(self.pending_messages)
+                    get_keyword_index().add_messages(
+                        self.file_id, len(self.content["full_history"]) - len(self.pending_messages), self.pending_messages
+                        )
+                    self.pending_messages = []
+            
+                self.content["embeddings_dim"] = self.embedding_store.dim
+                self.content["embeddings_count"] = self.embedding_store.count
+                self.content["history_count"] = len(self.content["full_history"])
+            
+                if self.needs_compaction or len(self.history_journal) >= self.compact_every:
+                    self.compact()
+                else:
+                    write_state_file(self.file_path, self.content)
+                    self.state_stamp = self._state_stamp()
+            
+                get_conversation_index().update_conversation(
+                    self.file_id, 
+                    turns_added=self.pending_turns, 
+                    byte_size=get_conversation_byte_size(self.file_path, self.content)
+                    )
+            
+                self.pending_fields = {}
+                self.dirty = False
+                self.pending_turns = 0
+    
+    def compact(self):
+        """
+        Fold the history journal into the conversation file: the whole conversation is written as a new snapshot
+        and the journal is emptied.
+        """
+        with self.lock, self.file_lock, timed_stage("storage_compact"):
+            #The files may have been written by another process, or archived, since this session read them
+            self.refresh()
+            add_conversation_file(self.file_path, self.content)
+            self.history_journal.clear()
+            write_state_file(self.file_path, self.content)
+            self.state_stamp = self._state_stamp()
+            self.needs_compaction = False
+    
+    def _set_content(self, content: dict, history_journal: HistoryJournal):
+        self.content = content
+        self.history_journal = history_journal
+        self.embedding_store = open_embedding_store(self.file_path, content)
+        self.pending_embeddings: list[np.ndarray] = []
+        self.pending_messages: list = []
+        self.pending_fields: dict = {}
+        self._retrieval_engine: RetrievalEngine = None
+        
+        #Files created before the history journal get their names with the first compaction
+        self.needs_compaction = "state_file" not in content
+        content.setdefault("history_journal_file", get_history_journal_file_name(self.file_path))
+        content.setdefault("state_file", get_state_file_name(self.file_path))
+        
+        self.state_stamp = self._state_stamp()
+    
+    def _state_stamp(self) -> tuple | None:
+        """
+        Identifies the last write of the state file, every write replaces the file with a new one.
+        """
+        try:
+            stat = os.stat(get_conversation_side_file_path(self.file_path, self.content["state_file"]))
+            return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+    
+    def _migrate_embeddings_vectors(self):
+        """
+        Drops the embeddings_vectors lists of files created before the binary embeddings file.
+        Those files kept one embedding per turn (of the user message without its context) instead of one per message
+        of full_history, so their rows can't be matched to the messages: every message is embedded again by the backfill.
+        """
+        embeddings_vectors = self.content.pop("embeddings_vectors", None)
+        
+        if embeddings_vectors is not None or "embeddings_count" not in self.content:
+            self.needs_compaction = True
+        
+        self.dirty = self.dirty or self.needs_compaction
     
-    conversation_content["full_history"].extend(messages)
+    def _schedule_idle_flush(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            
+        self.idle_timer = threading.Timer(self.idle_seconds, self.flush)
+        self.idle_timer.daemon = True
+        self.idle_timer.start()
 
-    add_conversation_file(file_path, conversation_content)
 
+conversation_sessions: dict[str, ConversationSession] = {}
+conversation_sessions_lock = threading.Lock()
 
-def update_message_to_conversation_file(file_id: str, messages: list):
+
+def get_conversation_session(file_id: str) -> ConversationSession:
     """
-    Updates the message history that the agent has in memory to the conversation file
+    Returns the session of a conversation, loading the file only the first time.
+    The file is loaded holding only the lock of its conversation, so a large or archived conversation
+    does not stop other conversations from getting their sessions.
+    At most conversation_hot_set sessions are kept, the least recently used ones are closed.
+    :param file_id: Id in index
     """
-    file_content: dict  = read_file_index()
+    with conversation_sessions_lock:
+        session = conversation_sessions.pop(file_id, None)
+        if session is not None:
+            conversation_sessions[file_id] = session
+            return session
     
-    if(file_id not in file_content):
-        raise HTTPException(status_code=404, detail="Conversation file no fount")
-
-    file_path = os.path.join(file_content[file_id]["file_path"])
+    file_path = get_conversation_file_path(file_id)
     
-    conversation_content = get_conversation_content(file_id)
-    conversation_content["messages_history"] = messages
+    with get_conversation_lock(file_path):
+        #Another thread may have loaded it while this one waited for the conversation lock
+        with conversation_sessions_lock:
+            session = conversation_sessions.get(file_id)
+        
+        if session is None:
+            content, history_journal = load_conversation_content(file_path)
+            session = ConversationSession(
+                file_id, file_path, content, history_journal,
+                flush_policy=session_flush_policy, 
+                flush_every=session_flush_every, 
+                idle_seconds=session_idle_seconds,
+                compact_every=history_compact_every
+                )
+            #Files in the old format are rewritten once in the current one
+            session.flush()
+        
+        #Added holding the conversation lock, so archive_conversation never archives an open conversation
+        with conversation_sessions_lock:
+            session = conversation_sessions.setdefault(file_id, session)
+            evicted = list(conversation_sessions)[:max(0, len(conversation_sessions) - max(1, conversation_hot_set))]
+    
+    get_conversation_index().touch(file_id)
+    
+    for evicted_id in evicted:
+        close_conversation_session(evicted_id)
+    
+    return session
+
+
+def close_conversation_session(file_id: str):
+    """
+    Flush a session, fold its history journal into the conversation file and remove it from memory.
+    :param file_id: Id in index
+    """
+    with conversation_sessions_lock:
+        session = conversation_sessions.pop(file_id, None)
+        
+    if session is not None:
+        session.closed = True
+        session.flush()
+        if len(session.history_journal):
+            session.compact()
+        get_conversation_index().touch(file_id)
+
+
+def migrate_all_conversations_embeddings() -> int:
+    """
+    Rewrites every indexed conversation in the old format in the current one, their messages are left to the backfill.
+    Archived conversations are left archived, they are migrated when they are restored.
+    :return number of conversations opened
+    """
+    file_ids = [file_id for file_id in read_file_index() if not is_conversation_archived(file_id)]
     
-    add_conversation_file(file_path, conversation_content)
\ No newline at end of file
+    for file_id in file_ids:
+        get_conversation_session(file_id)
+        
+    return len(file_ids)
+
+
+def flush_all_sessions():
+    """
+    Writes every session with pending changes to disk. Used on shutdown.
+    """
+    with conversation_sessions_lock:
+        sessions = list(conversation_sessions.values())
+        
+    for session in sessions:
+        session.flush()
+
+
+if __name__ == "__main__":
+    #python -m routers.file_manager migrate-embeddings
+    if sys.argv[1:] == ["migrate-embeddings"]:
+        print(migrate_all_conversations_embeddings())
+        flush_all_sessions()
+    else:
+        print("Usage: python -m routers.file_manager migrate-embeddings")
@@ -1,53 +1,89 @@
-import json, os
+import json, os, asyncio
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import StreamingResponse
 
 from calculations.utilities import id_generator
 
 from classes.agent import Agent
+from classes.agent_functions import request_scheduler, model_residency, EMBEDDING_MODEL
+from classes.agent_cache import AgentCache, estimate_agent_size
+from classes.agent_registry import AgentRegistry
+from classes.chat_stream import ChatStreamingResponse, sse_batches, asse_batches
 
 from models.models import Conversation_Chat, AgentModel, AgentModelPut
 
-from routers.file_manager import get_conversation_content
+from routers.file_manager import get_conversation_session, close_conversation_session, conversation_sessions, multi_worker
 
 IAAgents = APIRouter()
 
-#KEEP THE AGENT IN MEMORY
-active_agents = {}
+
+def estimate_conversation_size(agent: Agent) -> int:
+    """
+    Memory of an agent plus the embeddings its conversation session keeps loaded.
+    """
+    session = conversation_sessions.get(agent.file_id)
+    return estimate_agent_size(agent) + (session.memory_bytes() if session is not None else 0)
+
+
+def release_agent(agent_id: str, agent: Agent):
+    """
+    Called when an agent leaves the cache, its conversation is flushed and unloaded too.
+    """
+    close_conversation_session(agent.file_id)
+
+
+#KEEP THE AGENTS IN MEMORY, bounded by number, memory and idle time. Evicted agents are rebuilt from their conversation file.
+active_agents = AgentCache(
+    max_entries=int(os.getenv("AGENT_CACHE_MAX_ENTRIES", "256")),
+    max_bytes=int(os.getenv("AGENT_CACHE_MAX_MB", "512")) * 1024 * 1024,
+    idle_ttl=float(os.getenv("AGENT_CACHE_IDLE_SECONDS", "1800")),
+    on_evict=release_agent,
+    size_of=estimate_conversation_size
+    )
 
 this_path = os.path.dirname(__file__)
 default_agent_path = os.path.join(this_path, "..", "default_agent", "default_agents.json")
 
 
+#SSE responses join the chunks of the model in frames of at most SSE_BATCH_MS milliseconds or SSE_BATCH_CHARS characters
+sse_batch_seconds = float(os.getenv("SSE_BATCH_MS", "50")) / 1000
+sse_batch_chars = int(os.getenv("SSE_BATCH_CHARS", "512"))
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+#AGENTS OF default_agents.json, kept in memory and read again only when the file changes
+agent_registry = AgentRegistry(default_agent_path)
+
+#The models of the configured agents are kept loaded
+model_residency.add_pinned_source(lambda: [agent.get("model") for agent in agent_registry.list()])
+
+
 # FILE
 def get_agents_from_file() -> list:
     """
-    Returns the agents stored in the default_agents.json file
+    Returns the agents stored in the default_agents.json file with format: id, name, resume, model
     """
-    if not os.path.exists(default_agent_path):
-        raise HTTPException(status_code=404, detail="Agents file no fount")
-
     try:
-        with open(default_agent_path, "r", encoding="utf-8") as agents:
-            return json.load(agents)
+        return agent_registry.list()
     except FileNotFoundError:
-        raise HTTPException(status_code=400, detail="File not found")
+        raise HTTPException(status_code=404, detail="Agents file no fount")
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="File default agents corrupted")
 
 
-def change_agent_file(file_content: list):
+def change_agent_file(change, *args):
     """
-    Modify and add data to the agent file
-    :param file_content
+    Apply a change of the agent registry, it is written to the agent file
+    :param change: Method of agent_registry
     """
-    if not os.path.exists(default_agent_path):
-        raise HTTPException(status_code=404, detail="Agents file not fount")
-
     try:
-        with open(default_agent_path, "w", encoding="utf-8") as file:
-            json.dump(file_content, file, indent=4, ensure_ascii=False)
-            
+        return change(*args)
     except FileNotFoundError:
-        raise HTTPException(status_code=400, detail="File not found")
+        raise HTTPException(status_code=404, detail="Agents file not fount")
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="File default agents corrupted")
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Agent not found")
        
     
 #AGENT       
@@ -56,21 +92,7 @@ def get_ollama_local_agents() -> list:
     """
     Returns a list of agents with a format: id, name, resume, model
     """
-    
-    agent_list: dict  = get_agents_from_file()
-
-    try:
-        agent_list: list = [{
-            "id":agent.get("id"), 
-            "name":agent.get("name"), 
-            "resume":agent.get("resume"), 
-            "model":agent.get("model")
-            } for agent in get_agents_from_file()]
-            
-        return agent_list
-    
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="File default agents corrupted")
+    return get_agents_from_file()
 
 
 @IAAgents.post("/agent", tags=["Agents"])
@@ -82,11 +104,8 @@ def add_ollama_local_agents(agent: AgentModel) -> dict:
     """
     
     agent.id = id_generator()
-   
-    file_content: list  = get_agents_from_file()
-    file_content.append(dict(agent))
     
-    change_agent_file(file_content)
+    change_agent_file(agent_registry.add, agent.model_dump())
     
     return {"message": "Agent added"}
 
@@ -99,24 +118,9 @@ def update_ollama_local_agent(id: str, agent: AgentModelPut) -> dict:
     :param agent
     """
     
-    file_content = get_agents_from_file()
+    changes = {"name": agent.name, "resume": agent.resume, "prompt": agent.prompt, "model": agent.model}
 
-    for i, local_agent in enumerate(file_content):
-        if local_agent["id"] == id:
-            break 
-    else:
-        raise HTTPException(status_code=404, detail="Agent not found")
-
-    updated_agent = local_agent.copy()
-
-    updated_agent["name"] = agent.name if agent.name is not None else local_agent.get("name", agent.name)
-    updated_agent["resume"] = agent.resume if agent.resume is not None else local_agent.get("resume", agent.resume)
-    updated_agent["prompt"] = agent.prompt if agent.prompt is not None else local_agent.get("prompt", agent.prompt)
-    updated_agent["model"] = agent.model if agent.model is not None else local_agent.get("model", agent.model)
-
-    if updated_agent != local_agent:
-        file_content[i] = updated_agent
-        change_agent_file(file_content)
+    if change_agent_file(agent_registry.update, id, changes):
         return {"message": "Agent updated"}
     
     return {"message": "Agent not updated"}
@@ -128,26 +132,29 @@ def delete_ollama_local_agent(id: str) -> dict:
     Delete an agent.
     :param id
     """
-    file_content: list  = get_agents_from_file()
-    
-    new_file_content = [agent for agent in file_content if agent["id"] != id]
-    
-    if(len(new_file_content) == len(file_content)):
-        raise HTTPException(status_code=404, detail="Agent not fount")
-    
-    change_agent_file(new_file_content)
+    change_agent_file(agent_registry.delete, id)
     return {"message": "Agent deleted"}
 
 
+@IAAgents.get("/agents/cache", tags=["Agents"])
+def get_agent_cache_stats() -> dict:
+    """
+    Returns the size of the cache of agents in memory and its hit, miss and eviction counters,
+    and how many times the agent registry read and wrote default_agents.json.
+    """
+    return {**active_agents.get_stats(), "registry": agent_registry.get_stats()}
+
+
 #CHAT
-def chat_with_agent(conversation: Conversation_Chat) -> StreamingResponse:
+def get_conversation_agent(conversation_id: str) -> Agent:
     """
-    Returns the response of an agent in stream format taking the agent configuration from a conversation file by its id and keeping the agent in memory.
-    :param conversation: {conversation_id: str, message: str}
+    Returns the agent of a conversation taking its configuration from the conversation file and keeping the agent in memory.
+    :param conversation_id: Id in index
     """
-    
-    agent: Agent = None
-    conversation_content = get_conversation_content(conversation.conversation_id)
+    session = get_conversation_session(conversation_id)
+    if multi_worker:
+        session.refresh()
+    conversation_content = session.content
     
     agent_id: str = conversation_content["agent_id"]
     
@@ -159,15 +166,59 @@ def chat_with_agent(conversation: Conversation_Chat) -> StreamingResponse:
         'max_history': conversation_content["agent_config"]["max_history"], 
         'summary_model': conversation_content["agent_config"]["summary_model"],
         'chat_history': conversation_content["messages_history"],
-        'file_id': conversation.conversation_id
+        'resume_context': conversation_content.get("resume_context", ""),
+        'file_id': conversation_id
         }
 
     #Keeps agents in memory
-    if(agent_id not in active_agents):
+    agent = active_agents.get(agent_id)
+    
+    #An agent whose conversation was changed by another worker is rebuilt from the conversation
+    if agent is None or agent.conversation_reloads != session.reloads:
         agent = Agent(**agent_config)
-        active_agents[agent_id] = agent
+        agent.conversation_reloads = session.reloads
+        active_agents.put(agent_id, agent)
+    else:
+        active_agents.update_size(agent_id)
         
-    agent = active_agents[agent_id]
+    return agent
+
+
+def check_chat_admission(agent: Agent):
+    """
+    A streamed response can't change its status once started, so the request scheduler is asked before
+    streaming whether the chat and embedding requests would be admitted. Raises SchedulerOverloaded (429) if not.
+    """
+    request_scheduler.check_admission(EMBEDDING_MODEL)
+    request_scheduler.check_admission(agent.model)
+
+
+def chat_with_agent(conversation: Conversation_Chat, sse: bool = False) -> ChatStreamingResponse:
+    """
+    Returns the response of an agent in stream format taking the agent configuration from a conversation file by its id and keeping the agent in memory.
+    The response is generated in a threadpool worker. If the client disconnects the generation is stopped.
+    :param conversation: {conversation_id: str, message: str}
+    :param sse(optional): Stream server-sent events with the chunks joined in batches instead of plain text
+    """
+    agent: Agent = get_conversation_agent(conversation.conversation_id)
+    check_chat_admission(agent)
+    
+    if sse:
+        return ChatStreamingResponse(sse_batches(agent.generate_response(conversation.message), sse_batch_seconds, sse_batch_chars), media_type="text/event-stream", headers=SSE_HEADERS)
+    
+    return ChatStreamingResponse(agent.generate_response(conversation.message), media_type="text/plain")
+
+
+async def chat_with_agent_async(conversation: Conversation_Chat, sse: bool = False) -> ChatStreamingResponse:
+    """
+    Async version of chat_with_agent, the response is generated on the event loop without holding a threadpool worker.
+    :param conversation: {conversation_id: str, message: str}
+    :param sse(optional): Stream server-sent events with the chunks joined in batches instead of plain text
+    """
+    agent: Agent = await asyncio.to_thread(get_conversation_agent, conversation.conversation_id)
+    check_chat_admission(agent)
+    
+    if sse:
+        return ChatStreamingResponse(asse_batches(agent.agenerate_response(conversation.message), sse_batch_seconds, sse_batch_chars), media_type="text/event-stream", headers=SSE_HEADERS)
     
-    return StreamingResponse(agent.generate_response(conversation.message), media_type="text/plain")
-    
\ No newline at end of file
+    return ChatStreamingResponse(agent.agenerate_response(conversation.message), media_type="text/plain")
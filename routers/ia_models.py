@@ -1,23 +1,69 @@
 from fastapi import APIRouter, HTTPException
-from ollama import list as ollamaList
+
+from classes.agent_functions import embedding_cache, model_inventory, request_scheduler, model_residency
 
 IAModels = APIRouter()
 
 
 @IAModels.get("/models", tags=["Models"])
-def get_ollama_intalled_models() -> list[str] | str:
+def get_ollama_intalled_models(details: bool = False) -> list[str] | list[dict]:
     """
-    Returns the list of all installed ollama models installed
+    Returns the list of all installed ollama models installed, from the model inventory cache.
+    :param details(optional): Return {model, size, family, parameter_size, quantization_level, modified_at} instead of the names
     """
     try:
-        model_data: dict = ollamaList().models 
+        model_data: list = model_inventory.get()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error loading ollama models: {str(e)}")
+
+    if(len(model_data) == 0):
+        raise HTTPException(status_code=404, detail="There are no ollama models installed.")
 
-        if(len(model_data) == 0):
-            raise HTTPException(status_code=404, detail="There are no ollama models installed.")
-        
-        modelList: list = [element.model for element in model_data]
-        return modelList
+    if details:
+        return model_data
 
+    modelList: list = [element["model"] for element in model_data]
+    return modelList
+
+
+@IAModels.get("/models/cache", tags=["Models"])
+def get_model_inventory_stats() -> dict:
+    """
+    Returns the hit, fetch and invalidation counters of the model inventory cache
+    """
+    return model_inventory.get_stats()
+
+
+@IAModels.post("/models/refresh", tags=["Models"])
+def refresh_model_inventory() -> list[dict]:
+    """
+    Fetch the installed models from ollama now, after pulling or removing a model
+    """
+    try:
+        return model_inventory.refresh()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error loading ollama models: {str(e)}")
-    
\ No newline at end of file
+
+
+@IAModels.get("/embeddings/cache", tags=["Models"])
+def get_embedding_cache_stats() -> dict:
+    """
+    Returns the hit and miss counters and the size of the embedding cache
+    """
+    return embedding_cache.get_stats()
+
+
+@IAModels.get("/scheduler", tags=["Models"])
+def get_request_scheduler_stats() -> dict:
+    """
+    Returns the queue depth, running requests per model, wait times and rejections of the request scheduler
+    """
+    return request_scheduler.get_stats()
+
+
+@IAModels.get("/models/residency", tags=["Models"])
+def get_model_residency() -> dict:
+    """
+    Returns the loaded models, the models kept warm, their recent traffic and the last load and unload events
+    """
+    return model_residency.get_stats()
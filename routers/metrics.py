@@ -0,0 +1,54 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from classes.agent import context_builder
+from classes.agent_functions import embedding_cache, request_scheduler, model_residency
+from classes.metrics import metrics
+
+from routers.file_manager import conversation_sessions, get_conversation_index
+
+Metrics = APIRouter()
+
+#Content type of the Prometheus text exposition format
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+#The counters kept by the other components are read when the metrics are scraped
+metrics.gauge("scheduler_queue_depth", "Requests waiting in the request scheduler.", lambda: request_scheduler.get_stats()["queue_depth"])
+metrics.gauge(
+    "scheduler_running_requests", "Requests to ollama running per model.",
+    lambda: {model: stats["running"] for model, stats in request_scheduler.get_stats()["models"].items()}, ["model"]
+    )
+metrics.gauge(
+    "scheduler_requests_total", "Requests admitted, queued and rejected by the request scheduler.",
+    lambda: {key: value for key, value in request_scheduler.get_stats().items() if key in request_scheduler.stats}, ["outcome"], kind="counter"
+    )
+metrics.gauge(
+    "embedding_cache_lookups_total", "Lookups of the embedding cache by result.",
+    lambda: {key: embedding_cache.get_stats()[key] for key in ("memory_hits", "disk_hits", "misses")}, ["result"], kind="counter"
+    )
+metrics.gauge(
+    "context_builder_events_total", "Prompts built, history trims and context truncations of the context builder.",
+    lambda: {key: value for key, value in context_builder.get_stats().items() if key != "chars_per_token"}, ["event"], kind="counter"
+    )
+metrics.gauge("conversation_sessions_open", "Conversations loaded in memory.", lambda: len(conversation_sessions))
+metrics.gauge("conversations_archived", "Conversations in the archive tier.", lambda: get_conversation_index().archive_stats()["archived"])
+metrics.gauge(
+    "conversation_archive_bytes", "Size of the archived conversations before and after compression.",
+    lambda: {size: get_conversation_index().archive_stats()[f"{size}_bytes"] for size in ("original", "archived")}, ["size"]
+    )
+metrics.gauge("models_loaded_bytes", "Memory of the models loaded in ollama.", lambda: model_residency.get_stats()["loaded_bytes"])
+metrics.gauge(
+    "model_residency_events_total", "Models loaded, kept alive, unloaded and expired by the model residency manager.",
+    lambda: {key: value for key, value in model_residency.get_stats().items() if key in model_residency.stats}, ["event"], kind="counter"
+    )
+
+
+#ENDPOINTS
+@Metrics.get("/metrics", tags=["Config"], response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Returns the stage durations, time to first token and tokens per second per model and the counters
+    of the scheduler and caches in the Prometheus text format.
+    """
+    return PlainTextResponse(metrics.render(), media_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,209 @@
+import os, sys, time, shutil, threading, logging
+import numpy as np
+from fastapi import APIRouter, Query
+
+from classes.agent_functions import generate_embedding
+from classes.message_search_index import MessageSearchIndex
+
+from routers.file_manager import (json_local_path, read_file_index, get_conversation_file_path, get_conversation_lock, load_conversation_content,
+                                  open_embedding_store, flush_all_sessions, find_conversation_archive, archive_conversation,
+                                  embedding_quantization, embedding_rerank_factor, get_keyword_index)
+
+Search = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+search_index_path = os.path.join(json_local_path, "search_index")
+search_index_probes = int(os.getenv("SEARCH_INDEX_PROBES", "8"))
+
+search_index: MessageSearchIndex = None
+search_index_lock = threading.Lock()
+search_rebuild_lock = threading.Lock()
+
+
+#INDEX
+def get_search_index() -> MessageSearchIndex:
+    """
+    Returns the search index over the messages of every conversation, loading it on first use.
+    """
+    global search_index
+    
+    with search_index_lock:
+        if search_index is None:
+            search_index = MessageSearchIndex(
+                search_index_path, n_probe=search_index_probes, quantization=embedding_quantization, rerank_factor=embedding_rerank_factor
+                )
+        return search_index
+
+
+def add_messages_to_search_index(conversation_id: str, first_position: int, embeddings: np.ndarray, messages: list):
+    """
+    Add new messages of a conversation with their embeddings to the search index.
+    :param conversation_id: Id in index
+    :param first_position: Position in full_history of the first message
+    :param embeddings: One embedding per message
+    :param messages: Messages with format {role, content}
+    """
+    get_search_index().add_messages(conversation_id, first_position, embeddings, messages)
+
+
+def rebuild_search_index() -> dict:
+    """
+    Index again the messages of every conversation file. The new index is built apart and replaces the current one when finished.
+    Messages added to the current index while the new one is built are copied to it before the replacement.
+    :return {conversations, messages}
+    """
+    with search_rebuild_lock:
+        flush_all_sessions()
+        
+        current_index = get_search_index()
+        since = len(current_index)
+        
+        building_path = f"{search_index_path}.building"
+        shutil.rmtree(building_path, ignore_errors=True)
+        new_index = MessageSearchIndex(
+            building_path, n_probe=search_index_probes, quantization=embedding_quantization, rerank_factor=embedding_rerank_factor,
+            train_in_background=False
+            )
+        
+        conversations = 0
+        #Messages of every conversation in the new index, the ones added to the current index after them are copied at the end
+        indexed = {}
+        for file_id in read_file_index():
+            file_path = get_conversation_file_path(file_id)
+            archived = find_conversation_archive(file_path) is not None
+            
+            with get_conversation_lock(file_path):
+                content, _ = load_conversation_content(file_path)
+                
+                #Files in the old format have one embedding per turn, not per message: the backfill embeds and indexes them
+                if "embeddings_vectors" in content:
+                    vectors = np.empty((0, 0), dtype=np.float32)
+                else:
+                    vectors = np.array(open_embedding_store(file_path, content).read())
+                
+            full_history = content["full_history"]
+            indexed[file_id] = min(len(vectors), len(full_history))
+            if indexed[file_id]:
+                new_index.add_messages(file_id, 0, vectors[:indexed[file_id]], full_history[:indexed[file_id]])
+                conversations += 1
+            
+            #Conversations decompressed to be indexed go back to the archive tier
+            if archived:
+                archive_conversation(file_id)
+        
+        new_index.train()
+        current_index.replace_with(new_index, since=since, indexed=indexed)
+    
+    return {"conversations": conversations, "messages": len(current_index)}
+
+
+def rebuild_keyword_index() -> dict:
+    """
+    Index again the messages of every conversation file in the keyword index. Each conversation is replaced
+    holding its lock, messages written meanwhile are added by their own write.
+    :return {conversations, messages, errors}
+    """
+    keyword_index = get_keyword_index()
+    
+    conversations, errors = 0, {}
+    for file_id in read_file_index():
+        try:
+            file_path = get_conversation_file_path(file_id)
+            archived = find_conversation_archive(file_path) is not None
+            
+            with get_conversation_lock(file_path):
+                content, _ = load_conversation_content(file_path)
+                keyword_index.replace_conversation(file_id, content["full_history"])
+            conversations += 1
+            
+            if archived:
+                archive_conversation(file_id)
+        except Exception as e:
+            errors[file_id] = str(getattr(e, "detail", e))
+    
+    keyword_index.set_built()
+    return {"conversations": conversations, "messages": len(keyword_index), "errors": errors}
+
+
+def build_keyword_index_in_background():
+    """
+    Index the conversations written before the keyword index existed, once.
+    """
+    def run():
+        try:
+            logger.info(f"Keyword index built: {rebuild_keyword_index()}")
+        except Exception as e:
+            logger.error(f"Error building the keyword index: {e}")
+    
+    if not get_keyword_index().built:
+        threading.Thread(target=run, daemon=True, name="keyword-index").start()
+
+
+#ENDPOINTS
+@Search.get("/search/", tags=["Search"])
+def search_conversations(query: str, top_k: int = Query(default=5, ge=1, le=100)) -> dict:
+    """
+    Semantic search over the messages of all conversations.
+    :param query: Text to search
+    :param top_k: Number of results
+    :return {results: [{conversation_id, position, role, message, score}], took_ms}
+    """
+    start = time.perf_counter()
+    
+    query_embedding = generate_embedding(query)
+    results = get_search_index().search(query_embedding, top_k)
+    
+    return {"results": results, "took_ms": round((time.perf_counter() - start) * 1000, 2)}
+
+
+@Search.get("/search/keyword/", tags=["Search"])
+def search_keywords(
+    query: str,
+    limit: int = Query(default=10, ge=1, le=100),
+    offset: int = Query(default=0, ge=0)
+    ) -> dict:
+    """
+    Keyword search over the messages of all conversations ranked with BM25. Every word of the query must appear,
+    word* searches a prefix. The snippets mark the matched words with **.
+    When the query matches more than KEYWORD_SEARCH_MAX_RANKED messages only the most recent ones are ranked
+    and truncated is true.
+    :param query: Words to search
+    :param limit(optional): Results per page
+    :param offset(optional): Results to skip, next_offset of the previous page
+    :return {results: [{conversation_id, position, role, snippet, score}], next_offset, truncated, took_ms}
+    """
+    start = time.perf_counter()
+    
+    results, next_offset, truncated = get_keyword_index().search(query, limit, offset)
+    
+    return {
+        "results": results, "next_offset": next_offset, "truncated": truncated,
+        "took_ms": round((time.perf_counter() - start) * 1000, 2)
+        }
+
+
+@Search.post("/search/keyword/rebuild", tags=["Search"])
+def rebuild_keywords() -> dict:
+    """
+    Reindex the messages of every conversation file in the keyword index.
+    """
+    return rebuild_keyword_index()
+
+
+@Search.post("/search/rebuild", tags=["Search"])
+def rebuild_search() -> dict:
+    """
+    Reindex the messages of every conversation file.
+    """
+    return rebuild_search_index()
+
+
+if __name__ == "__main__":
+    # python -m routers.search rebuild | rebuild-keywords
+    if sys.argv[1:] == ["rebuild"]:
+        print(rebuild_search_index())
+    elif sys.argv[1:] == ["rebuild-keywords"]:
+        print(rebuild_keyword_index())
+    else:
+        print("Usage: python -m routers.search rebuild | rebuild-keywords")